@@ -1,11 +1,34 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, session, flash
+from flask import Flask, render_template, request, redirect, url_for, session, flash, g, has_request_context, Response, stream_with_context
 import pandas as pd
+import numpy as np
 import os
 import requests
 import shlex
 from flask_session import Session
 import json
+import sqlite3
+import uuid
+import hashlib
+import unicodedata
+import html
 import re
+from collections import OrderedDict, deque
+import threading
+import concurrent.futures
+import shutil
+import time
+import struct
+import zlib
+import pickle
+import queue
+import weakref
+import operator
+import bisect
+import contextlib
+import multiprocessing
+import tempfile
+import atexit
+import functools
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,17 +36,223 @@ load_dotenv()
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'your_default_secret_key')  # Ensure a secret key is set for sessions
 app.config['SESSION_TYPE'] = 'filesystem'  # Store session data on the filesystem
-app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10 MB limit for file uploads
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get("MODERNDB_MAX_UPLOAD_MB", 1024)) * 1024 * 1024  # Upload size limit (uploads are ingested in chunks)
 Session(app)
 
-DATA_PATH = "data/uploaded.csv"  # Path to the CSV file where data is stored
+DATA_PATH = "data/uploaded.csv"  # CSV file of the default table (import/export and the CSV backend)
+DATA_DIR = os.path.dirname(DATA_PATH)  # Every table keeps its store, CSV file and write-ahead log here
+DEFAULT_TABLE = os.path.splitext(os.path.basename(DATA_PATH))[0]  # Table used until a session picks another
+STORAGE_BACKEND = os.environ.get("MODERNDB_STORAGE", "columnar").lower()  # "columnar" or "csv"
+TABLE_MEMORY_MB = int(os.environ.get("MODERNDB_TABLE_MEMORY_MB", 1024))  # Budget for tables held in memory
+WAL_COMPACT_BYTES = int(os.environ.get("MODERNDB_WAL_COMPACT_BYTES", 16 * 1024 * 1024))  # Compact the log past this size
+UPLOAD_CHUNK_ROWS = int(os.environ.get("MODERNDB_UPLOAD_CHUNK_ROWS", 100000))  # Rows parsed and written per upload chunk
+UPLOAD_SAMPLE_ROWS = int(os.environ.get("MODERNDB_UPLOAD_SAMPLE_ROWS", 10000))  # Rows sampled to infer upload dtypes
+COMPACT_DTYPES = os.environ.get("MODERNDB_COMPACT_DTYPES", "on").lower() not in ("off", "false", "0", "no")  # Downcast/categorize columns
+CATEGORY_MAX_RATIO = float(os.environ.get("MODERNDB_CATEGORY_MAX_RATIO", 0.5))  # Distinct/rows ratio up to which strings become categoricals
 # AI Configuration: Prioritize environment variables, then app defaults.
 DEFAULT_AI_URL = os.environ.get("OPENROUTER_API_URL", "https://openrouter.ai/api/v1")
 # API Key must be provided via environment variable for security
 DEFAULT_API_KEY = ""  # Empty default - must be set via environment variable
 DEFAULT_AI_MODEL = os.environ.get("AI_MODEL", "qwen/qwen3-235b-a22b:free")  # Default AI model
 
+# --- Metrics ---------------------------------------------------------------------------------
+# Latency histograms and counters, exposed in the Prometheus text format on /metrics. Phases of
+# request handling (loading, filtering, casting, saving, rendering, the AI call, session I/O, ...)
+# are timed with timed() or the @instrumented decorator, inclusive of the phases nested in them.
+# The 'profile' command collects the phases and counters of a single command in a PhaseProfile,
+# following it onto the dataset writer thread when the command is a mutation.
+
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Histogram bounds, seconds
+METRIC_HELP = {
+    "moderndb_request_seconds": ("histogram", "HTTP request latency by endpoint"),
+    "moderndb_command_seconds": ("histogram", "Terminal command latency by operation"),
+    "moderndb_phase_seconds": ("histogram", "Time spent in each phase, including the phases nested in it"),
+    "moderndb_rows_scanned_total": ("counter", "Rows examined by scans (index lookups excluded)"),
+    "moderndb_rows_mutated_total": ("counter", "Rows added, updated or deleted"),
+    "moderndb_bytes_written_total": ("counter", "Bytes written to disk"),
+    "moderndb_scan_partitions_total": ("counter", "Row partitions scanned on the worker pool"),
+    "moderndb_table_evictions_total": ("counter", "Tables evicted from memory by the table pool"),
+    "moderndb_table_reloads_total": ("counter", "Evicted tables loaded back into memory"),
+    "moderndb_table_resident_bytes": ("gauge", "Estimated memory of each table's resident frame"),
+}
+_profile_context = threading.local()  # .collectors: PhaseProfiles recording this thread; .stack: open phases
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> per-bucket counts (last one +Inf), then the sum
+        self.gauges = {}  # (name, labels) -> last value set
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(METRIC_BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    # Returns every metric in the Prometheus text exposition format.
+    def render(self):
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+            gauges = dict(self.gauges)
+        lines = []
+        for name, (kind, help_text) in METRIC_HELP.items():
+            values = {"histogram": histograms, "counter": counters, "gauge": gauges}[kind]
+            series = sorted(key for key in values if key[0] == name)
+            if not series:
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for key in series:
+                labels = key[1]
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {values[key]}")
+                    continue
+                histogram, cumulative = histograms[key], 0
+                for bound, count in zip(METRIC_BUCKETS + (None,), histogram[:-1]):
+                    cumulative += count
+                    le = "+Inf" if bound is None else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram[-1]:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+metrics = Metrics()
+
+# Phases and counters of one command, for the 'profile' command.
+class PhaseProfile:
+    def __init__(self):
+        self.phases = OrderedDict()  # phase -> [calls, seconds, nesting depth of its first call]
+        self.counters = {}
+
+    # Registers a phase when it starts, so phases are listed in the order they began.
+    def start(self, phase, depth):
+        self.phases.setdefault(phase, [0, 0.0, depth])
+
+    def record(self, phase, seconds):
+        entry = self.phases[phase]
+        entry[0] += 1
+        entry[1] += seconds
+
+# Adds value to a counter, and to the counters of any profile collecting this thread.
+def count_metric(name, value=1, **labels):
+    metrics.inc(name, value, **labels)
+    for profile in getattr(_profile_context, "collectors", None) or ():
+        profile.counters[name] = profile.counters.get(name, 0) + value
+
+# Times the enclosed block into a histogram (moderndb_phase_seconds{phase=...} unless another
+# histogram and labels are given) and into any profile collecting this thread. A phase nested
+# in itself (a recursive or re-entrant call) is only timed once.
+@contextlib.contextmanager
+def timed(phase, histogram="moderndb_phase_seconds", **labels):
+    stack = getattr(_profile_context, "stack", None)
+    if stack is None:
+        stack = _profile_context.stack = []
+    if phase in stack:
+        yield
+        return
+    for profile in getattr(_profile_context, "collectors", None) or ():
+        profile.start(phase, len(stack))
+    stack.append(phase)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stack.pop()
+        metrics.observe(histogram, elapsed, **(labels or {"phase": phase}))
+        for profile in getattr(_profile_context, "collectors", None) or ():
+            profile.record(phase, elapsed)
+
+# Decorator timing every call of a function as the given phase.
+def instrumented(phase):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(phase):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Returns the total size of the files in a directory.
+def _directory_bytes(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+# Wraps the session interface to time loading and saving session data.
+class TimedSessionInterface:
+    def __init__(self, inner):
+        self.inner = inner
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def open_session(self, app, request):
+        with timed("session_load"):
+            return self.inner.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        with timed("session_save"):
+            return self.inner.save_session(app, session, response)
+
+app.session_interface = TimedSessionInterface(app.session_interface)
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def _observe_request(response):
+    started = g.get("request_started")
+    if started is not None:
+        metrics.observe("moderndb_request_seconds", time.perf_counter() - started,
+                        endpoint=request.endpoint or "unknown", method=request.method, status=str(response.status_code))
+    return response
+
+# Makes the table named by a ?table= (or form) parameter, else the session's table (see 'use'),
+# the current table for this request.
+@app.before_request
+def _select_table():
+    name = request.values.get("table") or session.get("table") or DEFAULT_TABLE
+    try:
+        table = get_table(name)
+    except ValueError as e:
+        if name == session.get("table"):
+            session.pop("table", None)  # Stale name from an older session; fall back to the default.
+            table = get_table(DEFAULT_TABLE)
+        else:
+            return {"error": str(e)}, 400
+    _table_context.table = table
+
+@app.teardown_request
+def _reset_table(exc):
+    _table_context.table = None
+
+# Route exposing the metrics in the Prometheus text format.
+@app.route("/metrics")
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 # Helper function to attempt type casting for assignment, inferring from target series or by trying common types.
+@instrumented("cast")
 def _attempt_cast_for_assignment(value_str, target_series_for_dtype_inference):
     # If the target series (column) is empty, we have to guess the type.
     if target_series_for_dtype_inference.empty:
@@ -36,345 +265,5241 @@ def _attempt_cast_for_assignment(value_str, target_series_for_dtype_inference):
 
     target_dtype = target_series_for_dtype_inference.dtype
 
-    # Handle common string representations of null/NA values.
-    if str(value_str).lower() in ['nan', 'na', '<na>', 'none', '']:
-        return pd.NA  # Use pandas' NA for missing values.
+    # Handle common string representations of null/NA values.
+    if str(value_str).lower() in NULL_VALUE_STRINGS:
+        return pd.NA  # Use pandas' NA for missing values.
+
+    try:
+        # Attempt casting based on the target column's existing dtype.
+        if pd.api.types.is_integer_dtype(target_dtype):
+            return int(float(value_str))  # Convert to float first to handle "10.0", then to int.
+        elif pd.api.types.is_float_dtype(target_dtype):
+            return float(value_str)
+        elif pd.api.types.is_bool_dtype(target_dtype):
+            val_lower = str(value_str).lower()
+            if val_lower in TRUE_STRINGS:
+                return True
+            if val_lower in FALSE_STRINGS:
+                return False
+            return str(value_str)  # If not a clear boolean string, keep as string.
+        elif pd.api.types.is_datetime64_any_dtype(target_dtype):
+            return pd.to_datetime(value_str, errors='raise')  # Try parsing as datetime.
+        return str(value_str)  # Default to string if no other type matches.
+    except ValueError:
+        # If any type conversion fails, return the original string value.
+        return str(value_str)
+
+# CSV storage backend: the original plain-text format. It re-infers dtypes from text on every
+# read, so it is mainly kept as the import/export format and as a fallback backend. The
+# compact dtypes text can't express (downcast integers, categoricals) are recorded in a
+# <path>.schema.json sidecar that is only trusted while the file's signature matches it.
+class CsvStorage:
+    name = "csv"
+    supports_wal = False  # A CSV file has nowhere to record which log records it already contains.
+
+    def __init__(self, path):
+        self.path = path
+        self.schema_path = path + ".schema.json"
+
+    # Returns the (mtime, size) signature of the file, or None if it doesn't exist.
+    def signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    # Reads the file. Returns an empty DataFrame if the file doesn't exist or is empty. Columns
+    # with a dtype recorded in the sidecar are parsed straight into it.
+    def read(self):
+        if os.path.exists(self.path):
+            try:
+                schema = self._schema()
+                if schema and schema["dtypes"]:
+                    try:
+                        return pd.read_csv(self.path, dtype=schema["dtypes"])
+                    except (ValueError, TypeError, OverflowError):
+                        pass  # Values no longer fit the recorded dtypes: infer them from the text.
+                return pd.read_csv(self.path)
+            except pd.errors.EmptyDataError:
+                # Handle empty file case
+                return pd.DataFrame()
+        else:
+            return pd.DataFrame()
+
+    # Writes the DataFrame and returns it. An empty DataFrame is written as an empty file.
+    # The file is written to a temporary name and renamed into place, so a crash mid-save
+    # leaves the previous version intact instead of a truncated file.
+    @instrumented("storage_write")
+    def write(self, df):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", newline="") as f:
+            if not df.empty:
+                df.to_csv(f, index=False)
+            f.flush()
+            os.fsync(f.fileno())
+        count_metric("moderndb_bytes_written_total", os.path.getsize(tmp_path), target="store")
+        os.replace(tmp_path, self.path)
+        _fsync_dir(directory)
+        self._write_schema(df)
+        return df if not df.empty else pd.DataFrame()
+
+    # Returns the sidecar schema if it describes the current file, otherwise None.
+    def _schema(self):
+        try:
+            with open(self.schema_path) as f:
+                schema = json.load(f)
+        except (OSError, ValueError):
+            return None
+        signature = self.signature()
+        return schema if signature is not None and schema.get("signature") == list(signature) else None
+
+    # Records the dtypes of df that a plain read wouldn't infer, and whether they were chosen by
+    # optimize_dtypes (see is_compact).
+    def _write_schema(self, df, compact=COMPACT_DTYPES):
+        dtypes = {str(col): str(dtype) for col, dtype in df.dtypes.items()
+                  if isinstance(dtype, pd.CategoricalDtype) or dtype in _COMPACT_INTEGER_DTYPES}
+        schema = {"signature": list(self.signature()), "compact": compact, "dtypes": dtypes}
+        tmp_path = f"{self.schema_path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(schema, f)
+        os.replace(tmp_path, self.schema_path)
+
+    # Whether the stored dtypes were already chosen by optimize_dtypes.
+    def is_compact(self):
+        schema = self._schema()
+        return bool(schema and schema["compact"])
+
+    # Flags the stored dtypes as chosen by optimize_dtypes without rewriting the file.
+    def mark_compact(self, df):
+        self._write_schema(df, compact=True)
+
+    # Returns a writer that streams chunks into a temporary file and replaces the store on commit.
+    # compact tells whether the chunks hold dtypes chosen by optimize_dtypes (see is_compact).
+    def open_writer(self, columns, compact=False):
+        return CsvChunkWriter(self, compact)
+
+    # Returns (0, iterator over the rows in chunks of chunk_rows starting at row start). The file
+    # is opened up front, so the chunks stay consistent if the file is replaced meanwhile.
+    def read_chunks(self, chunk_rows, start=0):
+        if not os.path.exists(self.path):
+            return 0, iter(())
+        schema = self._schema()
+        try:
+            reader = pd.read_csv(self.path, chunksize=chunk_rows, dtype=schema["dtypes"] if schema else None,
+                                 skiprows=range(1, start + 1) if start else None)
+        except pd.errors.EmptyDataError:
+            return 0, iter(())
+        return 0, self._iter_chunks(reader)
+
+    def _iter_chunks(self, reader):
+        with reader:
+            for chunk in reader:
+                yield chunk.reset_index(drop=True)
+
+    # Size of the stored file in bytes.
+    def stored_bytes(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    # Returns (rows, column names) of the stored file, counting rows with a one-column read.
+    def stored_shape(self):
+        try:
+            columns = list(pd.read_csv(self.path, nrows=0).columns)
+        except (OSError, pd.errors.EmptyDataError):
+            return 0, []
+        rows = sum(len(chunk) for chunk in pd.read_csv(self.path, usecols=[0], chunksize=UPLOAD_CHUNK_ROWS))
+        return rows, columns
+
+
+# Streams DataFrame chunks into a new CSV file; commit() renames it into place and records the
+# chunks' dtypes in the schema sidecar.
+class CsvChunkWriter:
+    def __init__(self, storage, compact=False):
+        self.storage = storage
+        self.path = storage.path
+        self.compact = compact
+        self.directory = os.path.dirname(self.path) or "."
+        os.makedirs(self.directory, exist_ok=True)
+        self.tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        self.file = open(self.tmp_path, "w", newline="")
+        self.schema = None  # Empty frame with the dtypes of the chunks
+        self.rows = 0
+
+    def append(self, chunk):
+        chunk.to_csv(self.file, index=False, header=self.schema is None)
+        if self.schema is None:
+            self.schema = chunk.iloc[:0]
+        self.rows += len(chunk)
+
+    def commit(self, wal_seq=0):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        count_metric("moderndb_bytes_written_total", os.path.getsize(self.tmp_path), target="store")
+        os.replace(self.tmp_path, self.path)
+        _fsync_dir(self.directory)
+        if self.schema is not None:
+            self.storage._write_schema(self.schema, compact=self.compact)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+# Columnar binary storage backend. Every save writes a new generation directory holding one
+# .npy file per column plus a schema.json sidecar (dtypes, categories, row count), and the
+# CURRENT file naming the live generation is swapped atomically. Numeric, bool and datetime
+# columns are memory-mapped on load; string columns are dictionary-encoded as integer codes.
+class ColumnarStorage:
+    name = "columnar"
+    supports_wal = True
+    FORMAT_VERSION = 1
+
+    def __init__(self, root):
+        self.root = root
+
+    def _current_path(self):
+        return os.path.join(self.root, "CURRENT")
+
+    # Returns the name of the live generation directory, or None if nothing was written yet.
+    def _current_generation(self):
+        try:
+            with open(self._current_path()) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    # CURRENT is replaced on every save, so its inode/mtime identifies the stored generation.
+    def signature(self):
+        try:
+            st = os.stat(self._current_path())
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    # Imports a CSV dataset left by an older version of the app, if the store is still empty.
+    def import_legacy_csv(self, csv_path):
+        if self._current_generation() is None and os.path.exists(csv_path):
+            df = CsvStorage(csv_path).read()
+            if not df.empty:
+                self.write(optimize_dtypes(df)[0] if COMPACT_DTYPES else df)
+
+    def read(self):
+        return self.read_checkpoint()[0]
+
+    # Returns the stored DataFrame together with the sequence number of the last write-ahead
+    # log record already folded into it.
+    def read_checkpoint(self):
+        generation = self._current_generation()
+        if generation is None:
+            return pd.DataFrame(), 0
+
+        gen_dir = os.path.join(self.root, generation)
+        with open(os.path.join(gen_dir, "schema.json")) as f:
+            schema = json.load(f)
+        n_rows = schema["rows"]
+        data = {}
+        for col_meta in schema["columns"]:
+            data[col_meta["name"]] = self._column_decoder(gen_dir, col_meta)(0, n_rows)
+        wal_seq = schema.get("wal_seq", 0)
+        if not data:
+            return pd.DataFrame(), wal_seq
+        return pd.DataFrame(data, copy=False), wal_seq  # copy=False keeps the memory-mapped arrays as-is.
+
+    # Returns the write-ahead log sequence number folded into the live generation and an iterator
+    # over its rows in chunks of chunk_rows, starting at row start. The generation's files are
+    # mapped up front, so the chunks stay consistent if a new generation is published meanwhile.
+    def read_chunks(self, chunk_rows, start=0):
+        generation = self._current_generation()
+        if generation is None:
+            return 0, iter(())
+        gen_dir = os.path.join(self.root, generation)
+        with open(os.path.join(gen_dir, "schema.json")) as f:
+            schema = json.load(f)
+        decoders = [(col_meta["name"], self._column_decoder(gen_dir, col_meta)) for col_meta in schema["columns"]]
+        return schema.get("wal_seq", 0), self._iter_chunks(decoders, schema["rows"], chunk_rows, start)
+
+    def _iter_chunks(self, decoders, n_rows, chunk_rows, start):
+        if not decoders:
+            return
+        for begin in range(start, n_rows, chunk_rows):
+            end = min(begin + chunk_rows, n_rows)
+            yield pd.DataFrame({name: decode(begin, end) for name, decode in decoders}, copy=False)
+
+    # Size of the live generation's files in bytes.
+    def stored_bytes(self):
+        generation = self._current_generation()
+        return _directory_bytes(os.path.join(self.root, generation)) if generation is not None else 0
+
+    # Returns (rows, column names) of the live generation, from its schema alone.
+    def stored_shape(self):
+        generation = self._current_generation()
+        if generation is None:
+            return 0, []
+        with open(os.path.join(self.root, generation, "schema.json")) as f:
+            schema = json.load(f)
+        return schema["rows"], [col_meta["name"] for col_meta in schema["columns"]]
+
+    # Returns the write-ahead log sequence number recorded in the live generation.
+    def checkpoint_seq(self):
+        generation = self._current_generation()
+        if generation is None:
+            return 0
+        with open(os.path.join(self.root, generation, "schema.json")) as f:
+            return json.load(f).get("wal_seq", 0)
+
+    # Whether the live generation's dtypes were already chosen by optimize_dtypes. Generations
+    # streamed in by an upload or written by an older version aren't.
+    def is_compact(self):
+        generation = self._current_generation()
+        return generation is not None and os.path.exists(os.path.join(self.root, generation, "COMPACT"))
+
+    # Flags the live generation as holding compact dtypes without rewriting it.
+    def mark_compact(self, df):
+        generation = self._current_generation()
+        if generation is not None:
+            open(os.path.join(self.root, generation, "COMPACT"), "w").close()
+
+    # Writes the DataFrame as a new generation and returns it with the dtypes it will read back with.
+    def write(self, df, wal_seq=0):
+        generation, stored = self.prepare_generation(df, wal_seq)
+        self.publish_generation(generation)
+        return stored
+
+    # Writes a complete generation directory without making it live yet. Returns its name and
+    # the DataFrame as it will read back.
+    @instrumented("storage_write")
+    def prepare_generation(self, df, wal_seq=0):
+        os.makedirs(self.root, exist_ok=True)
+        generation = f"gen-{time.time_ns():020d}"
+        tmp_dir = os.path.join(self.root, f"{generation}.tmp-{os.getpid()}")
+        os.makedirs(tmp_dir)
+
+        stored = {}
+        schema = {"format": self.FORMAT_VERSION, "rows": len(df), "wal_seq": wal_seq, "columns": []}
+        if not df.empty:
+            for i, col in enumerate(df.columns):
+                series = df[col]
+                if series.dtype == object:
+                    series = _normalize_object_column(series)
+                col_meta = {"name": str(col), "file": f"c{i}"}
+                col_meta.update(self._encode_column(tmp_dir, col_meta["file"], series))
+                schema["columns"].append(col_meta)
+                stored[str(col)] = series.reset_index(drop=True)
+        with open(os.path.join(tmp_dir, "schema.json"), "w") as f:
+            json.dump(schema, f, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        if COMPACT_DTYPES:
+            open(os.path.join(tmp_dir, "COMPACT"), "w").close()  # Frames saved here already hold compact dtypes.
+        count_metric("moderndb_bytes_written_total", _directory_bytes(tmp_dir), target="store")
+        os.rename(tmp_dir, os.path.join(self.root, generation))
+        return generation, (pd.DataFrame(stored, copy=False) if stored else pd.DataFrame())
+
+    # Makes a prepared generation live by atomically swapping CURRENT.
+    def publish_generation(self, generation):
+        current_tmp = self._current_path() + f".tmp-{os.getpid()}"
+        with open(current_tmp, "w") as f:
+            f.write(generation)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(current_tmp, self._current_path())
+        _fsync_dir(self.root)
+        self._remove_old_generations(keep=generation)
+
+    # Removes a prepared generation that will never be published.
+    def discard_generation(self, generation):
+        shutil.rmtree(os.path.join(self.root, generation), ignore_errors=True)
+
+    # Deletes superseded generations, keeping the live one and its predecessor so readers in
+    # other processes that resolved CURRENT just before the swap can finish loading.
+    def _remove_old_generations(self, keep):
+        generations = sorted(name for name in os.listdir(self.root)
+                             if name.startswith("gen-") and ".tmp-" not in name)
+        for name in generations[:-2]:
+            if name != keep:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    # Returns a writer that streams chunks into a new generation and publishes it on commit.
+    # compact tells whether the chunks hold dtypes chosen by optimize_dtypes (see is_compact).
+    def open_writer(self, columns, compact=False):
+        return ColumnarChunkWriter(self, columns, compact)
+
+    def _save_array(self, gen_dir, file_name, arr):
+        path = os.path.join(gen_dir, file_name + ".npy")
+        with open(path, "wb") as f:
+            np.save(f, np.ascontiguousarray(arr), allow_pickle=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _load_array(self, gen_dir, file_name):
+        # mmap_mode='c' maps the file copy-on-write: nothing is parsed or copied up front and
+        # in-memory edits never touch the stored generation.
+        return np.load(os.path.join(gen_dir, file_name + ".npy"), mmap_mode="c", allow_pickle=False)
+
+    # Writes one column and returns its schema entry.
+    def _encode_column(self, gen_dir, file_name, series):
+        dtype = series.dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            self._save_array(gen_dir, file_name, series.cat.codes.to_numpy())
+            categories = series.cat.categories
+            return {"kind": "category", "dtype": "category", "ordered": bool(dtype.ordered),
+                    "categories": categories.tolist(), "categories_dtype": str(categories.dtype)}
+        if isinstance(series.array, (pd.arrays.IntegerArray, pd.arrays.FloatingArray, pd.arrays.BooleanArray)):
+            # Nullable extension dtypes: raw values plus a validity mask.
+            numpy_dtype = dtype.numpy_dtype
+            self._save_array(gen_dir, file_name, series.to_numpy(dtype=numpy_dtype, na_value=numpy_dtype.type(0)))
+            self._save_array(gen_dir, file_name + ".mask", series.isna().to_numpy())
+            return {"kind": "masked", "dtype": str(dtype)}
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            self._save_array(gen_dir, file_name, series.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy())
+            return {"kind": "datetimetz", "dtype": str(dtype), "tz": str(dtype.tz)}
+        if isinstance(dtype, np.dtype) and dtype.kind in "biufcmM":
+            self._save_array(gen_dir, file_name, series.to_numpy())
+            return {"kind": "numpy", "dtype": str(dtype)}
+        # Strings (object or pandas string dtype): dictionary-encode into int32 codes, -1 for missing.
+        codes, uniques = pd.factorize(series, use_na_sentinel=True)
+        self._save_array(gen_dir, file_name, codes.astype(np.int32))
+        return {"kind": "dictionary", "dtype": "string" if isinstance(dtype, pd.StringDtype) else "object",
+                "values": [str(v) for v in uniques]}
+
+    # Returns decode(start, stop), which decodes rows start..stop of a stored column. The column's
+    # files are mapped (and its lookup tables built) once, when the decoder is made.
+    def _column_decoder(self, gen_dir, col_meta):
+        kind = col_meta["kind"]
+        values = self._load_array(gen_dir, col_meta["file"])
+        if kind == "numpy":
+            return lambda start, stop: values[start:stop]
+        if kind == "masked":
+            mask = self._load_array(gen_dir, col_meta["file"] + ".mask")
+            array_type = pd.api.types.pandas_dtype(col_meta["dtype"]).construct_array_type()
+            return lambda start, stop: array_type(values[start:stop], mask[start:stop])
+        if kind == "datetimetz":
+            return lambda start, stop: pd.Series(values[start:stop]).dt.tz_localize("UTC").dt.tz_convert(col_meta["tz"])
+        if kind == "category":
+            categories = pd.Index(col_meta["categories"]).astype(col_meta["categories_dtype"])
+            return lambda start, stop: pd.Categorical.from_codes(values[start:stop], categories=categories,
+                                                                 ordered=col_meta["ordered"])
+        # Dictionary-encoded strings: one gather through a lookup table whose last slot is the
+        # missing value, so code -1 maps to NaN without a separate pass.
+        lookup = np.empty(len(col_meta["values"]) + 1, dtype=object)
+        lookup[:-1] = col_meta["values"]
+        lookup[-1] = np.nan
+        if col_meta["dtype"] == "string":
+            return lambda start, stop: pd.array(lookup[values[start:stop]], dtype="string")
+        return lambda start, stop: lookup[values[start:stop]]
+
+
+# Streams DataFrame chunks into a new columnar generation without holding the whole table.
+# Each column is appended to its .npy file behind a header reserved at the maximum width and
+# rewritten with the real row count on commit. Every chunk must carry the same dtypes, except
+# that categoricals may differ in their categories: object columns are dictionary-encoded against
+# a dictionary that grows across chunks, and categoricals are re-coded against a category list
+# that grows the same way. Nullable and timezone-aware columns are stored as by _encode_column.
+class ColumnarChunkWriter:
+    def __init__(self, storage, columns, compact=False):
+        self.storage = storage
+        self.compact = compact
+        os.makedirs(storage.root, exist_ok=True)
+        self.generation = f"gen-{time.time_ns():020d}"
+        self.tmp_dir = os.path.join(storage.root, f"{self.generation}.tmp-{os.getpid()}")
+        os.makedirs(self.tmp_dir)
+        self.columns = [{"name": str(col), "file": f"c{i}"} for i, col in enumerate(columns)]
+        self.files = [None] * len(self.columns)
+        self.mask_files = [None] * len(self.columns)
+        self.dtypes = [None] * len(self.columns)
+        self.dictionaries = [None] * len(self.columns)
+        self.kinds = [None] * len(self.columns)  # Schema entry of each column, without its dictionary
+        self.rows = 0
+
+    def append(self, chunk):
+        for i, col_meta in enumerate(self.columns):
+            series = chunk.iloc[:, i]
+            if self.files[i] is None:
+                self._open_column(i, series)
+            kind = self.kinds[i]["kind"]
+            if self.dictionaries[i] is not None:
+                dictionary = self.dictionaries[i]
+                if kind == "category":
+                    uniques, codes = series.cat.categories, series.cat.codes.to_numpy()
+                    mapping = np.array([dictionary.setdefault(v, len(dictionary)) for v in uniques] + [-1], dtype=np.int32)
+                else:
+                    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+                    mapping = np.array([dictionary.setdefault(str(v), len(dictionary)) for v in uniques] + [-1], dtype=np.int32)
+                values = mapping[codes]
+            elif kind == "masked":
+                values = series.to_numpy(dtype=self.dtypes[i], na_value=self.dtypes[i].type(0))
+                self.mask_files[i].write(np.ascontiguousarray(series.isna().to_numpy()).tobytes())
+            elif kind == "datetimetz":
+                values = series.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy().astype(self.dtypes[i], copy=False)
+            else:
+                values = series.to_numpy().astype(self.dtypes[i], copy=False)
+            self.files[i].write(np.ascontiguousarray(values).tobytes())
+        self.rows += len(chunk)
+
+    def _open_column(self, i, series):
+        dtype = series.dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            self.dtypes[i], self.dictionaries[i] = np.dtype(np.int32), {}
+            self.kinds[i] = {"kind": "category", "dtype": "category", "ordered": bool(dtype.ordered),
+                             "categories_dtype": str(dtype.categories.dtype)}
+        elif isinstance(series.array, (pd.arrays.IntegerArray, pd.arrays.FloatingArray, pd.arrays.BooleanArray)):
+            self.dtypes[i] = dtype.numpy_dtype
+            self.kinds[i] = {"kind": "masked", "dtype": str(dtype)}
+            self.mask_files[i] = self._open_file(self.columns[i]["file"] + ".mask", np.dtype(bool))
+        elif isinstance(dtype, pd.DatetimeTZDtype):
+            self.dtypes[i] = np.dtype("datetime64[ns]")
+            self.kinds[i] = {"kind": "datetimetz", "dtype": str(dtype), "tz": str(dtype.tz)}
+        elif isinstance(dtype, np.dtype) and dtype.kind in "biufcmM":
+            self.dtypes[i] = dtype
+            self.kinds[i] = {"kind": "numpy", "dtype": str(dtype)}
+        else:
+            self.dtypes[i], self.dictionaries[i] = np.dtype(np.int32), {}
+            self.kinds[i] = {"kind": "dictionary", "dtype": "string" if isinstance(dtype, pd.StringDtype) else "object"}
+        self.files[i] = self._open_file(self.columns[i]["file"], self.dtypes[i])
+
+    def _open_file(self, file_name, dtype):
+        f = open(os.path.join(self.tmp_dir, file_name + ".npy"), "wb")
+        f.write(_npy_header(dtype, 10 ** 18))  # Placeholder wide enough for any row count.
+        return f
+
+    # Rewrites the placeholder header of a column file with the real row count and closes it.
+    def _finish_file(self, f, dtype):
+        f.seek(0)
+        f.write(_npy_header(dtype, self.rows, size=len(_npy_header(dtype, 10 ** 18))))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def commit(self, wal_seq=0):
+        schema = {"format": self.storage.FORMAT_VERSION, "rows": self.rows, "wal_seq": wal_seq, "columns": []}
+        for i, col_meta in enumerate(self.columns):
+            if self.files[i] is None:  # No rows were written: store an empty string column.
+                self.dtypes[i], self.dictionaries[i] = np.dtype(np.int32), {}
+                self.kinds[i] = {"kind": "dictionary", "dtype": "object"}
+                self.files[i] = self._open_file(col_meta["file"], self.dtypes[i])
+            self._finish_file(self.files[i], self.dtypes[i])
+            if self.mask_files[i] is not None:
+                self._finish_file(self.mask_files[i], np.dtype(bool))
+            col_meta.update(self.kinds[i])
+            if col_meta["kind"] == "category":
+                col_meta["categories"] = list(self.dictionaries[i])
+            elif col_meta["kind"] == "dictionary":
+                col_meta["values"] = list(self.dictionaries[i])
+            schema["columns"].append(col_meta)
+        with open(os.path.join(self.tmp_dir, "schema.json"), "w") as f:
+            json.dump(schema, f, default=str)
+            f.flush()
+            os.fsync(f.fileno())
+        if self.compact:
+            open(os.path.join(self.tmp_dir, "COMPACT"), "w").close()
+        count_metric("moderndb_bytes_written_total", _directory_bytes(self.tmp_dir), target="store")
+        os.rename(self.tmp_dir, os.path.join(self.storage.root, self.generation))
+        self.storage.publish_generation(self.generation)
+
+    def abort(self):
+        for f in self.files + self.mask_files:
+            if f is not None:
+                f.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+# Returns a version 1.0 .npy header for a 1-D array, padded with spaces to size bytes if given
+# (so a header written up front can be rewritten in place once the row count is known).
+def _npy_header(dtype, n_rows, size=None):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(dtype), n_rows)
+    prefix = 6 + 2 + 2  # Magic string, format version, header length.
+    if size is None:
+        size = -(-(prefix + len(header) + 1) // 64) * 64
+    header = header.ljust(size - prefix - 1) + "\n"
+    return np.lib.format.magic(1, 0) + struct.pack("<H", len(header)) + header.encode("latin1")
+
+# Gives object columns the dtype a CSV round-trip would have inferred (e.g. ints mixed with NA
+# after an update become float64), so the columnar store never has to pickle Python objects.
+# Columns of genuinely mixed types are stored as their string representation.
+def _normalize_object_column(series):
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+    if inferred in ("string", "empty"):
+        return series
+    if inferred in ("integer", "floating", "mixed-integer-float", "decimal"):
+        return pd.to_numeric(series, errors="coerce")
+    if inferred == "boolean":
+        return series.astype("boolean")
+    if inferred in ("datetime", "datetime64", "date"):
+        converted = pd.to_datetime(series, errors="coerce")
+        if converted.notna().sum() == series.notna().sum():
+            return converted
+    return series.where(series.isna(), series.astype(str))
+
+# Flushes a directory entry to disk so a rename inside it survives a crash.
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # Not supported on this platform (e.g. Windows).
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# --- Compact dtypes ------------------------------------------------------------------------
+# Uploaded and loaded tables pass through optimize_dtypes: integer columns are downcast to the
+# narrowest signed width that holds their range, and string columns with few distinct values
+# (at most CATEGORY_MAX_RATIO of the rows) become categoricals. Both stores persist the chosen
+# dtypes, so later loads read them back directly. Floats stay float64: float32 would change
+# comparisons and sums against the decimal literals typed in commands.
+
+_COMPACT_INTEGER_DTYPES = (np.dtype(np.int8), np.dtype(np.int16), np.dtype(np.int32))
+
+# Returns the compact dtype for a column, or None if it should keep its dtype.
+def compact_dtype(series):
+    dtype = series.dtype
+    if len(series) == 0:
+        return None
+    if isinstance(dtype, np.dtype) and dtype.kind == "i":
+        values = series.to_numpy()
+        low, high = values.min(), values.max()
+        for candidate in _COMPACT_INTEGER_DTYPES:
+            if candidate.itemsize >= dtype.itemsize:
+                return None
+            info = np.iinfo(candidate)
+            if info.min <= low and high <= info.max:
+                return candidate
+        return None
+    if dtype == object or isinstance(dtype, pd.StringDtype):
+        if pd.api.types.infer_dtype(series, skipna=True) != "string":
+            return None
+        if series.nunique(dropna=True) <= CATEGORY_MAX_RATIO * len(series):
+            return "category"
+    return None
+
+# Returns df with compact dtypes (unchanged columns are shared, not copied) and a dict of the
+# columns that changed, mapped to their new dtype.
+def optimize_dtypes(df):
+    changed = {}
+    for col in df.columns:
+        dtype = compact_dtype(df[col])
+        if dtype is not None:
+            changed[col] = dtype
+    if not changed:
+        return df, changed
+    df = df.copy(deep=False)
+    for col, dtype in changed.items():
+        df[col] = df[col].astype(object).astype(dtype) if dtype == "category" else df[col].astype(dtype)
+    return df, {col: df[col].dtype for col in changed}
+
+# Whether a column still stores its values the same way after a mutation: the dtype is equal,
+# or it is a categorical that only gained categories.
+def same_column_dtype(a, b):
+    if isinstance(a, pd.CategoricalDtype) and isinstance(b, pd.CategoricalDtype):
+        return a.ordered == b.ordered
+    return a == b
+
+# Gives appended rows the compact dtypes of the frame's columns where their values fit, so an
+# append doesn't widen a downcast integer column back to int64 or turn a categorical into
+# object. Categoricals gain the new strings as categories (df is updated in place).
+def _align_appended_rows(df, rows):
+    aligned = {}
+    for col in rows.columns:
+        if col not in df.columns or rows[col].dtype == df[col].dtype or rows[col].empty:
+            continue
+        dtype, values = df[col].dtype, rows[col]
+        if isinstance(dtype, pd.CategoricalDtype):
+            if pd.api.types.infer_dtype(values, skipna=True) not in ("string", "empty"):
+                continue
+            new = pd.Index(values.dropna().unique()).difference(dtype.categories, sort=False)
+            if len(new):
+                df[col] = df[col].cat.add_categories(new)
+            aligned[col] = pd.Categorical(values, dtype=df[col].dtype)
+        elif isinstance(dtype, np.dtype) and dtype.kind == "i" and values.dtype.kind == "i":
+            info = np.iinfo(dtype)
+            if info.min <= values.min() and values.max() <= info.max:
+                aligned[col] = values.astype(dtype)
+    if not aligned:
+        return rows
+    rows = rows.copy(deep=False)
+    for col, values in aligned.items():
+        rows[col] = values
+    return rows
+
+# Writes logged cell values into a column at the given row positions. A categorical column
+# first gains any values it doesn't have yet as categories, as the live update did, and a
+# downcast integer column is widened back to int64 if the values don't fit it.
+def _assign_values(df, positions, column, values):
+    series = df[column]
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        present = pd.Index(values).dropna().unique()
+        new = present.difference(dtype.categories, sort=False)
+        if len(new):
+            df[column] = series.cat.add_categories(new)
+    elif dtype in _COMPACT_INTEGER_DTYPES:
+        values = np.asarray(values)
+        info = np.iinfo(dtype)
+        if values.dtype.kind == "i" and len(values) and not (info.min <= values.min() and values.max() <= info.max):
+            df[column] = series.astype(np.int64)
+    df.iloc[positions, df.columns.get_loc(column)] = values
+
+# Returns (bytes used, bytes with the default wide dtype) for one column: int64 instead of a
+# downcast integer, object strings instead of a categorical.
+def column_memory(series):
+    used = int(series.memory_usage(index=False, deep=True))
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return used, int(series.astype(object).memory_usage(index=False, deep=True))
+    if isinstance(dtype, np.dtype) and dtype.kind == "i":
+        return used, len(series) * 8
+    return used, used
+
+# Summarizes the columns stored with compact dtypes, e.g. for the upload report.
+def describe_compact_columns(df, limit=10):
+    compact = [f"{col} ({dtype})" for col, dtype in df.dtypes.items()
+               if isinstance(dtype, pd.CategoricalDtype) or dtype in _COMPACT_INTEGER_DTYPES]
+    if not compact:
+        return None
+    more = f" and {len(compact) - limit} more" if len(compact) > limit else ""
+    return f"Compact dtypes for {len(compact)} column(s): {', '.join(compact[:limit])}{more}"
+
+# Formats a byte count for display, e.g. "12.3 MB".
+def _format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+# Append-only write-ahead log of a table's mutations, kept next to its store. Each record is framed
+# as <payload length:u32><crc32:u32><seq:u64><pickled payload>; a record torn by a crash mid-append
+# fails its length/CRC check and is dropped, along with anything after it, on the next scan.
+class WriteAheadLog:
+    HEADER = struct.Struct("<IIQ")
+
+    def __init__(self, path):
+        self.path = path
+        self.last_seq = None  # Highest sequence number written, resolved lazily on first use.
+
+    # Returns the (mtime, size) signature of the log, or None if it doesn't exist.
+    def signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    # Reads every intact record as (seq, record) pairs. A torn tail is truncated away so later
+    # appends don't land behind garbage.
+    def _scan(self):
+        entries = []
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return entries
+        offset = 0
+        while offset + self.HEADER.size <= len(data):
+            length, crc, seq = self.HEADER.unpack_from(data, offset)
+            start = offset + self.HEADER.size
+            payload = data[start:start + length]
+            if len(payload) != length or zlib.crc32(payload, seq & 0xFFFFFFFF) != crc:
+                break
+            entries.append((seq, pickle.loads(payload)))
+            offset = start + length
+        if offset < len(data):
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+                f.flush()
+                os.fsync(f.fileno())
+        return entries
+
+    # Makes sure last_seq is at least the checkpoint already folded into the base store.
+    def sync_seq(self, checkpoint_seq):
+        if self.last_seq is None:
+            entries = self._scan()
+            self.last_seq = entries[-1][0] if entries else 0
+        self.last_seq = max(self.last_seq, checkpoint_seq)
+        return self.last_seq
+
+    # Returns the records newer than after_seq, in order.
+    def read_records(self, after_seq):
+        return [record for seq, record in self._scan() if seq > after_seq]
+
+    # Appends one record durably and returns its sequence number.
+    def append(self, record):
+        return self.append_many([record])[-1]
+
+    # Appends several records with a single fsync (group commit) and returns their sequence numbers.
+    @instrumented("wal_append")
+    def append_many(self, records):
+        seqs, frames = [], []
+        for i, record in enumerate(records):
+            seq = self.last_seq + 1 + i
+            payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+            frames.append(self.HEADER.pack(len(payload), zlib.crc32(payload, seq & 0xFFFFFFFF), seq) + payload)
+            seqs.append(seq)
+        data = b"".join(frames)
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        count_metric("moderndb_bytes_written_total", len(data), target="wal")
+        self.last_seq = seqs[-1]
+        return seqs
+
+    # Drops records up to and including seq, once they are safely part of the base store.
+    def discard_through(self, seq):
+        remaining = [(s, record) for s, record in self._scan() if s > seq]
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            for s, record in remaining:
+                payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+                f.write(self.HEADER.pack(len(payload), zlib.crc32(payload, s & 0xFFFFFFFF), s) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        count_metric("moderndb_bytes_written_total", os.path.getsize(tmp_path), target="wal")
+        os.replace(tmp_path, self.path)
+        _fsync_dir(os.path.dirname(self.path) or ".")
+
+# Applies one write-ahead log record to a DataFrame and returns the result. The same function is
+# used when a mutation happens live and when the log is replayed on load, so both produce the
+# same frame. Records:
+#   {"op": "append", "rows": DataFrame}                       rows to add (with the full schema)
+#   {"op": "update", "positions": array, "columns": {...}}    per column either the new "values"
+#                                                              at positions, or a whole "column"
+#   {"op": "delete", "positions": array}                      row positions to tombstone
+@instrumented("apply_mutation")
+def apply_wal_record(df, record):
+    op = record["op"]
+    if op == "append":
+        rows = record["rows"]
+        if df.empty:
+            return rows.reset_index(drop=True)
+        for col in rows.columns:
+            if col not in df.columns:
+                df[col] = None
+        return pd.concat([df, _align_appended_rows(df, rows)], ignore_index=True)
+    if op == "update":
+        positions = record["positions"]
+        for col, change in record["columns"].items():
+            if "column" in change:
+                df[col] = change["column"]
+            else:
+                _assign_values(df, positions, col, change["values"])
+        return df
+    if op == "delete":
+        return df.drop(df.index[record["positions"]]).reset_index(drop=True)
+    raise ValueError(f"Unknown write-ahead log record: {op}")
+
+# Guards the tables' cached frames and versions. A cached frame is keyed by its table's dataset
+# version (bumped on every write) plus the on-disk signature of the store and the write-ahead log
+# (file mtime/size), so edits made outside this process still invalidate it.
+_data_lock = threading.RLock()
+
+# Unmodified frames handed out by load_data (or just committed), keyed by id() with a weak
+# reference to check identity. Secondary indexes are only used for frames found here.
+_frame_versions = {}
+
+# Records that df is the unmodified frame of the given dataset version.
+def _register_frame(df, version):
+    key = id(df)
+    def _expire(ref, key=key):
+        entry = _frame_versions.get(key)
+        if entry is not None and entry[0] is ref:
+            del _frame_versions[key]
+    _frame_versions[key] = (weakref.ref(df, _expire), version)
+
+# Returns the dataset version df is an unmodified copy of, or None if unknown.
+def frame_version(df):
+    entry = _frame_versions.get(id(df))
+    if entry is not None and entry[0]() is df:
+        return entry[1]
+    return None
+
+# Marks df as no longer matching its dataset version (for callers that mutate it in place
+# and keep querying it).
+def forget_frame(df):
+    _frame_versions.pop(id(df), None)
+
+# Returns the storage backend selected by MODERNDB_STORAGE for a table: "columnar" (default) or "csv".
+def create_storage(name):
+    csv_path = os.path.join(DATA_DIR, f"{name}.csv")
+    if STORAGE_BACKEND == "csv":
+        return CsvStorage(csv_path)
+    columnar = ColumnarStorage(os.path.join(DATA_DIR, f"{name}.store"))
+    columnar.import_legacy_csv(csv_path)
+    return columnar
+
+# --- Tables ----------------------------------------------------------------------------------
+# Every named table has its own store (data/<name>.store, or data/<name>.csv with the CSV
+# backend) and write-ahead log (data/<name>.wal), and its own cached frame, indexes, search index
+# and materialized aggregates. "uploaded" is the table older versions kept everything in.
+# Commands act on the current table of the thread: the session's (see 'use'), the one named by
+# a table-qualified command (sales.list) or by a ?table= parameter. Dataset versions are drawn
+# from one process-wide counter, so caches keyed by version never mix up tables.
+#
+# Open tables live in a process-wide pool, least recently used first. Resident frames are
+# charged their estimated size against TABLE_MEMORY_MB; when a load or write pushes the pool over
+# the budget, the least recently used other tables are evicted: their frame, indexes and
+# aggregate states are dropped and rebuilt from the store on their next use.
+
+class Table:
+    def __init__(self, name):
+        self.name = name
+        self.storage = create_storage(name)
+        self.wal = WriteAheadLog(os.path.join(DATA_DIR, f"{name}.wal")) if self.storage.supports_wal else None
+        self.version = _next_data_version()  # Dataset version of the table's current data
+        self.cache = {"version": None, "signature": None, "df": None, "bytes": 0}
+        self.version_signature = None  # On-disk signature the current version's data was read or written at
+        self.cache_stats = {"hits": 0, "misses": 0}
+        self.wal_stats = {"appends": 0, "replayed": 0, "compactions": 0}
+        self.compaction_event = threading.Event()
+        self.compaction_thread = None
+        self.declared_indexes = set()  # Columns that should have an index (explicit or automatic).
+        self.column_indexes = {}  # column -> ColumnIndex for the version it was built or maintained at.
+        self.column_use = {}  # column -> number of indexable conditions seen, for automatic indexing.
+        self.search_index = {"index": None, "wanted": False, "building": False}
+        self.materialized_views = {}  # name -> {"spec", "state" (AggregateState or None), "reads", "rebuilds"}
+        self.scan_snapshot = None  # ScanSnapshot of the current version for parallel scans
+        self.stored_shape = None  # (signature, rows, columns) cached by table_shape for out-of-core use
+        self.evicted = False  # Dropped by the pool since it was last resident
+        self.evictions = 0
+        self.reloads = 0
+
+    # Drops everything the table holds in memory; the next use reloads it from the store.
+    def evict(self):
+        with _data_lock:
+            self.cache.update(version=None, signature=None, df=None, bytes=0)
+            self.evicted = True
+            self.evictions += 1
+        with _index_lock:
+            self.column_indexes.clear()
+        with _search_index_lock:
+            self.search_index["index"] = None
+        with _view_lock:
+            for view in self.materialized_views.values():
+                view["state"] = None
+        retire_scan_snapshot(self)
+        table_pool_stats["evictions"] += 1
+        count_metric("moderndb_table_evictions_total", table=self.name)
+        metrics.set("moderndb_table_resident_bytes", 0, table=self.name)
+
+TABLE_NAME_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]{0,63}$")
+_table_context = threading.local()  # .table: the Table this thread's commands act on
+_tables_lock = threading.RLock()
+_version_lock = threading.Lock()
+tables = OrderedDict()  # name -> Table, least recently used first
+table_pool_stats = {"evictions": 0, "reloads": 0}
+data_version = 0  # Last dataset version handed out (to any table)
+
+def _next_data_version():
+    global data_version
+    with _version_lock:
+        data_version += 1
+        return data_version
+
+def valid_table_name(name):
+    return bool(TABLE_NAME_RE.match(name))
+
+# Returns the named table, opening it on first use. Raises ValueError for invalid names.
+def get_table(name):
+    if not valid_table_name(name):
+        raise ValueError(f"invalid table name '{name}' (use letters, digits and underscores)")
+    with _tables_lock:
+        table = tables.get(name)
+        if table is None:
+            table = tables[name] = Table(name)
+        return table
+
+# Returns the table the current thread's commands act on (DEFAULT_TABLE if none was chosen).
+def current_table():
+    table = getattr(_table_context, "table", None)
+    return table if table is not None else get_table(DEFAULT_TABLE)
+
+# Makes table the current table of this thread for the enclosed block.
+@contextlib.contextmanager
+def using_table(table):
+    previous = getattr(_table_context, "table", None)
+    _table_context.table = table
+    try:
+        yield table
+    finally:
+        _table_context.table = previous
+
+# Returns the names of the tables stored in DATA_DIR or opened by this process, sorted.
+def list_tables():
+    suffix = ".csv" if STORAGE_BACKEND == "csv" else ".store"
+    try:
+        entries = os.listdir(DATA_DIR)
+    except FileNotFoundError:
+        entries = []
+    names = {entry[:-len(suffix)] for entry in entries if entry.endswith(suffix)}
+    with _tables_lock:
+        names.update(tables)
+    return sorted(name for name in names if valid_table_name(name))
+
+# Estimates a frame's memory: exact for fixed-width and categorical columns, sampled for
+# object columns (deep-measuring every string would cost as much as a scan).
+def estimate_frame_bytes(df):
+    total = int(df.memory_usage(index=False, deep=False).sum())
+    for col in df.columns:
+        series = df[col]
+        if series.dtype == object and len(series):
+            sample = series.iloc[::max(len(series) // 256, 1)]
+            per_row = (sample.memory_usage(index=False, deep=True) - sample.memory_usage(index=False, deep=False)) / len(sample)
+            total += int(per_row * len(series))
+        elif isinstance(series.dtype, pd.CategoricalDtype):
+            total += int(series.cat.categories.memory_usage(deep=True))
+    return total
+
+# Marks table as the most recently used and evicts the least recently used other resident
+# tables while the resident frames exceed the memory budget. Called with the data lock held.
+def _touch_table(table):
+    budget = TABLE_MEMORY_MB * 1024 * 1024
+    with _tables_lock:
+        if tables.get(table.name) is table:
+            tables.move_to_end(table.name)
+        resident = [t for t in tables.values() if t.cache["df"] is not None]
+    used = sum(t.cache["bytes"] for t in resident)
+    for other in resident:
+        if used <= budget:
+            break
+        if other is not table:
+            used -= other.cache["bytes"]
+            other.evict()  # Outside _tables_lock: eviction takes the index and view locks.
+
+# Makes df the cached frame of the current table for its current version.
+def _cache_frame(table, df):
+    table.cache.update(version=table.version, signature=_dataset_signature(), df=df, bytes=estimate_frame_bytes(df))
+    table.version_signature = table.cache["signature"]
+    table.evicted = False
+    metrics.set("moderndb_table_resident_bytes", table.cache["bytes"], table=table.name)
+    _touch_table(table)
+
+# Returns the combined on-disk signature of the current table's store and write-ahead log.
+def _dataset_signature():
+    table = current_table()
+    return (table.storage.signature(), table.wal.signature() if table.wal else None)
+
+# Bumps the current table's dataset version. If a DataFrame is given it becomes the cached copy
+# for the new version (write-through), otherwise the cache is simply dropped.
+def bump_data_version(df=None):
+    table = current_table()
+    with _data_lock:
+        table.version = _next_data_version()
+        retire_scan_snapshot(table)
+        if df is None:
+            table.cache.update(version=None, signature=None, df=None, bytes=0)
+            table.version_signature = None
+        else:
+            if not isinstance(df.index, pd.RangeIndex):
+                df = df.reset_index(drop=True)  # Match what a fresh read of the file would return.
+            _cache_frame(table, df)
+            _register_frame(df, table.version)
+        return table.version
+
+# Reads the current table's base store and replays any write-ahead log records not yet
+# compacted into it.
+@instrumented("read_dataset")
+def _read_dataset():
+    table = current_table()
+    if table.wal is None:
+        return _compact_base(table.storage.read())
+    df, checkpoint_seq = table.storage.read_checkpoint()
+    df = _compact_base(df, checkpoint_seq)
+    table.wal.sync_seq(checkpoint_seq)
+    records = table.wal.read_records(after_seq=checkpoint_seq)
+    for record in records:
+        df = apply_wal_record(df, record)
+    table.wal_stats["replayed"] += len(records)
+    _schedule_compaction()
+    return df
+
+# Runs optimize_dtypes over a base store whose dtypes weren't chosen by it yet (a fresh upload,
+# a store written by an older version, a CSV file replaced outside the app) and persists the
+# result, so later loads read the compact dtypes straight from the store. It runs before the
+# write-ahead log is replayed; replay widens a column or adds categories where a logged value
+# doesn't fit the compact dtype.
+def _compact_base(df, checkpoint_seq=0):
+    storage = current_table().storage
+    if not COMPACT_DTYPES or df.empty or storage.is_compact():
+        return df
+    with timed("compact_dtypes"):
+        df, changed = optimize_dtypes(df)
+        if not changed:
+            storage.mark_compact(df)
+        elif not storage.supports_wal:
+            df = storage.write(df)
+        else:
+            df = storage.write(df, wal_seq=checkpoint_seq)
+    if changed:
+        app.logger.info("Stored compact dtypes: %s", ", ".join(f"{col} {dtype}" for col, dtype in changed.items()))
+    return df
+
+# Loads the current table, serving it from the in-memory cache when the version and file signature
+# still match. Callers get their own copy unless they pass copy=False and promise not to mutate the result.
+@instrumented("load_data")
+def load_data(copy=True):
+    table = current_table()
+    with _data_lock:
+        signature = _dataset_signature()
+        cache = table.cache
+        if cache["df"] is not None and cache["version"] == table.version and cache["signature"] == signature:
+            table.cache_stats["hits"] += 1
+            df = cache["df"]
+            _touch_table(table)
+        else:
+            table.cache_stats["misses"] += 1
+            if table.evicted:
+                table.evicted = False
+                table.reloads += 1
+                table_pool_stats["reloads"] += 1
+                count_metric("moderndb_table_reloads_total", table=table.name)
+            df = _read_dataset()
+            # Replay may have trimmed a torn log tail, so the signature is taken after reading.
+            # If the files changed since the current version was read or written (replaced
+            # outside the app), the data gets a new version so caches keyed by it (sort orders,
+            # rendered fragments, AI schema summaries) don't serve the old rows.
+            if table.version_signature is not None and table.version_signature != _dataset_signature():
+                table.version = _next_data_version()
+                retire_scan_snapshot(table)
+            _cache_frame(table, df)
+            invalidate_indexes()  # The data may have changed on disk.
+        if copy:
+            df = df.copy()
+        _register_frame(df, table.version)
+    return df
+
+# Returns a snapshot of the current table's cache counters.
+def get_cache_stats():
+    table = current_table()
+    with _data_lock:
+        return {
+            "table": table.name,
+            "version": table.version,
+            "backend": table.storage.name,
+            "cached": table.cache["df"] is not None,
+            "hits": table.cache_stats["hits"],
+            "misses": table.cache_stats["misses"],
+            "wal_bytes": table.wal.size() if table.wal else None,
+            **table.wal_stats,
+        }
+
+# Returns one row per table for the 'tables' command: whether it is resident, its rows and
+# estimated memory if so, and how often the pool evicted and reloaded it.
+def describe_tables():
+    names = list_tables()
+    with _data_lock, _tables_lock:
+        lru = list(tables)
+        rows = []
+        for name in names:
+            table = tables.get(name)
+            df = table.cache["df"] if table is not None else None
+            state = (f"resident, {len(df)} rows, {_format_bytes(table.cache['bytes'])}" if df is not None
+                     else "evicted" if table is not None and table.evicted else "not loaded")
+            if table is not None:
+                state += f", LRU rank {len(lru) - lru.index(name)}, evictions {table.evictions}, reloads {table.reloads}"
+            rows.append((name, state))
+        used = sum(t.cache["bytes"] for t in tables.values() if t.cache["df"] is not None)
+    return rows, used
+
+# Saves the DataFrame through the current table's storage backend, replacing the whole store.
+# The saved DataFrame becomes the cached copy, so it must not be mutated afterwards.
+@instrumented("save_data")
+def save_data(df):
+    _flush_pending_mutations()  # Mutations queued earlier in the same group land first.
+    table = current_table()
+    with _data_lock:
+        if table.wal is None:
+            df = table.storage.write(df)
+        else:
+            # The new base supersedes every logged mutation: record the log position in it
+            # first, then drop the log (a crash in between just leaves records replay skips).
+            seq = table.wal.sync_seq(table.storage.checkpoint_seq())
+            df = table.storage.write(df, wal_seq=seq)
+            table.wal.discard_through(seq)
+        bump_data_version(df)
+        invalidate_indexes()
+
+# Publishes a dataset streamed through a storage writer (see ingest_csv), replacing the whole
+# store like save_data. The new data isn't held in memory, so the cache is simply dropped and
+# the next load maps the new generation.
+def commit_writer(writer):
+    _flush_pending_mutations()
+    table = current_table()
+    with _data_lock:
+        if table.wal is None:
+            writer.commit()
+        else:
+            seq = table.wal.sync_seq(table.storage.checkpoint_seq())
+            writer.commit(wal_seq=seq)
+            table.wal.discard_through(seq)
+        bump_data_version()
+        invalidate_indexes()
+
+# Persists a single mutation. With the columnar backend the record is appended to the
+# write-ahead log, so the cost depends on the size of the change rather than the table;
+# otherwise the whole DataFrame is saved. df is the already-mutated frame, which becomes
+# the cached copy and must not be mutated afterwards. Inside the dataset writer the mutation
+# is only queued and persisted with the rest of its group.
+def log_mutation(df, record):
+    count_metric("moderndb_rows_mutated_total", len(record["rows"]) if record["op"] == "append" else len(record["positions"]),
+                 op=record["op"])
+    pending = getattr(_writer_context, "pending", None)
+    if pending is not None:
+        pending.append((df, record))
+        return
+    _commit_mutations([(df, record)])
+
+# Persists a list of (frame after the mutation, record) pairs with one write: a single WAL
+# append and fsync, or a single rewrite of the store without a WAL. Each record still gets
+# its own dataset version so indexes can be carried forward record by record.
+@instrumented("commit")
+def _commit_mutations(mutations):
+    table = current_table()
+    with _data_lock:
+        if table.wal is None:
+            save_data(mutations[-1][0])
+            return
+        table.wal.sync_seq(table.storage.checkpoint_seq())
+        table.wal.append_many([record for _, record in mutations])
+        table.wal_stats["appends"] += len(mutations)
+        for df, record in mutations:
+            old_version = table.version
+            bump_data_version(df)
+            with timed("maintain_indexes"):
+                maintain_indexes(table.cache["df"], record, old_version, table.version)
+                maintain_search_index(table.cache["df"], record, old_version, table.version)
+                maintain_materialized_views(table.cache["df"], record, old_version, table.version)
+    _schedule_compaction()
+
+# Wakes the current table's background compactor if its write-ahead log has outgrown
+# WAL_COMPACT_BYTES.
+def _schedule_compaction():
+    table = current_table()
+    if table.wal is None or table.wal.size() < WAL_COMPACT_BYTES:
+        return
+    with _data_lock:
+        if table.compaction_thread is None or not table.compaction_thread.is_alive():
+            table.compaction_thread = threading.Thread(target=_compaction_worker, args=(table,),
+                                                       name=f"wal-compactor-{table.name}", daemon=True)
+            table.compaction_thread.start()
+    table.compaction_event.set()
+
+def _compaction_worker(table):
+    while True:
+        table.compaction_event.wait()
+        table.compaction_event.clear()
+        try:
+            with using_table(table):
+                compact_wal()
+        except Exception:
+            app.logger.exception("Write-ahead log compaction of table %s failed", table.name)
+
+# Folds the current table's write-ahead log into a new base generation. The generation is
+# written outside the data lock so mutations keep flowing; it is only published if no full save
+# replaced the store in the meantime, and only then is the folded part of the log dropped.
+# Out-of-core tables are streamed into the new generation on the dataset writer instead.
+def compact_wal():
+    table = current_table()
+    if is_out_of_core(table):
+        return dataset_writer.submit(_compact_streamed, with_frame=False)
+    storage, wal = table.storage, table.wal
+    with _data_lock:
+        df = load_data(copy=False)
+        seq = wal.last_seq
+        base_signature = storage.signature()
+        if seq is None or seq <= storage.checkpoint_seq():
+            return False
+    generation, _ = storage.prepare_generation(df, wal_seq=seq)
+    with _data_lock:
+        if storage.signature() != base_signature:
+            storage.discard_generation(generation)
+            return False
+        cache_current = table.cache["signature"] == _dataset_signature()
+        version_current = table.version_signature == _dataset_signature()
+        storage.publish_generation(generation)
+        wal.discard_through(seq)
+        if cache_current:
+            table.cache["signature"] = _dataset_signature()  # Same data, just re-laid out on disk.
+        if version_current:
+            table.version_signature = _dataset_signature()
+        table.wal_stats["compactions"] += 1
+    return True
+
+# --- Dataset writer ---------------------------------------------------------------------------
+# Every change to the dataset goes through one background writer thread, so concurrent requests
+# can't interleave load -> mutate -> save and lose each other's writes. Jobs are applied in
+# arrival order, each to a fresh copy of the frame left by the previous one. Whatever queued up
+# while the previous group was being persisted is committed together (group commit): one WAL
+# fsync, or one atomic rewrite of the store without a WAL, and only then are the callers woken.
+# Jobs run against the table that was current when they were submitted; a group spanning several
+# tables is committed as one sub-group per run of consecutive jobs on the same table.
+
+GROUP_COMMIT_MAX = int(os.environ.get("MODERNDB_GROUP_COMMIT_MAX", 64))  # Jobs persisted per write at most
+GROUP_COMMIT_WAIT_MS = float(os.environ.get("MODERNDB_GROUP_COMMIT_WAIT_MS", 0))  # Extra wait for more jobs to join a group
+_writer_context = threading.local()  # .pending: mutations queued by the job being run by the writer
+writer_stats = {"jobs": 0, "groups": 0, "largest_group": 0}
+
+# Commits the mutations queued so far in the current writer group, so a full save that follows
+# them can't be overtaken by them. No-op outside the writer.
+def _flush_pending_mutations():
+    pending = getattr(_writer_context, "pending", None)
+    if pending:
+        mutations = list(pending)
+        del pending[:]
+        _commit_mutations(mutations)
+
+class DatasetWriter:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # Runs fn(df) on the writer thread with a private copy of the current table's latest data (or
+    # fn() if with_frame is False, for jobs that replace the whole table) and returns its result
+    # once the mutations it logged are durable. Exceptions raised by fn are re-raised here.
+    def submit(self, fn, with_frame=True):
+        if getattr(_writer_context, "pending", None) is not None:
+            return fn(load_data()) if with_frame else fn()  # Already on the writer thread.
+        job = {"fn": fn, "with_frame": with_frame, "done": threading.Event(), "result": None, "error": None,
+               "table": current_table(),
+               "collectors": getattr(_profile_context, "collectors", None)}  # Profiles following the job
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="dataset-writer", daemon=True)
+                self._thread.start()
+        self._queue.put(job)
+        job["done"].wait()
+        if job["error"] is not None:
+            raise job["error"]
+        return job["result"]
+
+    def _run(self):
+        while True:
+            jobs = [self._queue.get()]
+            deadline = time.time() + GROUP_COMMIT_WAIT_MS / 1000
+            while len(jobs) < GROUP_COMMIT_MAX:
+                try:
+                    jobs.append(self._queue.get(timeout=max(deadline - time.time(), 0)) if GROUP_COMMIT_WAIT_MS
+                                else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            start = 0
+            for end in range(1, len(jobs) + 1):
+                if end == len(jobs) or jobs[end]["table"] is not jobs[start]["table"]:
+                    with using_table(jobs[start]["table"]):
+                        self._run_group(jobs[start:end])
+                    start = end
+
+    def _run_group(self, jobs):
+        pending = _writer_context.pending = []
+        try:
+            for job in jobs:
+                queued = len(pending)
+                _profile_context.collectors = job["collectors"]
+                try:
+                    if not job["with_frame"]:
+                        job["result"] = job["fn"]()
+                        continue
+                    # Each job gets its own copy: a job that fails halfway must not leave a
+                    # half-mutated frame behind for the next one. Until the group is committed,
+                    # frames after a queued mutation have no dataset version (so no indexes).
+                    df = pending[-1][0].copy() if pending else load_data()
+                    job["result"] = job["fn"](df)
+                except Exception as e:
+                    del pending[queued:]
+                    job["error"] = e
+            _writer_context.pending = None
+            # The group's commit is part of every profiled job in it.
+            _profile_context.collectors = [p for job in jobs for p in job["collectors"] or ()]
+            if pending:
+                _commit_mutations(pending)
+        except Exception as e:
+            # Nothing of this group may be reported as done: drop the cached frame (it may be
+            # ahead of the disk) and fail every job that hadn't already failed on its own.
+            app.logger.exception("Dataset writer failed to commit a group")
+            bump_data_version()
+            invalidate_indexes()
+            for job in jobs:
+                if job["error"] is None:
+                    job["error"] = e
+        finally:
+            _writer_context.pending = None
+            _profile_context.collectors = None
+            writer_stats["jobs"] += len(jobs)
+            writer_stats["groups"] += 1
+            writer_stats["largest_group"] = max(writer_stats["largest_group"], len(jobs))
+            for job in jobs:
+                job["done"].set()
+
+dataset_writer = DatasetWriter()
+
+# --- Terminal history ---------------------------------------------------------------------------
+# Terminal output is kept in a dedicated store rather than the Flask session: a per-session ring
+# buffer of structured entries, capped by entry count and bytes. Messages are stored as their
+# (short) HTML; query results are stored as a TableResult entry (a reference to the query and
+# dataset version plus the few preview cells shown) and only rendered when the page displays them.
+# The session itself just holds the history id.
+
+HISTORY_STORE = os.environ.get("MODERNDB_HISTORY_STORE", "memory").lower()  # "memory" or "sqlite"
+HISTORY_PATH = os.path.join(os.path.dirname(DATA_PATH), "history.sqlite3")  # SQLite history file
+HISTORY_MAX_ENTRIES = int(os.environ.get("MODERNDB_HISTORY_MAX_ENTRIES", 50))  # Entries kept per session
+HISTORY_MAX_BYTES = int(os.environ.get("MODERNDB_HISTORY_MAX_BYTES", 256 * 1024))  # Bytes kept per session
+HISTORY_MAX_SESSIONS = int(os.environ.get("MODERNDB_HISTORY_MAX_SESSIONS", 1000))  # Sessions kept in memory
+
+# Result of a query command (list, search, search_exact). Holds the columns, total row count and
+# the preview rows a table shows (first and last 5 of larger results) as strings, plus the query
+# and dataset version it came from. Results built from a frame format their rows only when they
+# are rendered or stored in the history. str() renders it as an HTML table, so it can be used
+# wherever a command's message is expected.
+class TableResult:
+    PREVIEW_ROWS = 5
+
+    def __init__(self, columns, total, rows, query=None, version=None, frame=None, limit=None):
+        self.columns = columns
+        self.total = total
+        self._rows = rows
+        self.query = query
+        self.version = version
+        self.frame = frame  # The shown rows, for results built from a frame (not kept in the history)
+        self.limit = limit  # Set when the first limit rows are shown instead of the preview (JSON clients only)
+
+    @classmethod
+    def from_frame(cls, df, query=None, version=None, limit=None):
+        n = len(df)
+        if limit is not None:
+            shown = df.iloc[:limit]
+        else:
+            shown = df if n <= 2 * cls.PREVIEW_ROWS else df.iloc[np.r_[0:cls.PREVIEW_ROWS, n - cls.PREVIEW_ROWS:n]]
+        return cls([str(col) for col in df.columns], n, None, query, version, shown, limit)
+
+    # The shown rows as lists of strings, formatted when first needed (JSON clients read frame).
+    @property
+    def rows(self):
+        if self._rows is None:
+            self._rows = _format_rows(self.frame)
+        return self._rows
+
+    # Whether the rows are the preview (first and last PREVIEW_ROWS) of a larger result.
+    def is_preview(self):
+        return self.limit is None and self.total > len(self.frame if self.frame is not None else self._rows)
+
+    # The shown rows as JSON values (numbers stay numbers, dates are ISO strings).
+    def json_rows(self):
+        if self.frame is None:
+            return self._rows
+        return json.loads(self.frame.to_json(orient="values", date_format="iso", double_precision=15,
+                                             default_handler=str)) if len(self.frame) else []
+
+    def to_entry(self):
+        return {"kind": "table", "columns": self.columns, "total": self.total, "rows": self.rows,
+                "query": self.query, "version": self.version}
+
+    @classmethod
+    def from_entry(cls, entry):
+        return cls(entry["columns"], entry["total"], entry["rows"], entry.get("query"), entry.get("version"))
+
+    def __str__(self):
+        return render_table_result(self)
+
+@instrumented("format_result")
+def _format_rows(frame):
+    cells = [frame.iloc[:, i].astype(str).tolist() for i in range(frame.shape[1])]
+    return [list(row) for row in zip(*cells)]
+
+# Converts a message or TableResult to a history entry.
+def make_history_entry(msg):
+    if isinstance(msg, TableResult):
+        return msg.to_entry()
+    return {"kind": "text", "html": str(msg)}
+
+# Renders one history entry as terminal HTML.
+def render_history_entry(entry):
+    if entry["kind"] == "table":
+        return str(TableResult.from_entry(entry))
+    return entry["html"]
+
+# In-memory history: an ordered map of session id -> ring buffer, least recently used
+# sessions dropped past HISTORY_MAX_SESSIONS. Lost on restart.
+class MemoryHistoryStore:
+    name = "memory"
+
+    def __init__(self, max_entries, max_bytes, max_sessions):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_sessions = max_sessions
+        self._buffers = OrderedDict()  # session id -> [deque of (entry, size), total bytes]
+        self._lock = threading.Lock()
+
+    def append(self, history_id, entry):
+        size = len(json.dumps(entry))
+        with self._lock:
+            buffer = self._buffers.get(history_id)
+            if buffer is None:
+                buffer = self._buffers[history_id] = [deque(), 0]
+                if len(self._buffers) > self.max_sessions:
+                    self._buffers.popitem(last=False)
+            self._buffers.move_to_end(history_id)
+            entries = buffer[0]
+            entries.append((entry, size))
+            buffer[1] += size
+            while len(entries) > self.max_entries or (buffer[1] > self.max_bytes and len(entries) > 1):
+                buffer[1] -= entries.popleft()[1]
+
+    def entries(self, history_id):
+        with self._lock:
+            buffer = self._buffers.get(history_id)
+            return [entry for entry, _ in buffer[0]] if buffer else []
+
+    def clear(self, history_id):
+        with self._lock:
+            self._buffers.pop(history_id, None)
+
+# SQLite history: entries survive restarts and are shared by every worker process on the host.
+# Each append trims the session's oldest entries past the entry and byte caps.
+class SqliteHistoryStore:
+    name = "sqlite"
+
+    def __init__(self, path, max_entries, max_bytes):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # History is not worth an fsync per command.
+            conn.execute("CREATE TABLE IF NOT EXISTS history (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "session_id TEXT NOT NULL, size INTEGER NOT NULL, entry TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS history_session ON history (session_id, seq)")
+            self._conn = conn
+        return self._conn
+
+    def append(self, history_id, entry):
+        data = json.dumps(entry)
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN")
+            try:
+                conn.execute("INSERT INTO history (session_id, size, entry) VALUES (?, ?, ?)", (history_id, len(data), data))
+                # Newest first, keep entries while both running totals are within the caps (always keep the newest).
+                conn.execute(
+                    "DELETE FROM history WHERE session_id = ? AND seq IN ("
+                    " SELECT seq FROM (SELECT seq, ROW_NUMBER() OVER w AS n, SUM(size) OVER w AS bytes"
+                    "  FROM history WHERE session_id = ? WINDOW w AS (ORDER BY seq DESC))"
+                    " WHERE n > 1 AND (n > ? OR bytes > ?))",
+                    (history_id, history_id, self.max_entries, self.max_bytes))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def entries(self, history_id):
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT entry FROM history WHERE session_id = ? ORDER BY seq", (history_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def clear(self, history_id):
+        with self._lock:
+            self._connection().execute("DELETE FROM history WHERE session_id = ?", (history_id,))
+
+# Returns the history store selected by MODERNDB_HISTORY_STORE.
+def create_history_store():
+    if HISTORY_STORE == "sqlite":
+        return SqliteHistoryStore(HISTORY_PATH, HISTORY_MAX_ENTRIES, HISTORY_MAX_BYTES)
+    return MemoryHistoryStore(HISTORY_MAX_ENTRIES, HISTORY_MAX_BYTES, HISTORY_MAX_SESSIONS)
+
+terminal_history = create_history_store()
+
+# Returns this session's history id, assigning one on first use.
+def get_history_id():
+    history_id = session.get("history_id")
+    if history_id is None:
+        history_id = session["history_id"] = uuid.uuid4().hex
+    return history_id
+
+# Renders the terminal output for the current session from its history entries.
+def get_terminal_output():
+    return "<br>".join(render_history_entry(entry) for entry in terminal_history.entries(get_history_id()))
+
+# Appends a message (HTML string) or TableResult to the current session's terminal history.
+def append_terminal_output(msg):
+    terminal_history.append(get_history_id(), make_history_entry(msg))
+
+# Clears the current session's terminal history.
+def clear_terminal_output():
+    terminal_history.clear(get_history_id())
+
+# Retrieves AI configuration (URL, API key, and model).
+def get_ai_config():
+    # API URL: Env -> Session -> App Default
+    ai_url = os.environ.get("OPENROUTER_API_URL")
+    if not ai_url:
+        ai_url = session.get("api_url")
+    if not ai_url:
+        ai_url = DEFAULT_AI_URL  # Fallback to app default
+    
+    # API Key: Env only - no longer store in session for security
+    api_key = os.environ.get("OPENROUTER_API_KEY", "")
+    if not api_key:
+        api_key = DEFAULT_API_KEY  # Fallback to app default (empty string)
+        
+    # AI Model: Env -> Session -> App Default
+    ai_model = os.environ.get("AI_MODEL")
+    if not ai_model:
+        ai_model = session.get("ai_model")
+    if not ai_model:
+        ai_model = DEFAULT_AI_MODEL  # Fallback to app default
+
+    return ai_url, api_key, ai_model
+
+# Error handler for 413 Request Entity Too Large (file upload exceeds limit).
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    append_terminal_output(f"<div class='text-error'>Upload failed: File is larger than {limit_mb}MB.</div>")
+    return redirect(url_for("index"))
+
+# Route for the main page. Loads data and renders the index.html template.
+@app.route("/", methods=["GET"])
+def index():
+    table = current_table()
+    if is_out_of_core(table):
+        total_rows, columns = table_shape(table)
+    else:
+        df = load_data(copy=False)
+        total_rows, columns = len(df), [str(col) for col in df.columns]
+    with timed("render_history"):
+        terminal_output = get_terminal_output()
+    _, current_api_key, _ = get_ai_config()  # Get current API key status
+    api_key_configured = bool(session.get("api_key") or os.environ.get("OPENROUTER_API_KEY") or DEFAULT_API_KEY)
+
+    with timed("render_page"):
+        return render_template(
+            "index.html",
+            table_name=table.name,             # Table the session is using
+            total_rows=total_rows,             # Row count; the table fetches pages from /api/rows as it scrolls
+            columns=columns,                   # Column names for the table
+            page_size=PAGE_SIZE_DEFAULT,       # Rows per page fetched by the table
+            pending_ai_jobs=pending_ai_jobs(), # AI jobs the page polls until they finish
+            ai_stream=AI_STREAM,               # Whether the AI bar streams answers from /ai_stream
+            terminal_output=terminal_output,   # Output for the terminal display
+            api_key_configured=api_key_configured  # Pass this to the template
+        )
+
+PAGE_SIZE_DEFAULT = 100  # Rows per /api/rows page unless ?limit= is given
+PAGE_SIZE_MAX = 1000
+SORT_ORDER_CACHE_SIZE = 8  # Sort orders kept for keyset pagination (per dataset version and column)
+_sort_order_cache = OrderedDict()
+_sort_order_lock = threading.Lock()
+
+# Returns comparable sort keys for a column: floats for numbers and bools, int64 nanoseconds
+# (UTC) for datetimes and strings for everything else. Values at null positions are unused.
+def _sort_keys(series):
+    dtype = series.dtype
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            series = series.dt.tz_convert("UTC").dt.tz_localize(None)
+        return series.to_numpy(dtype="datetime64[ns]").view(np.int64)
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_numeric_dtype(dtype):
+        return series.to_numpy(dtype=np.float64, na_value=np.nan)
+    return series.astype(str).to_numpy(dtype=object)
+
+# Converts a keyset cursor value sent by a client to the key type _sort_keys uses for dtype.
+def _coerce_sort_key(value, dtype):
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        stamp = pd.Timestamp(value)
+        if stamp.tzinfo is not None:
+            stamp = stamp.tz_convert("UTC").tz_localize(None)
+        return stamp.value
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_numeric_dtype(dtype):
+        return float(value)
+    return str(value)
+
+# Returns (sorted keys, their row positions, null positions) for a column. Ties keep row order
+# and nulls sort last. Orders of known dataset versions are cached.
+def sort_order(df, column):
+    version = frame_version(df)
+    key = (version, column)
+    if version is not None:
+        with _sort_order_lock:
+            if key in _sort_order_cache:
+                _sort_order_cache.move_to_end(key)
+                return _sort_order_cache[key]
+    series = df[column]
+    null = series.isna().to_numpy()
+    valid = np.flatnonzero(~null)
+    keys = _sort_keys(series)[valid]
+    order = np.argsort(keys, kind="stable")
+    result = (keys[order], valid[order], np.flatnonzero(null))
+    if version is not None:
+        with _sort_order_lock:
+            _sort_order_cache[key] = result
+            if len(_sort_order_cache) > SORT_ORDER_CACHE_SIZE:
+                _sort_order_cache.popitem(last=False)
+    return result
+
+# Returns the index in the (asc or desc) sort order of the first row after the keyset cursor
+# (after, after_row): the sort value and position of the last row the client has seen.
+# Descending order is the ascending order of non-null values reversed, nulls still last.
+def _keyset_start(keys, positions, nulls, after, after_row, descending):
+    if after is None:
+        return len(positions) + int(np.searchsorted(nulls, after_row, side="right"))
+    lo = int(np.searchsorted(keys, after, side="left"))
+    hi = int(np.searchsorted(keys, after, side="right"))
+    ties = positions[lo:hi]  # Row positions with the cursor's value, ascending.
+    if not descending:
+        return lo + int(np.searchsorted(ties, after_row, side="right"))
+    return (len(positions) - hi) + (len(ties) - int(np.searchsorted(ties, after_row, side="left")))
+
+# JSON page endpoint for the data table and API clients. Query parameters:
+#   limit            - rows per page (default PAGE_SIZE_DEFAULT, at most PAGE_SIZE_MAX)
+#   offset           - offset pagination: index of the first row
+#   after_row, after - keyset pagination: row id and sort value of the last row seen, as
+#                      returned in "next" (after is JSON-encoded, only used with order_by)
+#   order_by, desc   - sort column and direction (nulls last)
+#   columns          - comma-separated column projection
+@app.route("/api/rows")
+def api_rows():
+    table = current_table()
+    streamed = is_out_of_core(table)  # Out-of-core tables are read page by page; no sorting.
+    df = None if streamed else load_data(copy=False)
+    version = None if streamed else frame_version(df)
+    n, all_columns = table_shape(table) if streamed else (len(df), list(df.columns))
+    try:
+        limit = min(max(int(request.args.get("limit", PAGE_SIZE_DEFAULT)), 1), PAGE_SIZE_MAX)
+        offset = max(int(request.args.get("offset", 0)), 0)
+        after_row = request.args.get("after_row")
+        after_row = int(after_row) if after_row is not None else None
+    except ValueError:
+        return {"error": "limit, offset and after_row must be integers"}, 400
+    columns = [c.strip() for c in request.args.get("columns", "").split(",") if c.strip()] or all_columns
+    order_by = request.args.get("order_by")
+    descending = request.args.get("desc", "").lower() in TRUE_STRINGS
+    for col in columns + ([order_by] if order_by else []):
+        if col not in all_columns:
+            return {"error": f"Column '{col}' does not exist."}, 400
+    if streamed and order_by:
+        return {"error": "order_by isn't supported on out-of-core tables."}, 400
+
+    if order_by:
+        keys, positions, nulls = sort_order(df, order_by)
+        if after_row is not None:
+            try:
+                after = json.loads(request.args.get("after", "null"))
+                after = None if after is None else _coerce_sort_key(after, df[order_by].dtype)
+            except ValueError:
+                return {"error": "after must be a JSON value matching the order_by column"}, 400
+            offset = _keyset_start(keys, positions, nulls, after, after_row, descending)
+        ordered = positions[::-1] if descending else positions
+        page = np.concatenate([ordered, nulls])[offset:offset + limit] if offset < n else np.empty(0, dtype=np.int64)
+    else:
+        if after_row is not None:
+            offset = after_row + 1  # Rows are kept in insertion order, so row ids are positions.
+        page = np.arange(min(offset, n), min(offset + limit, n))
+
+    if streamed:
+        version, frame = read_streamed_rows(offset, len(page))
+        page = page[:len(frame)]
+        frame = frame[columns] if len(frame) else frame
+    else:
+        frame = df.iloc[page, [df.columns.get_loc(c) for c in columns]]
+    rows = json.loads(frame.to_json(orient="values", date_format="iso", double_precision=15, default_handler=str)) if len(page) else []
+    next_cursor = None
+    if offset + len(page) < n and len(page):
+        next_cursor = {"after_row": int(page[-1])}
+        if order_by:
+            last = df[order_by].iloc[int(page[-1])]
+            if pd.isna(last):
+                last = None
+            elif isinstance(last, pd.Timestamp):
+                last = last.isoformat()
+            elif isinstance(last, np.generic):
+                last = last.item()  # Full precision, unlike to_json.
+            next_cursor["after"] = json.dumps(last, default=str)
+    return {"version": version, "total": n, "offset": offset, "columns": [str(c) for c in columns],
+            "row_ids": page.tolist(), "rows": rows, "next": next_cursor}
+
+# JSON aggregate for dashboards: ?view=<materialized aggregate name> or ?q=<aggregate arguments>,
+# e.g. q=count sum(price) by city. Materialized aggregates are served from their maintained result.
+@app.route("/api/aggregate")
+def api_aggregate():
+    df = load_data(copy=False)
+    version = frame_version(df)
+    name = request.args.get("view")
+    try:
+        if name is not None:
+            with _view_lock:
+                view = current_table().materialized_views.get(name)
+            if view is None:
+                return {"error": f"No materialized aggregate named '{name}'"}, 404
+            spec = view["spec"]
+        else:
+            spec = parse_aggregate(shlex.split(request.args.get("q", "")))
+        validate_aggregate(spec, df)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    result = aggregate(df, spec)
+    rows = json.loads(result.to_json(orient="values", double_precision=15, default_handler=str)) if len(result) else []
+    return {"version": version, "aggregate": str(spec), "columns": [str(c) for c in result.columns], "rows": rows}
+
+# Progress of the upload being ingested, polled by the page through /upload_progress.
+_ingest_lock = threading.Lock()
+ingest_progress = {"active": False, "rows": 0, "chunks": 0, "seconds": 0.0, "rows_per_sec": 0.0}
+
+# Returns the dtype a column must have once chunks with dtypes current and found are combined,
+# following read_csv's inference on the whole file: int widens to float, anything else to text.
+def _widen_upload_dtype(current, found):
+    if current == found or current == object:
+        return current
+    if pd.api.types.is_numeric_dtype(current) and pd.api.types.is_numeric_dtype(found) \
+            and not pd.api.types.is_bool_dtype(current) and not pd.api.types.is_bool_dtype(found):
+        return np.dtype(np.float64)
+    return np.dtype(object)
+
+# Streams a CSV upload into the storage backend chunk by chunk, so memory use is bounded by
+# UPLOAD_CHUNK_ROWS rather than the file size. Column dtypes are inferred from the first
+# UPLOAD_SAMPLE_ROWS rows and enforced on every chunk; text columns are read as raw strings.
+# If a later chunk doesn't fit (e.g. a decimal in an int column), the remaining chunks are only
+# checked to settle the final dtypes, and the file is ingested again from the start.
+# Returns (rows, columns, seconds).
+@instrumented("ingest")
+def ingest_csv(stream):
+    started = time.time()
+    sample = pd.read_csv(stream, nrows=UPLOAD_SAMPLE_ROWS)
+    if len(sample.columns) == 0:
+        raise ValueError("File has no valid data or no header.")
+    columns = list(sample.columns)
+    dtypes = {col: sample[col].dtype for col in columns}
+    while True:
+        stream.seek(0)
+        text_columns = {col: str for col, dtype in dtypes.items() if dtype == object}
+        writer = current_table().storage.open_writer(columns)
+        settled = True
+        try:
+            for chunk in pd.read_csv(stream, chunksize=UPLOAD_CHUNK_ROWS, dtype=text_columns):
+                for col in columns:
+                    widened = _widen_upload_dtype(dtypes[col], chunk[col].dtype)
+                    if widened != dtypes[col]:
+                        dtypes[col] = widened
+                        settled = False
+                if not settled:
+                    continue  # Keep scanning only to settle the dtypes of every column.
+                writer.append(chunk.astype(dtypes, copy=False))
+                elapsed = time.time() - started
+                ingest_progress.update(rows=writer.rows, chunks=ingest_progress["chunks"] + 1, seconds=elapsed,
+                                       rows_per_sec=writer.rows / elapsed if elapsed else 0.0)
+            if settled:
+                if writer.rows == 0:
+                    raise ValueError("File has no valid data or no header.")
+                dataset_writer.submit(lambda: commit_writer(writer), with_frame=False)
+                if COMPACT_DTYPES and not is_out_of_core(current_table()):
+                    load_data(copy=False)  # Choose and store compact dtypes now rather than on the first read.
+                return writer.rows, len(columns), time.time() - started
+        except Exception:
+            writer.abort()
+            raise
+        writer.abort()
+        app.logger.info("Upload dtypes widened after sampling, ingesting again: %s", dtypes)
+        ingest_progress.update(rows=0, chunks=0)
+
+# Route for handling file uploads.
+@app.route("/upload", methods=["POST"])
+def upload():
+    file = request.files["file"]
+    if file:
+        # Check if the file has a .csv extension
+        if not file.filename.lower().endswith('.csv'):
+            append_terminal_output("<div class='text-error'>Upload failed: Only CSV files are allowed.</div>")
+            return redirect(url_for("index"))
+
+        if not _ingest_lock.acquire(blocking=False):
+            append_terminal_output("<span style='color:red;'>Upload failed: Another upload is still being ingested.</span>")
+            return redirect(url_for("index"))
+        try:
+            ingest_progress.update(active=True, rows=0, chunks=0, seconds=0.0, rows_per_sec=0.0)
+            rows, columns, seconds = ingest_csv(file.stream)
+            rate = rows / seconds if seconds else rows
+            table = current_table()
+            if request.form.get("table"):
+                session["table"] = table.name  # Uploading into a table switches the session to it.
+            append_terminal_output(f"<span style='color:green;'>Data uploaded to table {table.name}. "
+                                   f"Rows: {rows}, Columns: {columns}</span>")
+            append_terminal_output(f"<span style='color:gray;'>Ingested {rows} rows in {ingest_progress['chunks']} chunk(s), "
+                                   f"{seconds:.2f}s ({rate:,.0f} rows/sec)</span>")
+            compact = describe_compact_columns(load_data(copy=False)) if COMPACT_DTYPES and not is_out_of_core(table) else None
+            if compact:
+                append_terminal_output(f"<span style='color:gray;'>{html.escape(compact)}</span>")
+        except pd.errors.EmptyDataError:
+            append_terminal_output("<span style='color:red;'>Upload failed: File has no valid data or no header.</span>")
+        except Exception as e:
+            append_terminal_output(f"<span style='color:red;'>Upload failed: {e}</span>")
+        finally:
+            ingest_progress["active"] = False
+            _ingest_lock.release()
+    else:
+        append_terminal_output("<span style='color:red;'>No file selected.</span>")
+    return redirect(url_for("index"))
+
+# Route reporting the progress of the upload being ingested (rows so far and rows/sec).
+@app.route("/upload_progress")
+def upload_progress():
+    return dict(ingest_progress)
+
+# Export formats: extension, mimetype and whether the stream is gzip-compressed.
+EXPORT_FORMATS = {
+    "csv": (".csv", "text/csv", False),
+    "jsonl": (".jsonl", "application/x-ndjson", False),
+    "csv.gz": (".csv.gz", "application/gzip", True),
+}
+EXPORT_CHUNK_ROWS = int(os.environ.get("MODERNDB_EXPORT_CHUNK_ROWS", 50000))  # Rows encoded per streamed chunk
+_jsonl_encoder = json.JSONEncoder(default=str)
+_JSON_LITERALS = {True: "true", False: "false", None: "null"}  # Encodings of boolean column values
+
+# Yields the selected rows and columns of df encoded chunk by chunk, so only one chunk of
+# output is ever held in memory.
+def generate_export(df, positions, columns, fmt):
+    column_positions = [df.columns.get_loc(c) for c in columns]
+    return encode_export((df.iloc[positions[start:start + EXPORT_CHUNK_ROWS], column_positions]
+                          for start in range(0, max(len(positions), 1), EXPORT_CHUNK_ROWS)), fmt)
+
+# Yields the streamed chunks of an out-of-core table, filtered and projected for export.
+def generate_streamed_export(conditions, columns, fmt):
+    return encode_export((chunk.iloc[_chunk_positions(conditions, chunk)][columns] if conditions else chunk[columns]
+                          for _, chunk in stream_table(EXPORT_CHUNK_ROWS)[1]), fmt)
+
+# Returns a frame's rows as JSON Lines. Floats are written with Python's shortest repr, which reads
+# back as the same value (to_json rounds them); missing and infinite values become null and
+# datetimes ISO 8601 strings. Each column is encoded in one pass, then the rows are assembled.
+def _jsonl_lines(chunk):
+    columns = []
+    for _, col in chunk.items():
+        if pd.api.types.is_datetime64_any_dtype(col.dtype):
+            values = [None if pd.isna(value) else value.isoformat() for value in col]
+        else:
+            missing = col.isna() | col.isin([np.inf, -np.inf])
+            values = col.astype(object).where(~missing, None).tolist()
+        if pd.api.types.is_bool_dtype(col.dtype):
+            columns.append([_JSON_LITERALS[value] for value in values])
+        elif pd.api.types.is_float_dtype(col.dtype) or pd.api.types.is_integer_dtype(col.dtype):
+            columns.append(["null" if value is None else repr(value) for value in values])
+        else:
+            columns.append(list(map(_jsonl_encoder.encode, values)))
+    row = "{{" + ", ".join(json.dumps(str(name)).replace("{", "{{").replace("}", "}}") + ": {}"
+                           for name in chunk.columns) + "}}\n"  # A str.format template
+    return "".join(row.format(*values) for values in zip(*columns))
+
+# Encodes frames one at a time in an export format; only the first CSV chunk gets a header.
+def encode_export(frames, fmt):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if EXPORT_FORMATS[fmt][2] else None  # wbits=31: gzip container
+    for i, chunk in enumerate(frames):
+        if fmt == "jsonl":
+            data = _jsonl_lines(chunk)
+        else:
+            data = chunk.to_csv(index=False, header=i == 0)
+        data = data.encode("utf-8")
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
+
+# Route for exporting data. Optional query parameters:
+#   where   - conditions in the search_exact/delete syntax, e.g. where=age=>30 status=active
+#   columns - comma-separated column projection, e.g. columns=name,email
+#   format  - csv (default), jsonl or csv.gz
+# The export is streamed from the stored dataset, whatever the backend; out-of-core tables are
+# read chunk by chunk.
+@app.route("/export")
+def export():
+    table = current_table()
+    streamed = is_out_of_core(table)
+    df = None if streamed else load_data(copy=False)
+    n, all_columns = table_shape(table) if streamed else (len(df), list(df.columns))
+    if n == 0:
+        return "No data to export", 404
+    fmt = request.args.get("format", "csv").lower()
+    if fmt not in EXPORT_FORMATS:
+        return f"Unknown export format '{fmt}'. Use one of: {', '.join(EXPORT_FORMATS)}", 400
+
+    columns = [c.strip() for c in request.args.get("columns", "").split(",") if c.strip()] or all_columns
+    conditions = {}
+    try:
+        condition_tokens = [t for where in request.args.getlist("where") for t in shlex.split(where)]
+    except ValueError as e:
+        return f"Invalid where clause: {e}", 400
+    for token in condition_tokens:
+        if "=" not in token:
+            return f"Condition '{token}' format is incorrect. Expected 'column=value'.", 400
+        k, v = token.split("=", 1)
+        conditions[k] = v
+    for col in list(conditions) + columns:
+        if col not in all_columns:
+            return f"Column '{col}' does not exist.", 400
+
+    extension, mimetype, _ = EXPORT_FORMATS[fmt]
+    download_name = table.name + extension
+    if streamed:
+        body = generate_streamed_export(conditions, columns, fmt)
+    else:
+        positions = compile_conditions(conditions, df).positions(df) if conditions else np.arange(len(df))
+        body = generate_export(df, positions, columns, fmt)
+    return app.response_class(body, mimetype=mimetype,
+                              headers={"Content-Disposition": f"attachment; filename={download_name}"})
+
+# Route for checking the AI service status.
+@app.route("/check_ai_status", methods=["POST"])
+def check_ai_status():
+    ai_url, api_key, ai_model = get_ai_config()
+    if api_key:  # Check if api_key is not empty
+        append_terminal_output(f"<span style='color:green;'>AI Status: API Key is configured. Using model: {ai_model}. URL: {ai_url}</span>")
+    else:
+        append_terminal_output("<span style='color:red;'>AI Status: API Key is NOT configured. Please set it via the form or environment variable OPENROUTER_API_KEY.</span>")
+    return redirect(url_for("index"))
+
+# --- AI command pipeline --------------------------------------------------------------------------
+# AI requests run as jobs on a bounded thread pool instead of inside the request worker, so a
+# slow model doesn't tie up the web server. /ai_command returns at once with a job id; the page
+# polls /ai_jobs/<id>, which reports the suggested command, then its result, plus per-job
+# timings. All jobs share one keep-alive HTTP session (connection pool) to the AI service.
+
+AI_WORKERS = int(os.environ.get("MODERNDB_AI_WORKERS", 4))  # AI requests in flight at once
+AI_MAX_QUEUED = int(os.environ.get("MODERNDB_AI_MAX_QUEUED", 32))  # Jobs waiting or running before new ones are refused
+AI_TIMEOUT = float(os.environ.get("MODERNDB_AI_TIMEOUT", 30))  # Seconds per AI request
+AI_JOBS_KEPT = 200  # Finished jobs remembered for polling
+ai_executor = concurrent.futures.ThreadPoolExecutor(max_workers=AI_WORKERS, thread_name_prefix="ai-worker")
+ai_http = requests.Session()
+ai_http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=AI_WORKERS))
+ai_http.mount("http://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=AI_WORKERS))
+ai_jobs = OrderedDict()  # job id -> job dict (see submit_ai_job)
+_ai_jobs_lock = threading.Lock()
+
+AI_CACHE_ENABLED = os.environ.get("MODERNDB_AI_CACHE", "on").lower() not in ("off", "false", "0", "no")  # Cache AI answers
+AI_CACHE_PATH = os.path.join(os.path.dirname(DATA_PATH), "ai_cache.sqlite3")  # Persistent AI answer cache
+AI_CACHE_SIZE = int(os.environ.get("MODERNDB_AI_CACHE_SIZE", 1000))  # Cached answers kept (least recently used dropped)
+AI_CACHE_TTL = float(os.environ.get("MODERNDB_AI_CACHE_TTL", 24 * 3600))  # Seconds a cached answer stays valid
+ai_cache_stats = {"hits": 0, "misses": 0, "coalesced": 0, "saved_ms": 0.0}
+_ai_inflight = {}  # cache key -> in-flight upstream call shared by identical requests
+_ai_inflight_lock = threading.Lock()
+
+# Persistent LRU cache of parsed AI commands, in a local SQLite file. An answer depends only on
+# the model, the table schema and the question, so the key is built from those (see
+# ai_cache_key). Entries expire after AI_CACHE_TTL seconds; past AI_CACHE_SIZE entries the least
+# recently used are dropped. Each entry remembers how long the model took, so hits can report
+# the latency they saved.
+class AiCommandCache:
+    def __init__(self, path, max_entries, ttl):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS ai_cache (key TEXT PRIMARY KEY, ai_cmd TEXT NOT NULL, "
+                         "latency_ms REAL NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS ai_cache_last_used ON ai_cache (last_used)")
+            self._conn = conn
+        return self._conn
+
+    # Returns (ai_cmd, latency_ms) for a live entry, or None.
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute("SELECT ai_cmd, latency_ms, created FROM ai_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[2] > self.ttl:
+                conn.execute("DELETE FROM ai_cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE ai_cache SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, ai_cmd, latency_ms):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("INSERT OR REPLACE INTO ai_cache (key, ai_cmd, latency_ms, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                         (key, json.dumps(ai_cmd), latency_ms, now, now))
+            conn.execute("DELETE FROM ai_cache WHERE key IN (SELECT key FROM ai_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                         (self.max_entries,))
+
+    def size(self):
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM ai_cache").fetchone()[0]
+
+ai_cache = AiCommandCache(AI_CACHE_PATH, AI_CACHE_SIZE, AI_CACHE_TTL) if AI_CACHE_ENABLED else None
+
+# Returns the cache key of a question: the AI endpoint and model, a fingerprint of the table
+# schema (column names and dtypes) and the question with whitespace normalized. Case is kept,
+# since it can matter for the values in the answer.
+def ai_cache_key(ai_url, model, df, user_input):
+    schema = [[str(col), str(dtype)] for col, dtype in df.dtypes.items()]
+    question = " ".join(unicodedata.normalize("NFC", user_input).split())
+    return hashlib.sha256(json.dumps([ai_url, model, schema, question]).encode("utf-8")).hexdigest()
+
+# Returns a snapshot of the AI cache counters, with the hit ratio (coalesced requests count as
+# hits: they didn't make their own upstream call).
+def get_ai_cache_stats():
+    stats = dict(ai_cache_stats)
+    lookups = stats["hits"] + stats["coalesced"] + stats["misses"]
+    stats["hit_ratio"] = (stats["hits"] + stats["coalesced"]) / lookups if lookups else None
+    stats["entries"] = ai_cache.size() if ai_cache else 0
+    return stats
+
+# Raised when the AI's answer can't be parsed as a JSON command; content is the raw answer.
+class AiResponseError(Exception):
+    def __init__(self, content, error):
+        super().__init__(str(error))
+        self.content = content
+
+# Calls the AI service and returns its answer parsed as a JSON command.
+@instrumented("ai_http")
+def request_ai_command(request_args):
+    # Make the API call to the AI service.
+    resp = ai_http.post(request_args["url"], json=request_args["json"], headers=request_args["headers"], timeout=AI_TIMEOUT)
+    resp.raise_for_status()  # Raise an exception for HTTP errors.
+    data = resp.json()
+
+    # Extract the AI's response content.
+    if "choices" in data and data["choices"]:
+        content = data["choices"][0]["message"]["content"]
+    elif "message" in data and "content" in data["message"]:  # Some models might use this structure
+        content = data["message"]["content"]
+    else:
+        content = str(data)  # Fallback if structure is unexpected
+
+    try:
+        # Clean up potential markdown formatting from the AI response.
+        if content.strip().startswith("```json"):
+            content = content.strip().removeprefix("```json").removesuffix("```").strip()
+        # Replace 'undefined' with 'null' for better JSON parsing compatibility.
+        content = re.sub(r':\s*undefined', ': null', content)
+        return json.loads(content)  # Parse the JSON command.
+    except Exception as e:
+        raise AiResponseError(content, e)
+
+# Returns (ai_cmd, source) for a job: from the cache ("cache"), from an identical request already
+# in flight ("coalesced") or from the AI service ("model"). Identical concurrent requests share
+# one upstream call (single flight); its answer, or its error, goes to all of them.
+def resolve_ai_command(request_args, key):
+    if ai_cache is None:
+        return request_ai_command(request_args), "model"
+    cached = ai_cache.get(key)
+    if cached is not None:
+        ai_cache_stats["hits"] += 1
+        ai_cache_stats["saved_ms"] += cached[1]
+        return cached[0], "cache"
+    flight, leader = _join_ai_flight(key)
+    if not leader:
+        return _await_ai_flight(flight), "coalesced"
+    ai_cache_stats["misses"] += 1
+    try:
+        started = time.time()
+        ai_cmd = request_ai_command(request_args)
+        _cache_ai_answer(key, flight, ai_cmd, (time.time() - started) * 1000)
+        return ai_cmd, "model"
+    except Exception as e:
+        flight["error"] = e
+        raise
+    finally:
+        _finish_ai_flight(key, flight)
+
+# Returns (flight, leader): the flight of an identical AI request in progress, or a new one the
+# caller leads and must finish with _finish_ai_flight.
+def _join_ai_flight(key):
+    with _ai_inflight_lock:
+        flight = _ai_inflight.get(key)
+        if flight is not None:
+            return flight, False
+        flight = _ai_inflight[key] = {"done": threading.Event(), "ai_cmd": None, "error": None, "latency_ms": 0.0}
+        return flight, True
+
+# Waits for the leader of a flight and returns its command, or raises its error.
+def _await_ai_flight(flight):
+    flight["done"].wait()
+    if flight["error"] is not None:
+        raise flight["error"]
+    ai_cache_stats["coalesced"] += 1
+    ai_cache_stats["saved_ms"] += flight["latency_ms"]
+    return flight["ai_cmd"]
+
+# Hands the leader's answer to its flight and caches it.
+def _cache_ai_answer(key, flight, ai_cmd, latency_ms):
+    flight["ai_cmd"], flight["latency_ms"] = ai_cmd, latency_ms
+    if isinstance(ai_cmd, dict) and ai_cmd.get("operation") not in (None, "error"):
+        ai_cache.put(key, ai_cmd, latency_ms)  # Refusals aren't cached, so a retry asks again.
+
+# Ends a flight and wakes its followers. A leader that stopped without an answer or an error
+# (a streaming client that went away) fails the flight rather than leaving followers without one.
+def _finish_ai_flight(key, flight):
+    if flight["ai_cmd"] is None and flight["error"] is None:
+        flight["error"] = RuntimeError("the identical AI request it was waiting for was cancelled, please retry")
+    with _ai_inflight_lock:
+        _ai_inflight.pop(key, None)
+    flight["done"].set()
+
+AI_SCHEMA_TOKENS = int(os.environ.get("MODERNDB_AI_SCHEMA_TOKENS", 1500))  # Token budget of the table summary in the prompt
+SCHEMA_SAMPLE_ROWS = 2000  # Rows sampled (evenly spaced) for example values and cardinalities
+SCHEMA_EXAMPLES = 3  # Example values shown per column
+_schema_context_cache = OrderedDict()  # (dataset version, budget) -> summary text
+_schema_context_lock = threading.Lock()
+
+# Rough token count of a text (about 4 characters per token for English and identifiers).
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+# Returns a short type name for the prompt.
+def _describe_dtype(dtype):
+    if pd.api.types.is_bool_dtype(dtype):
+        return "boolean"
+    if pd.api.types.is_integer_dtype(dtype):
+        return "integer"
+    if pd.api.types.is_float_dtype(dtype):
+        return "number"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "datetime"
+    if isinstance(dtype, pd.CategoricalDtype):
+        return "category"
+    return "text"
+
+# Builds the table summary for the AI prompt: row and column counts, then per column its type,
+# distinct values and a few examples, estimated from a sample of SCHEMA_SAMPLE_ROWS rows so the
+# cost doesn't grow with the table. Columns are described in full while the budget allows;
+# the rest are listed by name and type, and past the budget only counted.
+def build_schema_context(df, budget_tokens):
+    n_rows, n_cols = len(df), len(df.columns)
+    header = f"Table: {n_rows} rows, {n_cols} columns."
+    if n_cols == 0:
+        return header
+    sample = df.iloc[np.linspace(0, n_rows - 1, min(n_rows, SCHEMA_SAMPLE_ROWS)).astype(np.int64)] if n_rows else df
+    details, compacts = [], []
+    for i, col in enumerate(df.columns):
+        kind = _describe_dtype(df[col].dtype)
+        compacts.append(f"{col} ({kind})")
+        values = pd.unique(sample.iloc[:, i].dropna())
+        if len(sample) == n_rows:
+            distinct = f"{len(values)} distinct"
+        else:
+            distinct = "mostly unique" if len(values) >= 0.9 * len(sample) else f"~{len(values)}+ distinct"
+        examples = ", ".join(json.dumps(str(v)[:30]) if kind == "text" else str(v)[:30] for v in values[:SCHEMA_EXAMPLES])
+        details.append(f"- {col}: {kind}, {distinct}" + (f", e.g. {examples}" if examples else ", all missing"))
+
+    # Start from the compact listing of every column and upgrade columns to their full
+    # description, in table order, while the total stays within the budget.
+    budget = budget_tokens - estimate_tokens(header) - 10
+    costs = [estimate_tokens(c) for c in compacts]
+    total = sum(costs)
+    detailed = 0
+    while detailed < n_cols and total - costs[detailed] + estimate_tokens(details[detailed]) <= budget:
+        total += estimate_tokens(details[detailed]) - costs[detailed]
+        detailed += 1
+    lines = [header] + (["Columns:"] + details[:detailed] if detailed else [])
+    rest = compacts[detailed:]
+    if rest:
+        shown, used = [], 0
+        for entry, cost in zip(rest, costs[detailed:]):
+            if total > budget and used + cost > budget - (total - sum(costs[detailed:])):
+                break
+            shown.append(entry)
+            used += cost
+        lines.append("Other columns: " + ", ".join(shown)
+                     + (f", ... and {len(rest) - len(shown)} more columns" if len(shown) < len(rest) else ""))
+    return "\n".join(lines)
+
+# Returns the table summary for df, cached per dataset version.
+def schema_context(df, budget_tokens=None):
+    budget_tokens = budget_tokens or AI_SCHEMA_TOKENS
+    version = frame_version(df)
+    key = (version, budget_tokens)
+    if version is not None:
+        with _schema_context_lock:
+            text = _schema_context_cache.get(key)
+            if text is not None:
+                _schema_context_cache.move_to_end(key)
+                return text
+    text = build_schema_context(df, budget_tokens)
+    if version is not None:
+        with _schema_context_lock:
+            _schema_context_cache[key] = text
+            if len(_schema_context_cache) > 4:
+                _schema_context_cache.popitem(last=False)
+    return text
+
+# Builds the system prompt describing the table and the supported JSON commands.
+@instrumented("ai_prompt")
+def build_ai_prompt(df):
+    return f"""
+You are a database assistant. The user has uploaded the following data table:
+{schema_context(df)}
+You can understand the following operations and must strictly return commands in JSON format:
+
+- list: List all data. JSON: {{"operation": "list"}}
+
+- add: Add a new row. JSON: {{"operation": "add", "data": {{"column_name1": value1, "column_name2": value2}}}}
+  Note: Missing columns will receive appropriate default values based on their data types.
+
+- add_batch: Add multiple rows at once. Return JSON as:
+  {{"operation": "add_batch", "columns": ["col1", "col2"], "values": [[val1_row1, val2_row1], [val1_row2, val2_row2]]}}
+
+- update: Update rows matching conditions. JSON: 
+  {{"operation": "update", "conditions": {{"condition_column1": "condition_value1"}}, "data": {{"update_column1": "new_value1"}}}}
+  (conditions cannot be empty)
+  
+  Supports advanced comparison operators for numeric columns:
+  - greater than: "column": ">value" 
+  - less than: "column": "<value"
+  - greater/equal: "column": ">=value"
+  - less/equal: "column": "<=value"
+  - not equal: "column": "!=value"
+  
+  Supports pattern matching for string columns:
+  - starts with: "column": "prefix*"
+  - ends with: "column": "*suffix"
+  - contains: "column": "*contains*"
+
+- delete: Delete rows matching conditions. JSON: 
+  {{"operation": "delete", "conditions": {{"condition_column1": "condition_value1", "condition_column2": "condition_value2"}}}}
+  (conditions cannot be empty)
+  
+  Supports the same advanced comparison operators as update.
+  For bulk deletions (>10 rows), add "confirm": true to the JSON.
+
+- search: Fuzzy search all fields. JSON: {{"operation": "search", "keyword": "search_term"}}
+
+- search_exact: Exact search a specific column. JSON: 
+  {{"operation": "search_exact", "column": "column_name", "value": "exact_value"}}
+  
+  Also supports pattern matching like update/delete.
+
+- columns: Show column information. JSON: {{"operation": "columns"}}
+
+Important notes:
+- The 'conditions' object is required in 'update' and 'delete' operations and cannot be an empty object.
+- The 'data' object is required in 'add' and 'update' operations.
+- Value types should match column data types as much as possible. For string values, please use strings.
+- Strictly return only JSON commands. Do not include any other text, explanations, or Markdown tags.
+- For missing/null values, use null or the strings "nan" or "na" (returned as NaN in the database).
+- If the user request is outside the above scope or incorrectly formatted, please return {{"operation": "error", "message": "Only specified command formats are supported."}}.
+"""
+
+# Returns the chat completions request for a question about df (see request_ai_command). With
+# stream, the service streams its answer as server-sent events (see stream_ai_content).
+def build_ai_request(df, user_input, stream=False):
+    ai_url, api_key, model = get_ai_config()
+    return {
+        "url": f"{ai_url}/chat/completions",
+        "json": {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": build_ai_prompt(df)},
+                {"role": "user", "content": user_input}
+            ],
+            "stream": stream
+        },
+        "headers": {"Authorization": f"Bearer {api_key}"},
+    }
+
+# Queues an AI request for the current session and returns the job, or None if the queue is full.
+def submit_ai_job(user_input):
+    ai_url, api_key, model = get_ai_config()
+    df = load_data(copy=False)
+    job = {
+        "id": uuid.uuid4().hex,
+        "history_id": get_history_id(),
+        "table": current_table(),  # The command runs against the table the request was made on
+        "status": "queued",  # queued -> running -> executing -> done (or error)
+        "user_input": user_input,
+        "suggested": None,  # The AI's JSON command
+        "command": None,  # The command, in terminal syntax
+        "result": None,  # HTML of the command's result
+        "output": None,  # The command's result as JSON (see result_json)
+        "error": None,
+        "source": None,  # Where the AI command came from: "model", "cache" or "coalesced"
+        "timings": {"created": time.time()},
+    }
+    cache_key = ai_cache_key(ai_url, model, df, user_input)
+    request_args = build_ai_request(df, user_input)
+    job["timings"]["prompt_built"] = time.time()
+    with _ai_jobs_lock:
+        active = sum(1 for j in ai_jobs.values() if j["status"] not in ("done", "error"))
+        if active >= AI_MAX_QUEUED:
+            return None
+        ai_jobs[job["id"]] = job
+        while len(ai_jobs) > AI_JOBS_KEPT + active:
+            oldest = next(iter(ai_jobs))
+            if ai_jobs[oldest]["status"] not in ("done", "error"):
+                break
+            ai_jobs.popitem(last=False)
+    ai_executor.submit(run_ai_job, job, request_args, cache_key)
+    return job
+
+# Runs one AI job on a pool thread: gets the AI command (cached, coalesced or from the model),
+# converts it to a Command and executes it. Messages go to the terminal history of the
+# session that submitted the job.
+def run_ai_job(job, request_args, cache_key):
+    timings = job["timings"]
+    timings["started"] = time.time()
+    job["status"] = "running"
+
+    def output(msg):
+        terminal_history.append(job["history_id"], make_history_entry(msg))
+
+    # Errors quote the AI's answer, so they are escaped for the terminal; the job keeps plain text.
+    def fail(message):
+        job["error"] = message
+        output(f"<span style='color:red;'>{html.escape(message)}</span>")
+
+    try:
+        ai_cmd, job["source"] = resolve_ai_command(request_args, cache_key)
+        timings["responded"] = time.time()
+        try:
+            job["suggested"] = ai_cmd
+            output(f"<div class='text-info'>AI suggested command: {html.escape(json.dumps(ai_cmd))}" + (" (cached)" if job["source"] != "model" else "") + "</div>")
+
+            try:
+                command = command_from_json(ai_cmd)  # The AI's JSON command, checked, as a Command.
+            except CommandError as e:
+                fail(f"AI failed to generate a valid command: {str(e).rstrip('.')}.")
+            else:
+                job["command"] = str(command)
+                job["status"] = "executing"
+                output(f"<div class='text-command'>&gt; {html.escape(job['command'])}</div>")
+                with using_table(job["table"]):
+                    result = execute_command(command)  # Execute the command.
+                output(result)
+                job["result"] = str(result)
+                job["output"] = result_json(result)
+        except Exception as e:
+            fail(f"AI response could not be parsed as a command: {ai_cmd} ({e}), please retry or optimize the prompt.")
+    except AiResponseError as e:
+        fail(f"AI response could not be parsed as a command: {e.content} ({e}), please retry or optimize the prompt.")
+    except Exception as e:
+        fail(f"AI request failed: {e}")
+    finally:
+        timings["finished"] = time.time()
+        job["status"] = "error" if job["error"] else "done"
+
+# Returns a job's state for polling, with durations in milliseconds: prompt (building the
+# system prompt), queued (waiting for a worker), model (the AI request), execute (running the
+# command) and total.
+def describe_ai_job(job):
+    t = job["timings"]
+    def ms(start, end):
+        return round((t[end] - t[start]) * 1000, 1) if start in t and end in t else None
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "suggested": job["suggested"],
+        "command": job["command"],
+        "result": job["result"],
+        "output": job["output"],
+        "error": job["error"],
+        "source": job["source"],
+        "timings_ms": {
+            "prompt": ms("created", "prompt_built"),
+            "queued": ms("prompt_built", "started"),
+            "model": ms("started", "responded"),
+            "execute": ms("responded", "finished") if job["command"] else None,
+            "total": ms("created", "finished"),
+        },
+    }
+
+# Route for processing commands generated by the AI. The request is queued and the page polls
+# the job; requests asking for JSON get the job id back instead of a redirect.
+@app.route("/ai_command", methods=["POST"])
+def ai_command():
+    user_input = request.form["user_input"]  # User's natural language query
+    ai_url, api_key, model = get_ai_config()  # Get config including model
+    wants_json = request.accept_mimetypes.best == "application/json"
+
+    if not api_key:  # Explicitly check for API key
+        append_terminal_output("<span style='color:red;'>AI Error: API Key is not configured. Please set it first (via UI or OPENROUTER_API_KEY environment variable).</span>")
+        return ({"error": "AI API key is not configured"}, 400) if wants_json else redirect(url_for("index"))
+
+    job = submit_ai_job(user_input)
+    if job is None:
+        append_terminal_output("<span style='color:red;'>AI request failed: Too many AI requests in progress, please retry shortly.</span>")
+        return ({"error": "Too many AI requests in progress"}, 503) if wants_json else redirect(url_for("index"))
+    if wants_json:
+        return {"job_id": job["id"], "status_url": url_for("ai_job_status", job_id=job["id"])}, 202
+    return redirect(url_for("index"))
+
+# Route reporting an AI job's progress and result (only to the session that submitted it).
+@app.route("/ai_jobs/<job_id>")
+def ai_job_status(job_id):
+    with _ai_jobs_lock:
+        job = ai_jobs.get(job_id)
+    if job is None or job["history_id"] != session.get("history_id"):
+        return {"error": "Unknown job"}, 404
+    return describe_ai_job(job)
+
+# Returns the ids of this session's AI jobs that haven't finished yet.
+def pending_ai_jobs():
+    history_id = session.get("history_id")
+    with _ai_jobs_lock:
+        return [job["id"] for job in ai_jobs.values()
+                if job["history_id"] == history_id and job["status"] not in ("done", "error")]
+
+# --- Streaming AI answers -----------------------------------------------------------------------
+# /ai_stream answers an AI request with server-sent events instead of a job to poll: it asks the
+# AI service to stream its answer, relays each piece to the browser as it arrives ("token"
+# events) and, as soon as the text received so far holds a complete JSON command, stops reading,
+# checks the command and runs it ("command", then "result"). The model's trailing output (closing
+# Markdown fences, explanations) is never waited for, so the first output shows up after the
+# model's first tokens rather than its whole answer. Cached answers are replayed at once. Streams
+# run on the web worker serving them, at most AI_MAX_QUEUED at a time.
+
+AI_STREAM = os.environ.get("MODERNDB_AI_STREAM", "on").lower() not in ("off", "false", "0", "no")  # The page streams AI answers
+_ai_stream_slots = threading.BoundedSemaphore(AI_MAX_QUEUED)
+_json_decoder = json.JSONDecoder()
+
+# Yields the pieces of the AI's answer as the service streams them: OpenAI-style server-sent
+# events, one "data: {chunk}" line per piece, ending with "data: [DONE]". A service that answers
+# in one piece (no event stream) yields its whole answer. Closing the generator closes the
+# connection.
+def stream_ai_content(request_args):
+    with ai_http.post(request_args["url"], json=request_args["json"], headers=request_args["headers"],
+                      timeout=AI_TIMEOUT, stream=True) as resp:
+        resp.raise_for_status()
+        if not resp.headers.get("Content-Type", "").startswith("text/event-stream"):
+            data = resp.json()
+            if "choices" in data and data["choices"]:
+                yield data["choices"][0]["message"]["content"]
+            elif "message" in data and "content" in data["message"]:
+                yield data["message"]["content"]
+            else:
+                yield str(data)
+            return
+        for line in _iter_event_lines(resp):
+            if not line.startswith("data:"):
+                continue  # Blank separators, comments (keep-alives) and other fields.
+            data = line[5:].strip()
+            if data == "[DONE]":
+                return
+            choices = json.loads(data).get("choices") or [{}]
+            piece = (choices[0].get("delta") or {}).get("content")
+            if piece:
+                yield piece
+
+# Yields the lines of a streamed response as soon as each one is complete. iter_lines() would
+# wait for whole 512-byte reads, holding back the first tokens; read1() returns what has arrived.
+def _iter_event_lines(resp):
+    read1 = getattr(resp.raw, "read1", None)
+    if read1 is None:  # urllib3 1.x
+        for line in resp.iter_lines(chunk_size=1):
+            yield line.decode("utf-8")
+        return
+    buffer = b""
+    while True:
+        data = read1(65536)
+        if not data:
+            break
+        *lines, buffer = (buffer + data).split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r").decode("utf-8")
+    if buffer:
+        yield buffer.decode("utf-8")
+
+# Returns the JSON command at the start of a partial AI answer once it is complete, or None
+# until then. Text around the object (Markdown fences, explanations) is ignored and 'undefined'
+# reads as null.
+def parse_partial_command(content):
+    start = content.find("{")
+    if start < 0:
+        return None
+    try:
+        return _json_decoder.raw_decode(re.sub(r':\s*undefined', ': null', content[start:]))[0]
+    except ValueError:
+        return None
+
+# Formats one server-sent event.
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+# Yields the server-sent events of one streamed AI request: "token" ({"text"}) per piece of the
+# answer, "suggested" (the AI's JSON command), "command" ({"command"}, in terminal syntax),
+# "result" ({"html", "output"}), "error" ({"message"}) and finally "done" ({"source", "timings_ms"}).
+# Messages also go to the terminal history of the session, as for AI jobs.
+def stream_ai_events(request_args, cache_key, table, history_id):
+    state = {"started": time.time(), "source": None, "timings": {}}
+    if _ai_stream_slots.acquire(blocking=False):
+        try:
+            yield from _stream_ai_command(request_args, cache_key, table, history_id, state)
+        finally:
+            _ai_stream_slots.release()  # Also when the browser goes away mid-stream.
+    else:
+        yield _ai_stream_error(history_id, "AI request failed: Too many AI requests in progress, please retry shortly.")
+    state["timings"]["total"] = _ms_since(state["started"])
+    yield _sse("done", {"source": state["source"], "timings_ms": state["timings"]})
+
+def _ms_since(started):
+    return round((time.time() - started) * 1000, 1)
+
+# Reports an error to the terminal history and returns its "error" event.
+def _ai_stream_error(history_id, message):
+    terminal_history.append(history_id, make_history_entry(f"<span style='color:red;'>{html.escape(message)}</span>"))
+    return _sse("error", {"message": message})
+
+def _stream_ai_command(request_args, cache_key, table, history_id, state):
+    timings = state["timings"]
+
+    def output(msg):
+        terminal_history.append(history_id, make_history_entry(msg))
+
+    cached = ai_cache.get(cache_key) if ai_cache is not None else None
+    flight, leader = _join_ai_flight(cache_key) if ai_cache is not None and cached is None else (None, True)
+    if cached is not None:
+        ai_cmd, state["source"] = cached[0], "cache"
+        ai_cache_stats["hits"] += 1
+        ai_cache_stats["saved_ms"] += cached[1]
+    elif not leader:
+        # An identical request (streamed or a job) is already asking the AI: replay its answer.
+        try:
+            ai_cmd = _await_ai_flight(flight)
+        except AiResponseError as e:
+            yield _ai_stream_error(history_id, f"AI response could not be parsed as a command: {e.content}, "
+                                               "please retry or optimize the prompt.")
+            return
+        except Exception as e:
+            yield _ai_stream_error(history_id, f"AI request failed: {e}")
+            return
+        state["source"] = "coalesced"
+    else:
+        if flight is not None:
+            ai_cache_stats["misses"] += 1
+        state["source"] = "model"
+        ai_cmd, content = None, ""
+        try:
+            pieces = stream_ai_content(request_args)
+            try:
+                with timed("ai_http"):
+                    for piece in pieces:
+                        timings.setdefault("first_token", _ms_since(state["started"]))
+                        content += piece
+                        yield _sse("token", {"text": piece})
+                        if "}" in piece:
+                            ai_cmd = parse_partial_command(content)
+                            if ai_cmd is not None:
+                                break  # Don't wait for the rest of the answer.
+            except Exception as e:
+                if flight is not None:
+                    flight["error"] = e
+                yield _ai_stream_error(history_id, f"AI request failed: {e}")
+                return
+            finally:
+                pieces.close()
+            if not isinstance(ai_cmd, dict):
+                if flight is not None:
+                    flight["error"] = AiResponseError(content, "no JSON command in the answer")
+                yield _ai_stream_error(history_id, f"AI response could not be parsed as a command: {content}, "
+                                                   "please retry or optimize the prompt.")
+                return
+            if flight is not None:
+                _cache_ai_answer(cache_key, flight, ai_cmd, _ms_since(state["started"]))
+        finally:
+            if flight is not None:
+                _finish_ai_flight(cache_key, flight)  # Also when the browser goes away mid-stream.
+    timings["parsed"] = _ms_since(state["started"])
+    output(f"<div class='text-info'>AI suggested command: {html.escape(json.dumps(ai_cmd))}"
+           + (" (cached)" if state["source"] != "model" else "") + "</div>")
+    yield _sse("suggested", ai_cmd)
+    try:
+        command = command_from_json(ai_cmd)
+    except CommandError as e:
+        yield _ai_stream_error(history_id, f"AI failed to generate a valid command: {str(e).rstrip('.')}.")
+        return
+    output(f"<div class='text-command'>&gt; {html.escape(str(command))}</div>")
+    yield _sse("command", {"command": str(command)})
+    with using_table(table):
+        result = execute_command(command)
+    output(result)
+    timings["executed"] = _ms_since(state["started"])
+    yield _sse("result", {"html": str(result), "output": result_json(result)})
+
+# Route streaming an AI request's answer and its command's result as server-sent events (see
+# stream_ai_events). The page uses it when MODERNDB_AI_STREAM is on; /ai_command remains for
+# job-based clients.
+@app.route("/ai_stream", methods=["POST"])
+def ai_stream():
+    user_input = request.form["user_input"]  # User's natural language query
+    ai_url, api_key, model = get_ai_config()
+    if not api_key:
+        append_terminal_output("<span style='color:red;'>AI Error: API Key is not configured. Please set it first (via UI or OPENROUTER_API_KEY environment variable).</span>")
+        return {"error": "AI API key is not configured"}, 400
+    df = load_data(copy=False)
+    cache_key = ai_cache_key(ai_url, model, df, user_input)
+    request_args = build_ai_request(df, user_input, stream=True)
+    events = stream_ai_events(request_args, cache_key, current_table(), get_history_id())
+    return Response(stream_with_context(events), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# --- Commands ---------------------------------------------------------------------------------
+# Every command runs from one typed form, a Command: its operation, its arguments parsed and
+# checked per operation (COMMAND_ARGS) and optionally the table it names. Terminal text is compiled
+# into it once (compile_command: one shlex split, k=v pairs split once); JSON commands, from the AI
+# or from /api/command, are converted into it directly (command_from_json) without going through
+# text. execute_command runs it and returns a Message, a TableResult or a ProfileResult: str()
+# renders any of them as terminal HTML and result_json() gives their JSON form, so JSON clients
+# never pay for HTML. Argument values are kept as text, the form the casting and condition code
+# reads (JSON numbers and booleans are spelled as on the terminal, null as nan), so a command
+# behaves the same whichever syntax it came in.
+
+# Arguments of each operation's Command.
+COMMAND_ARGS = {
+    "help": (), "clear": (), "list": (), "columns": (), "cache": (), "tables": (),
+    "use": ("name",),  # Table to switch to, or None to show the current one
+    "add": ("data",),  # {column: value}
+    "add_batch": ("columns",),  # {column: [value, ...]}, all of the same length
+    "update": ("conditions", "data"),  # {column: condition}, {column: value}
+    "delete": ("conditions", "confirm"),  # {column: condition}, bool
+    "delete_all": ("confirm",),  # bool
+    "search": ("keyword",),
+    "search_exact": ("column", "value"),
+    "index": ("column", "drop"),  # Column to index or drop, or None to list the indexes; bool
+    "aggregate": ("spec", "view"),  # AggregateSpec, or None to read the materialized aggregate named view
+    "materialize": ("name", "spec", "drop"),  # name None lists them; spec to create, or drop
+    "profile": ("command",),  # The Command to profile
+}
+# Commands that change the dataset; they run on the dataset writer.
+MUTATING_COMMANDS = {"add", "add_batch", "update", "delete", "delete_all"}
+TABLELESS_COMMANDS = {"help", "clear", "cache", "tables", "use"}  # Commands that don't read the current table's rows
+API_COMMANDS_MAX = 100  # Commands accepted in one /api/command request
+
+# How the terminal shows a Message of each style.
+MESSAGE_STYLES = {
+    None: "{}",
+    "success": "<div class='text-success'>{}</div>",
+    "notice": "<div class='text-command'>{}</div>",
+    "muted": "<div class='text-gray-400'>{}</div>",
+    "warning": "<span style='color:orange;'>{}</span>",
+    "danger": "<span style='color:red;'>{}</span>",
+    "pre": "<pre>{}</pre>",
+}
+
+# A command's text message. ok is False when the command failed or was refused (an error, an
+# unknown command, a bulk delete waiting for confirmation). str() renders it, escaped, for the
+# terminal.
+class Message:
+    def __init__(self, text, style=None, ok=True):
+        self.text = text
+        self.style = style
+        self.ok = ok
+
+    def __str__(self):
+        return MESSAGE_STYLES[self.style].format(html.escape(self.text, quote=False))
+
+# Raised while compiling or running a command; becomes the command's failed Message.
+class CommandError(Exception):
+    def __init__(self, message, style=None):
+        super().__init__(message)
+        self.style = style
+
+    def to_message(self):
+        return Message(str(self), self.style, ok=False)
+
+# A command ready to run: op is one of COMMAND_ARGS, args holds that operation's arguments.
+class Command:
+    def __init__(self, op, args=None, table=None, text=None):
+        self.op = op
+        self.args = args or {}
+        self.table = table  # Table the command names ("sales.list"), None for the current table
+        self.text = text  # Terminal text the command was compiled from, if any
+        self.limit = None  # Rows a query returns to a JSON client instead of the terminal preview
+
+    # The command in terminal syntax: the text it was compiled from, or else written out from its
+    # arguments (for display; it is never parsed back).
+    def __str__(self):
+        if self.text is not None:
+            return self.text
+        op, args = self.op, self.args
+        words = [shlex.quote(f"{self.table}.{op}" if self.table else op)]
+        pairs = lambda mapping: [shlex.quote(f"{k}={v}") for k, v in mapping.items()]
+        if op == "use" and args["name"] is not None:
+            words.append(shlex.quote(args["name"]))
+        elif op == "add":
+            words += pairs(args["data"])
+        elif op == "add_batch":
+            words += pairs({col: ",".join(values) for col, values in args["columns"].items()})
+        elif op == "update":
+            words += pairs(args["conditions"]) + ["set"] + pairs(args["data"])
+        elif op == "delete":
+            words += pairs(args["conditions"]) + (["confirm=yes"] if args["confirm"] else [])
+        elif op == "delete_all" and args["confirm"]:
+            words.append("confirm")
+        elif op == "search":
+            words.append(shlex.quote(args["keyword"]))
+        elif op == "search_exact":
+            words += pairs({args["column"]: args["value"]})
+        elif op == "index" and args["column"] is not None:
+            words += (["drop"] if args["drop"] else []) + [shlex.quote(args["column"])]
+        elif op == "aggregate":
+            words.append(str(args["spec"]) if args["spec"] is not None else shlex.quote(args["view"]))
+        elif op == "materialize" and args["name"] is not None:
+            words += ["drop", shlex.quote(args["name"])] if args["drop"] else [shlex.quote(args["name"]), str(args["spec"])]
+        elif op == "profile":
+            words.append(str(args["command"]))
+        return " ".join(words)
+
+# Compiles a terminal command into a Command. Raises CommandError with the message to show for a
+# malformed command.
+def compile_command(text):
+    try:
+        tokens = shlex.split(text)  # Split command string into tokens, respecting quotes.
+    except ValueError as e:
+        raise CommandError(f"Error processing command '{text}': {e}. Please check syntax or use 'help'.", "danger")
+    if not tokens:
+        raise CommandError("No command input")
+    return _compile_tokens(tokens, text.strip())
+
+def _compile_tokens(tokens, text):
+    op, table = tokens[0].lower(), None
+    name, dot, rest = tokens[0].partition(".")
+    if dot and valid_table_name(name) and rest.lower() in COMMAND_ARGS.keys() - {"use", "tables"}:
+        op, table = rest.lower(), name  # Table-qualified command, e.g. sales.list
+    words = tokens[1:]
+    try:
+        if op in ("help", "clear", "list", "columns", "cache", "tables"):
+            args = {}
+        elif op == "use":
+            args = {"name": words[0] if len(words) == 1 else None}
+        elif op == "add":
+            args = {"data": dict(token.split('=', 1) for token in words if '=' in token)}
+            if not args["data"]:
+                raise CommandError("add requires fields and values, e.g., add name=Tom age=18")
+        elif op == "add_batch":
+            pairs = dict(token.split('=', 1) for token in words if '=' in token)
+            if not pairs:
+                raise CommandError("add_batch requires column lists, e.g., add_batch name=Tom,Alice,Bob age=25,30,28")
+            args = {"columns": {col: [v.strip() for v in values.split(',')] for col, values in pairs.items()}}
+        elif op == "update":
+            conditions, updates = parse_update_args(tokens)
+            args = {"conditions": conditions, "data": updates}
+        elif op == "delete":
+            conditions, confirmed = parse_delete_args(tokens)
+            args = {"conditions": conditions, "confirm": confirmed}
+        elif op == "delete_all":
+            args = {"confirm": bool(words) and words[0].lower() == "confirm"}
+        elif op == "search":
+            if not words:
+                raise CommandError("search command requires a keyword. Usage: search <keyword>")
+            args = {"keyword": words[0]}
+        elif op == "search_exact":
+            if len(words) != 1 or '=' not in words[0]:
+                raise CommandError("search_exact command format error. Usage: search_exact column_name=value_to_search")
+            column, value = words[0].split('=', 1)
+            args = {"column": column, "value": value}
+        elif op == "index":
+            drop = len(words) == 2 and words[0].lower() == "drop"
+            args = {"column": words[-1] if drop else (words[0] if words else None), "drop": drop}
+        elif op == "aggregate":
+            if not words:
+                raise CommandError("aggregate requires measures, e.g., aggregate count sum(price) by city where age=>30")
+            if len(words) == 1:  # A materialized aggregate's name, or a single measure.
+                try:
+                    spec = parse_aggregate(words)
+                except ValueError:
+                    spec = None
+                args = {"spec": spec, "view": words[0]}
+            else:
+                args = {"spec": parse_aggregate(words), "view": None}
+        elif op == "materialize":
+            if not words:
+                args = {"name": None, "spec": None, "drop": False}
+            elif len(words) == 2 and words[0].lower() == "drop":
+                args = {"name": words[1], "spec": None, "drop": True}
+            elif len(words) < 2:
+                raise CommandError("materialize requires a name and measures, e.g., materialize sales_by_city count sum(price) by city")
+            else:
+                args = {"name": _check_view_name(words[0]), "spec": parse_aggregate(words[1:]), "drop": False}
+        elif op == "profile":
+            if not words:
+                raise CommandError("profile requires a command, e.g., profile search_exact city=Paris")
+            command = _compile_tokens(words, text.split(None, 1)[1])
+            if command.op == "profile":
+                raise CommandError("Error: profile can't profile itself.")
+            args = {"command": command}
+        else:
+            raise CommandError(f"Unknown command: '{op}'. Type 'help' for available commands.", "warning")
+    except ValueError as e:
+        # parse_update_args and parse_delete_args report the whole message, parse_aggregate a reason.
+        raise CommandError(str(e) if op in ("update", "delete") else f"Error: {e}.")
+    _check_batch(op, args)
+    return Command(op, args, table, text)
+
+# Checks that the columns of an add_batch have the same, non-zero number of values.
+def _check_batch(op, args):
+    if op != "add_batch":
+        return
+    row_count = -1  # Used to ensure all columns have the same number of values.
+    for col, values in args["columns"].items():
+        if row_count == -1:
+            row_count = len(values)
+        elif len(values) != row_count:  # Validate consistent number of values.
+            raise CommandError(f"Error: All columns must have the same number of values. Column '{col}' has {len(values)} values, but expected {row_count}.")
+    if row_count <= 0:  # Check if any values were actually provided.
+        raise CommandError("Error: No values provided for batch add, or empty value lists.")
+
+# Returns name if it can name a materialized aggregate (it can't look like a measure or 'drop').
+def _check_view_name(name):
+    if _AGGREGATE_RE.match(name) or name.lower() == "drop":
+        raise CommandError(f"Error: '{name}' can't be used as a name.")
+    return name
+
+# Converts a JSON command ({"operation": "update", "conditions": {...}, "data": {...}}, the format
+# the AI is prompted for, with an optional "table") into a Command. Raises CommandError saying what
+# is wrong with it; an AI refusal ({"operation": "error"}) raises with the AI's message.
+def command_from_json(obj):
+    if not isinstance(obj, dict) or not isinstance(obj.get("operation"), str):
+        raise CommandError("a command must be a JSON object with an 'operation'")
+    op = obj["operation"].lower()
+    if op == "error":
+        raise CommandError(str(obj.get("message") or "the request isn't a supported command"))
+    if op not in COMMAND_ARGS:
+        raise CommandError(f"Unknown command: '{op}'. Type 'help' for available commands.", "warning")
+    table = obj.get("table")
+    if table is not None and (not isinstance(table, str) or not valid_table_name(table) or op in ("use", "tables")):
+        raise CommandError(f"'table' must name a table (letters, digits and underscores) and can't be used with {op}")
+    if op in ("help", "clear", "list", "columns", "cache", "tables"):
+        args = {}
+    elif op == "use":
+        args = {"name": _json_name(obj, "name", op, required=False)}
+    elif op == "add":
+        args = {"data": _json_mapping(obj, "data", op)}
+    elif op == "add_batch":
+        columns, rows = obj.get("columns"), obj.get("values")
+        if not isinstance(columns, list) or not columns or not all(isinstance(col, str) for col in columns):
+            raise CommandError("add_batch requires 'columns', a list of column names")
+        if not isinstance(rows, list) or not all(isinstance(row, list) and len(row) == len(columns) for row in rows):
+            raise CommandError("add_batch requires 'values', a list of rows with one value per column")
+        args = {"columns": {col: [_json_text(row[i], col) for row in rows] for i, col in enumerate(columns)}}
+    elif op == "update":
+        args = {"conditions": _json_mapping(obj, "conditions", op), "data": _json_mapping(obj, "data", op)}
+    elif op == "delete":
+        args = {"conditions": _json_mapping(obj, "conditions", op), "confirm": obj.get("confirm") is True}
+    elif op == "delete_all":
+        args = {"confirm": obj.get("confirm") is True}
+    elif op == "search":
+        if obj.get("keyword") is None:
+            raise CommandError("search requires a 'keyword'")
+        args = {"keyword": _json_text(obj["keyword"], "keyword")}
+    elif op == "search_exact":
+        if obj.get("value") is None:
+            raise CommandError("search_exact requires a 'value'")
+        args = {"column": _json_name(obj, "column", op), "value": _json_text(obj["value"], "value")}
+    elif op == "index":
+        args = {"column": _json_name(obj, "column", op, required=False), "drop": obj.get("drop") is True}
+        if args["drop"] and args["column"] is None:
+            raise CommandError("index requires the 'column' to drop")
+    elif op == "aggregate":
+        view = _json_name(obj, "view", op, required=False)
+        args = {"spec": None if view is not None else _json_aggregate(obj), "view": view}
+    elif op == "materialize":
+        name = _json_name(obj, "name", op, required=False)
+        drop = obj.get("drop") is True
+        if name is None and drop:
+            raise CommandError("materialize requires the 'name' to drop")
+        spec = _json_aggregate(obj) if name is not None and not drop else None
+        args = {"name": _check_view_name(name) if spec is not None else name, "spec": spec, "drop": drop}
+    else:  # profile
+        command = command_from_json(obj.get("command"))
+        if command.op == "profile":
+            raise CommandError("Error: profile can't profile itself.")
+        args = {"command": command}
+    _check_batch(op, args)
+    return Command(op, args, table)
+
+# Returns a JSON command's value as the text a terminal command would hold.
+def _json_text(value, key):
+    if value is None:
+        return "nan"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (str, int, float)):
+        return str(value)
+    raise CommandError(f"'{key}' must hold text, numbers, booleans or null")
+
+# Returns the string obj[key] (a column or table name), or None if it is absent and not required.
+def _json_name(obj, key, op, required=True):
+    value = obj.get(key)
+    if value is None and not required:
+        return None
+    if not isinstance(value, str) or not value:
+        raise CommandError(f"{op} requires '{key}', a name")
+    return value
+
+# Returns obj[key], which must be a non-empty object of column -> value, with the values as text.
+def _json_mapping(obj, key, op):
+    mapping = obj.get(key)
+    if not isinstance(mapping, dict) or not mapping:
+        raise CommandError(f"{op} requires '{key}', a non-empty object of column: value")
+    return {str(col): _json_text(value, col) for col, value in mapping.items()}
+
+# Builds the AggregateSpec of a JSON aggregate: "measures" (["count", "sum(price)"]), optionally
+# "by" (a list of columns) and "where" (an object of column: condition).
+def _json_aggregate(obj):
+    measures, by, where = obj.get("measures"), obj.get("by") or [], obj.get("where") or {}
+    if isinstance(measures, str):
+        measures = measures.split()
+    if isinstance(by, str):
+        by = [col for col in by.split(",") if col]
+    if not isinstance(measures, list) or not all(isinstance(m, str) for m in measures):
+        raise CommandError("aggregate requires 'measures', e.g., [\"count\", \"sum(price)\"]")
+    if not isinstance(by, list) or not all(isinstance(col, str) for col in by) or not isinstance(where, dict):
+        raise CommandError("aggregate's 'by' must be a list of columns and 'where' an object of column: condition")
+    try:
+        spec = parse_aggregate(measures)
+    except ValueError as e:
+        raise CommandError(f"Error: {e}.")
+    return AggregateSpec(spec.measures, by, {str(col): _json_text(value, col) for col, value in where.items()})
+
+# Returns a command result (Message, TableResult or ProfileResult) as JSON.
+def result_json(result):
+    if isinstance(result, TableResult):
+        return {"ok": True, "type": "table", "version": result.version, "total": result.total,
+                "columns": result.columns, "rows": result.json_rows(), "preview": result.is_preview()}
+    if isinstance(result, ProfileResult):
+        output = result_json(result.output)
+        return {"ok": output["ok"], "type": "profile", "result": output, "total_ms": round(result.seconds * 1000, 3),
+                "phases": [{"phase": phase, "calls": calls, "ms": round(seconds * 1000, 3), "depth": depth}
+                           for phase, (calls, seconds, depth) in result.profile.phases.items()],
+                "counters": dict(result.profile.counters)}
+    return {"ok": result.ok, "type": "message", "style": result.style, "text": result.text}
+
+# Message for a command that raised while running.
+def _command_failed(command, e):
+    return Message(f"Error processing command '{command}': {e}. Please check syntax or use 'help'.", "danger", ok=False)
+
+# Executes a command (a Command, or terminal text compiled first) and returns its result.
+# Mutating commands are queued on the dataset writer; read-only ones run here on the shared cached
+# frame. Commands on an out-of-core table stream its stored rows instead (see
+# run_streamed_command). A table-qualified command runs against the named table without changing
+# the session's current table; the table must exist, so a misspelt name doesn't create one.
+def execute_command(command):
+    if isinstance(command, str):
+        try:
+            command = compile_command(command)
+        except CommandError as e:
+            return e.to_message()
+    if command.table and command.table not in list_tables():
+        return Message(f"Error: Unknown table '{command.table}'. Use 'tables' to list the tables, "
+                       f"or 'use {command.table}' to create it.", ok=False)
+    with using_table(get_table(command.table)) if command.table else contextlib.nullcontext():
+        op = command.op
+        if op == "profile":
+            return profile_command(command.args["command"])
+        if op in OUT_OF_CORE_COMMANDS and is_out_of_core(current_table()):
+            if op not in MUTATING_COMMANDS:
+                return run_streamed_command(command)
+            try:
+                return dataset_writer.submit(lambda: run_streamed_command(command), with_frame=False)
+            except Exception as e:
+                return _command_failed(command, e)
+        if op in TABLELESS_COMMANDS and is_out_of_core(current_table()):
+            return run_command(command, pd.DataFrame())  # Don't load a table the command doesn't read.
+        if op in MUTATING_COMMANDS:
+            try:
+                return dataset_writer.submit(lambda df: run_command(command, df))
+            except Exception as e:
+                return _command_failed(command, e)
+        return run_command(command, load_data(copy=False))
+
+# Result of 'profile': the profiled command's result, followed by the phases and counters a
+# PhaseProfile collected while it ran (on the dataset writer too, for mutations).
+class ProfileResult:
+    def __init__(self, command, output, profile, seconds):
+        self.command = command
+        self.output = output
+        self.profile = profile
+        self.seconds = seconds
+
+    def __str__(self):
+        total = self.seconds
+        counters = self.profile.counters
+        lines = [f"Profile of '{self.command}': {total * 1000:.2f} ms",
+                 f"{'phase':<34} {'calls':>6} {'total ms':>10} {'share':>7}"]
+        for phase, (calls, seconds, depth) in self.profile.phases.items():
+            lines.append(f"{'  ' * depth + phase:<34} {calls:>6} {seconds * 1000:>10.2f} {seconds / total:>7.1%}")
+        lines.append(f"rows scanned: {counters.get('moderndb_rows_scanned_total', 0)}, "
+                     f"rows mutated: {counters.get('moderndb_rows_mutated_total', 0)}, "
+                     f"bytes written: {counters.get('moderndb_bytes_written_total', 0)}")
+        return f"{self.output}<pre>{html.escape(chr(10).join(lines))}</pre>"
+
+# Runs a command with a PhaseProfile collecting its phases and counters and returns its
+# ProfileResult.
+def profile_command(command):
+    profile = PhaseProfile()
+    previous = getattr(_profile_context, "collectors", None)
+    _profile_context.collectors = (previous or []) + [profile]
+    started = time.perf_counter()
+    try:
+        output = execute_command(command)
+    finally:
+        _profile_context.collectors = previous
+    return ProfileResult(command, output, profile, time.perf_counter() - started)
+
+# Route for processing commands entered directly into the terminal.
+@app.route("/terminal_command", methods=["POST"])
+def terminal_command():
+    cmd = request.form["terminal_input"]  # Command string from the terminal input field.
+    append_terminal_output(f"<div class='text-command'>&gt; {html.escape(cmd)}</div>")
+    msg = execute_command(cmd)  # Compile and execute the command.
+    append_terminal_output(msg)
+    return redirect(url_for("index"))
+
+# JSON command API for programmatic clients. The body is one command or an array of them, each a
+# JSON command (see command_from_json) or a terminal command string; a JSON command may add
+# "limit" to get up to that many rows of a query result (at most PAGE_SIZE_MAX) instead of the
+# terminal preview. Commands run in order, each on its own (use /run_script for a transaction),
+# and nothing is written to the terminal. Answers with one result, or {"results": [...]} for an
+# array; each result is result_json's with "ms", or {"ok": false, "error": ...} for a command
+# that couldn't be compiled.
+@app.route("/api/command", methods=["POST"])
+def api_command():
+    body = request.get_json(silent=True)
+    single = not isinstance(body, list)
+    items = [body] if single else body
+    if body is None or not items:
+        return {"ok": False, "error": "The body must be a JSON command or an array of commands"}, 400
+    if len(items) > API_COMMANDS_MAX:
+        return {"ok": False, "error": f"At most {API_COMMANDS_MAX} commands per request"}, 400
+    results = []
+    for item in items:
+        started = time.perf_counter()
+        try:
+            command = compile_command(item) if isinstance(item, str) else command_from_json(item)
+            limit = item.get("limit") if isinstance(item, dict) else None
+            if limit is not None:
+                if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+                    raise CommandError("'limit' must be a positive integer")
+                command.limit = min(limit, PAGE_SIZE_MAX)
+        except CommandError as e:
+            results.append({"ok": False, "error": str(e)})
+            continue
+        result = result_json(execute_command(command))
+        result["ms"] = round((time.perf_counter() - started) * 1000, 3)
+        results.append(result)
+    if single:
+        return results[0], 200 if "error" not in results[0] else 400
+    return {"results": results}
+
+# --- Scripts -----------------------------------------------------------------------------------
+# A script is a list of terminal commands run as one transaction: a single dataset writer job
+# applies them in order to one private copy of the dataset, and their mutations are committed
+# together at the end (one WAL append, or one rewrite of the store without a WAL). The first
+# command that fails rolls the whole script back.
+
+# Commands allowed in a script. delete_all replaces the store directly, so it couldn't be rolled
+# back; the commands acting on the terminal or on server state aren't data commands.
+SCRIPT_COMMANDS = (MUTATING_COMMANDS - {"delete_all"}) | {"list", "columns", "search", "search_exact", "aggregate"}
+SCRIPT_REPORT_LINES = 20  # Commands listed in the terminal report of a script
+
+class ScriptError(Exception):
+    def __init__(self, message, results):
+        super().__init__(message)
+        self.results = results  # Results of the commands run before the script stopped
+
+# Splits a script into (line number, command) pairs: one command per line, skipping blank
+# lines and # comments.
+def parse_script(text):
+    return [(number, line.strip()) for number, line in enumerate(text.splitlines(), 1)
+            if line.strip() and not line.strip().startswith("#")]
+
+# Compiles a script's commands, then runs them as one transaction on the dataset writer and
+# returns their results ({"line", "command", "ok", "ms", "output"}) once the changes are durable.
+# A command that doesn't compile fails the script before anything runs. A change command that
+# changes nothing (unknown column, no matching rows, an unconfirmed bulk delete) fails the script:
+# ScriptError is raised with the results so far and none of its changes are kept.
+def execute_script(commands):
+    compiled = []
+    for number, cmd in commands:
+        try:
+            command = compile_command(cmd)
+        except CommandError as e:
+            raise ScriptError(f"Line {number}: {e}", [])
+        if command.op not in SCRIPT_COMMANDS or command.table is not None:
+            raise ScriptError(f"Line {number}: '{cmd.split(None, 1)[0]}' can't be used in a script", [])
+        compiled.append((number, command))
+
+    def transaction(df):
+        pending = _writer_context.pending
+        results = []
+        for number, command in compiled:
+            logged = len(pending)
+            started = time.perf_counter()
+            output = run_command(command, df)
+            changed = len(pending) > logged
+            ok = changed or command.op not in MUTATING_COMMANDS
+            results.append({"line": number, "command": str(command), "ok": ok,
+                            "ms": round((time.perf_counter() - started) * 1000, 2), "output": output})
+            if not ok:
+                raise ScriptError(f"Line {number} failed, nothing was changed", results)
+            if changed:
+                forget_frame(df)  # update changes the frame in place, so its indexes no longer apply.
+                df = pending[-1][0]
+        return results
+
+    return dataset_writer.submit(transaction)
+
+# Route running a script of terminal commands (pasted as text or uploaded as a file) in one
+# transaction. Returns a JSON report when the client asks for JSON, otherwise reports to the
+# terminal.
+@app.route("/run_script", methods=["POST"])
+def run_script():
+    wants_json = request.accept_mimetypes.best == "application/json"
+    script_file = request.files.get("script_file")
+    try:
+        text = script_file.read().decode("utf-8-sig") if script_file and script_file.filename else request.form.get("script", "")
+    except UnicodeDecodeError:
+        text = None
+    commands = parse_script(text) if text is not None else []
+    if not commands:
+        error = "The script is empty" if text is not None else "The script must be UTF-8 text"
+        append_terminal_output(f"<span style='color:red;'>Script failed: {error}.</span>")
+        return ({"error": error}, 400) if wants_json else redirect(url_for("index"))
+
+    started = time.perf_counter()
+    try:
+        results, error = execute_script(commands), None
+    except ScriptError as e:
+        results, error = e.results, str(e)
+    except Exception as e:
+        results, error = [], f"Commit failed: {e}"
+    total_ms = (time.perf_counter() - started) * 1000
+    command_ms = sum(r["ms"] for r in results)
+    report = {
+        "committed": error is None,
+        "error": error,
+        "commands": len(commands),
+        "executed": len(results),
+        "total_ms": round(total_ms, 2),
+        "commit_ms": round(total_ms - command_ms, 2) if error is None else None,  # Writer queue wait and commit
+        "results": [dict(r, output=str(r["output"])) for r in results],
+    }
+    if wants_json:
+        return report, 200 if error is None else 422
+
+    append_terminal_output(f"<div class='text-command'>&gt; run script ({len(commands)} commands)</div>")
+    lines = [f"{r['line']:>5}  {r['ms']:>9.2f} ms  {'ok    ' if r['ok'] else 'FAILED'}  {r['command']}"
+             for r in results[:SCRIPT_REPORT_LINES]]
+    if len(results) > SCRIPT_REPORT_LINES:
+        lines.append(f"... {len(results) - SCRIPT_REPORT_LINES} more commands")
+    if error is None:
+        summary = (f"<div class='text-success'>Script succeeded: {len(commands)} commands committed in "
+                   f"{total_ms:.1f} ms ({command_ms:.1f} ms running commands).</div>")
+    else:
+        summary = f"<span style='color:red;'>Script failed: {html.escape(error)}. All changes were rolled back.</span>"
+    append_terminal_output(summary + (f"<pre>{html.escape(chr(10).join(lines))}</pre>" if lines else ""))
+    if error is not None and results:
+        append_terminal_output(results[-1]["output"])  # Why the failing command failed
+    return redirect(url_for("index"))
+
+# Route for destroying all data
+@app.route("/destroy_data", methods=["POST"])
+def destroy_data():
+    try:
+        # Save an empty dataset rather than removing the store (save_data also bumps the dataset version)
+        dataset_writer.submit(lambda: save_data(pd.DataFrame()), with_frame=False)
+        
+        # Clear terminal output
+        clear_terminal_output()
+        append_terminal_output(f"<div class='text-success'>All data in table {current_table().name} has been destroyed. "
+                               "Application reset to initial state.</div>")
+        return redirect(url_for("index"))
+    except Exception as e:
+        append_terminal_output(f"<div class='text-error'>Data destruction failed: {e}</div>")
+    return redirect(url_for("index"))
+
+# --- Bulk mutation helpers -------------------------------------------------------------------
+# update and add_batch cast each value once per target column and write whole columns or
+# masked ranges at a time, so their cost is dominated by NumPy rather than per-row Python.
+
+TRUE_STRINGS = ('true', '1', 't', 'yes')
+FALSE_STRINGS = ('false', '0', 'f', 'no')
+
+# Returns True if the column can store value without changing its dtype, so the update
+# can be written in place at the matched positions.
+def _can_hold_value(series, value):
+    dtype = series.dtype
+    if dtype == object:
+        return True
+    if isinstance(dtype, pd.CategoricalDtype):
+        return value is pd.NA or value is None or value in dtype.categories
+    if value is pd.NA or value is None:
+        return pd.api.types.is_float_dtype(dtype) or pd.api.types.is_datetime64_dtype(dtype)
+    if pd.api.types.is_bool_dtype(dtype):
+        return isinstance(value, (bool, np.bool_))
+    if isinstance(value, (bool, np.bool_)):
+        return False
+    if pd.api.types.is_integer_dtype(dtype) and isinstance(dtype, np.dtype):
+        return isinstance(value, (int, np.integer)) and np.iinfo(dtype).min <= value <= np.iinfo(dtype).max
+    if pd.api.types.is_float_dtype(dtype) and isinstance(dtype, np.dtype):
+        return isinstance(value, (int, float, np.integer, np.floating))
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return isinstance(value, pd.Timestamp) and value.tz is None
+    return False
+
+# Sets one already-cast value on the given row positions of a column. Values the column can
+# hold are written in place (a new string first becomes a category of a categorical column);
+# otherwise the column is rebuilt with Series.mask, which upcasts the dtype the same way a
+# per-row assignment would.
+def assign_at_positions(df, positions, column, value):
+    series = df[column]
+    if isinstance(series.dtype, pd.CategoricalDtype) and isinstance(value, str) and value not in series.cat.categories:
+        series = df[column] = series.cat.add_categories([value])
+    if _can_hold_value(series, value):
+        df.iloc[positions, df.columns.get_loc(column)] = value
+        return
+    mask = np.zeros(len(df), dtype=bool)
+    mask[positions] = True
+    df[column] = series.mask(mask, value)
+
+# Vectorized counterpart of _attempt_cast_for_assignment for a whole list of value strings
+# destined for one existing column. Returns a typed array when every value casts cleanly,
+# otherwise an object array where values that don't fit the column stay strings.
+@instrumented("cast")
+def cast_values_for_column(values, target_series):
+    raw = pd.Series(values, dtype=object)
+    if target_series.empty:
+        # Nothing to infer the type from: numbers where possible, strings otherwise.
+        numeric = pd.to_numeric(raw, errors="coerce")
+        failed = numeric.isna().to_numpy() & (raw != "").to_numpy()
+        if not failed.any():
+            return numeric.to_numpy()
+        return _mix_numbers_and_strings(raw, failed)
+
+    dtype = target_series.dtype
+    lower = raw.str.lower()
+    is_null = lower.isin(NULL_VALUE_STRINGS).to_numpy()
+
+    if pd.api.types.is_bool_dtype(dtype):
+        is_true = lower.isin(TRUE_STRINGS).to_numpy()
+        is_false = lower.isin(FALSE_STRINGS).to_numpy()
+        if (is_true | is_false).all():
+            return is_true
+        result = raw.to_numpy(dtype=object).copy()
+        result[is_true] = True
+        result[is_false] = False
+        result[is_null] = pd.NA
+        return result
+
+    if pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype):
+        candidates = raw.where(~is_null)
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            parsed = pd.to_datetime(candidates, errors="coerce", format="mixed")
+        else:
+            parsed = pd.to_numeric(candidates, errors="coerce")
+            if pd.api.types.is_integer_dtype(dtype):
+                parsed = np.trunc(parsed)  # Same as int(float(value)): "10.7" -> 10.
+        failed = parsed.isna().to_numpy() & ~is_null
+        if not failed.any():
+            if pd.api.types.is_integer_dtype(dtype) and not is_null.any():
+                return parsed.to_numpy(dtype=np.int64)
+            return parsed.to_numpy()  # Missing values become NaN/NaT.
+        result = parsed.to_numpy(dtype=object)
+        if pd.api.types.is_integer_dtype(dtype):
+            ok = ~failed & ~is_null
+            result[ok] = parsed.to_numpy()[ok].astype(np.int64)  # Keep Python-style ints, not floats.
+        result[failed] = raw.to_numpy()[failed]
+        result[is_null] = pd.NA
+        return result
+
+    result = raw.to_numpy(dtype=object).copy()
+    result[is_null] = pd.NA
+    return result
+
+# Builds an object array where the cells flagged as failed keep their string and the rest
+# are parsed as numbers, so integers stay integers (parsing them together with the strings
+# would have turned them into floats).
+def _mix_numbers_and_strings(raw, failed):
+    result = raw.to_numpy(dtype=object).copy()
+    parsed = ~failed
+    if parsed.any():
+        result[parsed] = pd.to_numeric(raw[parsed]).to_numpy(dtype=object)
+    return result
+
+# Infers a typed array for a column that doesn't exist yet: numbers if every value parses,
+# bools if every value is true/false, otherwise a mix where each value keeps its own type.
+@instrumented("cast")
+def infer_new_column_values(values):
+    raw = pd.Series(values, dtype=object)
+    numeric = pd.to_numeric(raw, errors="coerce")
+    failed = numeric.isna().to_numpy() & (raw != "").to_numpy()
+    if not failed.any():
+        return numeric.to_numpy()
+    lower = raw.str.lower()
+    is_bool = lower.isin(['true', 'false']).to_numpy()
+    if is_bool.all():
+        return (lower == 'true').to_numpy()
+    result = _mix_numbers_and_strings(raw, failed)
+    bool_cells = failed & is_bool
+    result[bool_cells] = (lower == 'true').to_numpy()[bool_cells]
+    return result
+
+# Default fill for existing columns a new row doesn't mention: 0 for numeric (and bool)
+# columns, empty string otherwise.
+def default_column_values(series, row_count):
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return np.zeros(row_count, dtype=np.int64)
+    return np.full(row_count, "", dtype=object)
+
+# --- Compiled condition engine -------------------------------------------------------------
+# update, delete and search_exact share one condition syntax (col=val, col=>=5, name=*foo*,
+# x=nan, ...). Conditions are compiled once into typed predicates for the columns' dtypes and
+# the plans are cached per (condition text, schema). Multi-column plans are evaluated most
+# selective predicate first, and each later predicate only looks at rows that survived.
+
+NULL_VALUE_STRINGS = ('nan', 'na', '<na>', 'none', '')
+PLAN_CACHE_SIZE = 256  # Compiled plans kept in the LRU cache.
+SELECTIVITY_SAMPLE_ROWS = 2048  # Rows sampled to estimate a predicate's selectivity.
+_plan_cache = OrderedDict()
+_plan_cache_lock = threading.Lock()
+
+# Relative per-row evaluation cost of each predicate kind. Together with the estimated
+# selectivity it decides evaluation order (cost / (1 - selectivity), cheapest-to-filter first).
+_PREDICATE_COST = {"isna": 1, "eq": 1, "bool": 1, "range": 1, "ne": 1,
+                   "str_eq": 8, "startswith": 20, "endswith": 20, "contains": 40}
+
+# Converts a comparison result (numpy or nullable boolean) into a plain bool array, NA as False.
+def _as_bool_array(result):
+    if isinstance(result, pd.Series):
+        return result.to_numpy(dtype=bool, na_value=False)
+    return np.asarray(result, dtype=bool)
+
+# Returns True if every non-null value of an object column is already a str, in which case
+# string predicates can run on it directly instead of on an astype(str) copy.
+def _is_pure_string(series):
+    return pd.api.types.infer_dtype(series, skipna=True) in ("string", "empty")
+
+# One compiled condition on one column.
+class Predicate:
+    __slots__ = ("column", "kind", "op", "operand", "text")
+
+    def __init__(self, column, kind, op, operand, text):
+        self.column = column
+        self.kind = kind  # Shape of the test, used for cost estimates.
+        self.op = op  # Evaluator: isna, cmp, bool, bool_str, str, str_fallback.
+        self.operand = operand
+        self.text = text  # The original condition value, e.g. ">=5".
+
+    # Per-row cost estimate; string tests on object columns cost more than numeric compares.
+    @property
+    def cost(self):
+        if self.op == "str" and self.kind == "eq":
+            return _PREDICATE_COST["str_eq"]
+        return _PREDICATE_COST.get(self.kind, 8)
+
+    # Evaluates the predicate over a column (or a subset of it) and returns a bool array.
+    def evaluate(self, series):
+        if self.op == "isna":
+            return series.isna().to_numpy()
+        if self.op == "cmp":
+            symbol, value = self.operand
+            return _as_bool_array(_COMPARATORS[symbol](series, value))
+        if self.op == "bool":
+            return _as_bool_array(series == self.operand)
+        if self.op == "bool_str":
+            return _as_bool_array(series.astype(str).str.lower() == self.operand)
+        if self.op == "str_fallback":
+            return _as_bool_array(series.astype(str) == self.operand)
+        # String predicates. Categorical columns are tested once per category and mapped
+        # through the codes; object columns skip astype(str) when they hold only strings.
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            categories = pd.Series(series.cat.categories.astype(str))
+            lookup = np.append(self._match_strings(categories), False)  # Code -1 (missing) -> False.
+            return lookup[series.cat.codes.to_numpy()]
+        if series.dtype == object and not _is_pure_string(series):
+            series = series.astype(str)
+        return self._match_strings(series)
+
+    def _match_strings(self, str_series):
+        method, value = self.operand
+        if method == "eq":
+            return _as_bool_array(str_series == value)
+        if method == "contains":
+            return _as_bool_array(str_series.str.contains(value, case=True, na=False))
+        return _as_bool_array(getattr(str_series.str, method)(value, na=False))
+
+
+# Numeric comparison operators, longest prefix first.
+_NUMERIC_OPERATORS = (('>=', "range"), ('<=', "range"), ('>', "range"), ('<', "range"), ('!=', "ne"))
+_COMPARATORS = {'>=': operator.ge, '<=': operator.le, '>': operator.gt, '<': operator.lt,
+                '!=': operator.ne, '==': operator.eq}
+
+# Compiles one condition value for a column of the given dtype.
+def compile_predicate(column, val_str, dtype):
+    val_str = str(val_str)
+    val_str_lower = val_str.lower()
+    # Handle null/empty string conditions.
+    if val_str_lower in NULL_VALUE_STRINGS:
+        return Predicate(column, "isna", "isna", None, val_str)
+    try:
+        if pd.api.types.is_bool_dtype(dtype):
+            # Boolean comparisons; anything that isn't clearly a bool falls back to a string match.
+            if val_str_lower in TRUE_STRINGS:
+                return Predicate(column, "bool", "bool", True, val_str)
+            if val_str_lower in FALSE_STRINGS:
+                return Predicate(column, "bool", "bool", False, val_str)
+            return Predicate(column, "bool", "bool_str", val_str_lower, val_str)
+        if pd.api.types.is_numeric_dtype(dtype):
+            # Numeric comparisons (>, <, >=, <=, !=, ==).
+            for symbol, kind in _NUMERIC_OPERATORS:
+                if val_str.startswith(symbol):
+                    return Predicate(column, kind, "cmp", (symbol, pd.to_numeric(val_str[len(symbol):])), val_str)
+            return Predicate(column, "eq", "cmp", ("==", pd.to_numeric(val_str)), val_str)
+    except ValueError:
+        # The value doesn't parse for the column's type: compare string representations.
+        return Predicate(column, "str_eq", "str_fallback", val_str, val_str)
+    # String/object columns: contains, startswith, endswith or exact match.
+    if val_str.startswith('*') and val_str.endswith('*'):
+        return Predicate(column, "contains", "str", ("contains", val_str.strip('*')), val_str)
+    if val_str.startswith('*'):
+        return Predicate(column, "endswith", "str", ("endswith", val_str[1:]), val_str)
+    if val_str.endswith('*'):
+        return Predicate(column, "startswith", "str", ("startswith", val_str[:-1]), val_str)
+    return Predicate(column, "eq", "str", ("eq", val_str), val_str)
+
+
+# A compiled set of AND-ed conditions.
+class ConditionPlan:
+    def __init__(self, predicates):
+        self.predicates = predicates
+
+    # Orders predicates by cost / (1 - selectivity), with selectivity measured on an evenly
+    # spaced sample of rows, so cheap and highly selective predicates shrink the row set first.
+    # Predicates answered by an index cost next to nothing and always go first.
+    def _ordered(self, df, indexes):
+        if len(self.predicates) < 2:
+            return self.predicates
+        if len(df) <= SELECTIVITY_SAMPLE_ROWS:
+            return sorted(self.predicates, key=lambda p: p.cost)
+        sample = np.linspace(0, len(df) - 1, SELECTIVITY_SAMPLE_ROWS).astype(np.int64)
+        scores = {}
+        for p in self.predicates:
+            if p.column in indexes and p.kind in _INDEXABLE_KINDS:
+                scores[id(p)] = 0.0
+                continue
+            try:
+                selectivity = p.evaluate(df[p.column].take(sample)).mean()
+            except Exception:
+                selectivity = 1.0
+            scores[id(p)] = p.cost / max(1.0 - selectivity, 1e-3)
+        return sorted(self.predicates, key=lambda p: scores[id(p)])
+
+    # Returns the sorted row positions matching every predicate. Predicates are answered from
+    # a secondary index when df is an unmodified dataset frame with a current index on the column.
+    @instrumented("filter")
+    def positions(self, df):
+        indexes = indexes_for_frame(df)
+        positions = None
+        for p in self._ordered(df, indexes):
+            if p.kind in _INDEXABLE_KINDS:
+                note_column_use(p.column, df)
+            matched = indexes[p.column].lookup(p) if p.column in indexes else None
+            if matched is not None:
+                positions = matched if positions is None else np.intersect1d(positions, matched, assume_unique=True)
+            elif positions is None:
+                count_metric("moderndb_rows_scanned_total", len(df), scan="condition")
+                positions = parallel_scan(df, [p.column], "predicate", p, "condition")
+                if positions is None:
+                    positions = np.flatnonzero(p.evaluate(df[p.column]))
+            else:
+                count_metric("moderndb_rows_scanned_total", len(positions), scan="condition")
+                positions = positions[p.evaluate(df[p.column].take(positions))]
+            if positions.size == 0:
+                break
+        if positions is None:
+            return np.arange(len(df))
+        return positions
+
+    # Returns a boolean mask Series aligned with df.
+    def mask(self, df):
+        mask = np.zeros(len(df), dtype=bool)
+        mask[self.positions(df)] = True
+        return pd.Series(mask, index=df.index)
+
+
+# Compiles (or fetches from the plan cache) the plan for a {column: value} condition dict.
+# All columns must exist in df. The cache key includes the dtypes of the referenced columns,
+# so a schema change recompiles the plan.
+def compile_conditions(conditions, df):
+    key = tuple((col, str(val), str(df[col].dtype)) for col, val in conditions.items())
+    with _plan_cache_lock:
+        plan = _plan_cache.get(key)
+        if plan is not None:
+            _plan_cache.move_to_end(key)
+            return plan
+    plan = ConditionPlan([compile_predicate(col, val, df[col].dtype) for col, val in conditions.items()])
+    with _plan_cache_lock:
+        _plan_cache[key] = plan
+        if len(_plan_cache) > PLAN_CACHE_SIZE:
+            _plan_cache.popitem(last=False)
+    return plan
+
+# --- Parallel partitioned scans ---------------------------------------------------------------
+# Full-column condition scans (a plan's first predicate, when no index answers it) and the search
+# fallback scan are split into row partitions and run on a pool of worker processes once a table
+# has PARALLEL_SCAN_MIN_ROWS rows. Workers never receive pickled copies of the data: the scanned
+# columns of the table's current dataset version are exported once into a scan snapshot, a
+# directory of .npy files (on /dev/shm where available) that every worker memory-maps, and a
+# task only names its row range. A worker rebuilds its slice of each column with the exact dtype
+# and values and runs the same predicate or search code as a serial scan, so results don't depend
+# on the path taken; the partial results are merged in row order. Columns a snapshot can't hold,
+# frames that aren't the table's current version and pool failures fall back to a serial scan.
+
+PARALLEL_SCAN_WORKERS = int(os.environ.get("MODERNDB_PARALLEL_SCAN_WORKERS", os.cpu_count() or 1))  # 0 or 1 disables
+PARALLEL_SCAN_MIN_ROWS = int(os.environ.get("MODERNDB_PARALLEL_SCAN_MIN_ROWS", 1000000))  # Smaller tables are scanned serially
+PARALLEL_SCAN_PARTITION_ROWS = 100000  # Rows per partition at least, so tasks aren't dominated by overhead
+_scan_pool = None
+_scan_pool_lock = threading.Lock()
+_scan_snapshot_lock = threading.Lock()  # Guards every table's scan_snapshot and the snapshots' users
+_scan_root = None  # Directory holding this process's scan snapshots
+parallel_scan_stats = {"scans": 0, "partitions": 0, "exports": 0, "fallbacks": 0}
+
+# The exported columns of one dataset version of a table. Columns are exported on first use.
+class ScanSnapshot:
+    def __init__(self, version):
+        self.version = version
+        self.path = tempfile.mkdtemp(prefix=f"v{version}-", dir=_scan_snapshot_root())
+        self.columns = {}  # column -> spec (file, kind, dtype), or None if it can't be exported
+        self.bytes = 0
+        self.users = 0  # Scans using the snapshot; its files are removed once retired and unused
+        self.retired = False
+        self.lock = threading.Lock()
+
+    # Returns the spec of a column, exporting series on first use (None if its dtype isn't supported).
+    def column(self, name, series):
+        with self.lock:
+            if name not in self.columns:
+                with timed("scan_export"):
+                    self.columns[name] = self._export(f"c{len(self.columns)}", series)
+                parallel_scan_stats["exports"] += 1
+            return self.columns[name]
+
+    def _save(self, file_name, array):
+        np.save(os.path.join(self.path, file_name + ".npy"), array, allow_pickle=False)
+        self.bytes += array.nbytes
+
+    def _save_lookup(self, file_name, values):
+        with open(os.path.join(self.path, file_name + ".pkl"), "wb") as f:
+            pickle.dump(values, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # Mirrors ColumnarStorage._encode_column, except that dictionary-encoded values keep their
+    # exact objects (including each kind of missing value) instead of being stringified.
+    def _export(self, file_name, series):
+        dtype = series.dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            self._save(file_name, series.cat.codes.to_numpy())
+            self._save_lookup(file_name, dtype)
+            return {"file": file_name, "kind": "category"}
+        if isinstance(series.array, (pd.arrays.IntegerArray, pd.arrays.FloatingArray, pd.arrays.BooleanArray)):
+            self._save(file_name, series.array._data)
+            self._save(file_name + ".mask", series.array._mask)
+            return {"file": file_name, "kind": "masked", "dtype": dtype}
+        if isinstance(dtype, pd.DatetimeTZDtype):
+            self._save(file_name, series.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy())
+            return {"file": file_name, "kind": "datetimetz", "dtype": dtype}
+        if isinstance(dtype, np.dtype) and dtype.kind in "biufcmM":
+            self._save(file_name, series.to_numpy())
+            return {"file": file_name, "kind": "numpy"}
+        if dtype != object and not isinstance(dtype, pd.StringDtype):
+            return None
+        values = series.to_numpy(dtype=object)
+        codes, uniques = pd.factorize(values, use_na_sentinel=True)
+        codes = codes.astype(np.int32)
+        lookup = list(uniques)
+        missing = np.flatnonzero(codes == -1)
+        if len(missing):
+            # factorize folds every missing value into -1; give each kind (None, nan, pd.NA, ...)
+            # its own slot so the rebuilt slice holds the same objects.
+            slots = {}
+            for position in missing:
+                value = values[position]
+                slot = slots.get(type(value))
+                if slot is None:
+                    slot = slots[type(value)] = len(lookup)
+                    lookup.append(value)
+                codes[position] = slot
+        self._save(file_name, codes)
+        self._save_lookup(file_name, lookup)
+        return {"file": file_name, "kind": "dictionary", "dtype": dtype}
+
+def _scan_snapshot_root():
+    global _scan_root
+    if _scan_root is None:
+        shm = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+        _scan_root = tempfile.mkdtemp(prefix="moderndb-scan-", dir=shm)
+        atexit.register(shutil.rmtree, _scan_root, True)
+    return _scan_root
+
+# Returns the table's snapshot for version, creating it if needed, and registers a user of it.
+# Returns None if version is no longer the table's current one.
+def _acquire_scan_snapshot(table, version):
+    with _scan_snapshot_lock:
+        if version != table.version:
+            return None
+        snapshot = table.scan_snapshot
+        if snapshot is None or snapshot.version != version:
+            if snapshot is not None:
+                snapshot.retired = True
+                if snapshot.users == 0:
+                    shutil.rmtree(snapshot.path, ignore_errors=True)
+            snapshot = table.scan_snapshot = ScanSnapshot(version)
+        snapshot.users += 1
+        return snapshot
+
+def _release_scan_snapshot(snapshot):
+    with _scan_snapshot_lock:
+        snapshot.users -= 1
+        remove = snapshot.retired and snapshot.users == 0
+    if remove:
+        shutil.rmtree(snapshot.path, ignore_errors=True)
+
+# Drops a table's scan snapshot (its version was superseded or the table was evicted). The
+# files stay until the scans using them finish.
+def retire_scan_snapshot(table):
+    with _scan_snapshot_lock:
+        snapshot, table.scan_snapshot = table.scan_snapshot, None
+        if snapshot is None:
+            return
+        snapshot.retired = True
+        remove = snapshot.users == 0
+    if remove:
+        shutil.rmtree(snapshot.path, ignore_errors=True)
+
+def _scan_executor():
+    global _scan_pool
+    with _scan_pool_lock:
+        if _scan_pool is None:
+            # spawn: the server process has threads holding locks that a forked worker would inherit.
+            _scan_pool = concurrent.futures.ProcessPoolExecutor(max_workers=PARALLEL_SCAN_WORKERS,
+                                                                mp_context=multiprocessing.get_context("spawn"))
+        return _scan_pool
+
+# Runs a scan over df's columns on the worker pool and returns the sorted matching positions,
+# or None if the scan has to run serially. task is "predicate" (argument: a Predicate) or
+# "search" (argument: the keyword, matched against every column given).
+def parallel_scan(df, columns, task, argument, scan):
+    global _scan_pool
+    n_rows = len(df)
+    if PARALLEL_SCAN_WORKERS < 2 or n_rows < max(PARALLEL_SCAN_MIN_ROWS, 2 * PARALLEL_SCAN_PARTITION_ROWS):
+        return None
+    version = frame_version(df)
+    table = current_table()
+    snapshot = _acquire_scan_snapshot(table, version) if version is not None else None
+    if snapshot is None:
+        return None
+    try:
+        specs = {}
+        for col in columns:
+            specs[col] = snapshot.column(col, df[col])
+            if specs[col] is None:
+                return None
+        partitions = min(PARALLEL_SCAN_WORKERS, n_rows // PARALLEL_SCAN_PARTITION_ROWS)
+        bounds = np.linspace(0, n_rows, partitions + 1).astype(np.int64)
+        with timed("parallel_scan"):
+            pool = _scan_executor()
+            futures = [pool.submit(_scan_partition, snapshot.path, specs, int(start), int(stop), task, argument)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            positions = np.concatenate([future.result() for future in futures])
+    except Exception as e:
+        app.logger.exception("Parallel %s scan failed, scanning serially", scan)
+        parallel_scan_stats["fallbacks"] += 1
+        if isinstance(e, concurrent.futures.BrokenExecutor):
+            with _scan_pool_lock:
+                _scan_pool = None  # A worker died; start a new pool next time.
+        return None
+    finally:
+        _release_scan_snapshot(snapshot)
+    parallel_scan_stats["scans"] += 1
+    parallel_scan_stats["partitions"] += partitions
+    count_metric("moderndb_scan_partitions_total", partitions, scan=scan)
+    return positions
+
+# Memory-mapped arrays of the snapshot columns a worker process has opened, most recent last.
+_worker_columns = OrderedDict()  # (snapshot path, file) -> (values, mask or lookup)
+WORKER_COLUMNS_KEPT = 32
+
+def _snapshot_arrays(path, spec):
+    key = (path, spec["file"])
+    arrays = _worker_columns.get(key)
+    if arrays is not None:
+        _worker_columns.move_to_end(key)
+        return arrays
+    base = os.path.join(path, spec["file"])
+    extra = None
+    if spec["kind"] == "masked":
+        extra = np.load(base + ".mask.npy", mmap_mode="r")
+    elif spec["kind"] in ("category", "dictionary"):
+        with open(base + ".pkl", "rb") as f:
+            extra = pickle.load(f)
+        if spec["kind"] == "dictionary":
+            lookup = np.empty(len(extra), dtype=object)
+            lookup[:] = extra
+            extra = lookup
+    arrays = _worker_columns[key] = (np.load(base + ".npy", mmap_mode="r"), extra)
+    while len(_worker_columns) > WORKER_COLUMNS_KEPT:
+        _worker_columns.popitem(last=False)
+    return arrays
+
+# Rebuilds rows start:stop of an exported column as a Series of the original dtype.
+def _snapshot_slice(path, spec, start, stop):
+    values, extra = _snapshot_arrays(path, spec)
+    values = values[start:stop]
+    kind = spec["kind"]
+    if kind == "numpy":
+        return pd.Series(values, copy=False)
+    if kind == "masked":
+        return pd.Series(spec["dtype"].construct_array_type()(values, extra[start:stop]))
+    if kind == "datetimetz":
+        return pd.Series(values).dt.tz_localize("UTC").dt.tz_convert(spec["dtype"].tz)
+    if kind == "category":
+        return pd.Series(pd.Categorical.from_codes(values, dtype=extra))
+    decoded = extra[values]
+    if isinstance(spec["dtype"], pd.StringDtype):
+        return pd.Series(pd.array(decoded, dtype=spec["dtype"]))
+    return pd.Series(decoded, dtype=object)
+
+# Worker task: scans rows start:stop of a snapshot and returns the matching positions.
+def _scan_partition(path, specs, start, stop, task, argument):
+    if task == "predicate":
+        matched = argument.evaluate(_snapshot_slice(path, specs[argument.column], start, stop))
+    else:
+        matched = np.zeros(stop - start, dtype=bool)
+        for spec in specs.values():
+            matched |= _search_column(_snapshot_slice(path, spec, start, stop), argument)
+    return np.flatnonzero(matched) + start
+
+# --- Out-of-core tables ----------------------------------------------------------------------
+# A table whose store (plus write-ahead log) takes more than OUT_OF_CORE_MB on disk and isn't
+# resident anyway is never loaded whole by list, columns, search, search_exact, update and
+# delete, by /api/rows or by /export: they stream the stored rows in chunks of
+# OUT_OF_CORE_CHUNK_ROWS, replaying the logged mutations not yet compacted into the store on
+# every chunk. Query results keep only their row count and the preview rows a TableResult shows,
+# and update, delete and log compaction write the new store chunk by chunk through a storage
+# writer, so memory use follows the chunk size rather than the table size. Other commands still
+# load the table, which then stays resident (and is served from memory) until the pool evicts it.
+
+OUT_OF_CORE_MB = int(os.environ.get("MODERNDB_OUT_OF_CORE_MB", 2048))  # Stored size from which tables are streamed; 0 disables
+OUT_OF_CORE_CHUNK_ROWS = int(os.environ.get("MODERNDB_OUT_OF_CORE_CHUNK_ROWS", 100000))  # Rows per streamed chunk
+OUT_OF_CORE_COMMANDS = {"list", "columns", "search", "search_exact", "update", "delete"}
+out_of_core_stats = {"commands": 0, "chunks": 0, "rewrites": 0}
+
+# Whether commands on table stream its stored rows instead of loading them.
+def is_out_of_core(table):
+    if OUT_OF_CORE_MB <= 0 or table.cache["df"] is not None:
+        return False
+    stored = table.storage.stored_bytes() + (table.wal.size() if table.wal else 0)
+    return stored > OUT_OF_CORE_MB * 1024 * 1024
+
+# Returns (rows, column names) of a table without streaming its rows: the shape of the base store
+# (the CSV backend counts its rows once) adjusted by the logged records not yet compacted into
+# it. Cached until the store or the log changes.
+def table_shape(table):
+    signature = (table.storage.signature(), table.wal.signature() if table.wal else None)
+    cached = table.stored_shape
+    if cached is not None and cached[0] == signature:
+        return cached[1], list(cached[2])
+    rows, columns = table.storage.stored_shape()
+    if table.wal is not None:
+        checkpoint_seq = table.storage.checkpoint_seq()
+        table.wal.sync_seq(checkpoint_seq)
+        for record in table.wal.read_records(after_seq=checkpoint_seq):
+            if record["op"] == "append":
+                rows += len(record["rows"])
+                added = record["rows"].columns
+            elif record["op"] == "delete":
+                rows -= len(record["positions"])
+                added = ()
+            else:
+                added = record["columns"]
+            columns += [str(col) for col in added if str(col) not in columns]
+    table.stored_shape = (signature, rows, columns)
+    return rows, list(columns)
+
+# Returns (dataset version, iterator over (offset, chunk)) for the current table's rows. Chunks
+# hold chunk_rows rows of the base store with the write-ahead log records not yet compacted into
+# it replayed on them, followed by the rows the records appended. start skips the base rows
+# before it when there is nothing to replay (chunks then start at offset start).
+def stream_table(chunk_rows=None, start=0):
+    table = current_table()
+    chunk_rows = chunk_rows or OUT_OF_CORE_CHUNK_ROWS
+    with _data_lock:  # The base generation and the log records of the same moment.
+        records = []
+        if table.wal is not None:
+            checkpoint_seq = table.storage.checkpoint_seq()
+            table.wal.sync_seq(checkpoint_seq)
+            records = table.wal.read_records(after_seq=checkpoint_seq)
+        if records:
+            start = 0
+        _, base = table.storage.read_chunks(chunk_rows, start)
+        version = table.version
+    return version, _replay_chunks(base, records, chunk_rows, start)
+
+# Yields (offset, chunk) for the base chunks with every record replayed on them, then for the
+# rows each append record added, with the records after it replayed. offsets[i] is where the next
+# chunk starts in the table as it was before record i, which is what record i's positions refer
+# to. Appended rows get the compact dtypes of the base columns (see _align_appended_rows), and
+# every chunk gets the column order of the first.
+def _replay_chunks(base, records, chunk_rows, start):
+    offsets = [start] * (len(records) + 1)
+    columns, schema = None, None
+    def replay(chunk, stage):
+        nonlocal columns
+        for i in range(stage, len(records)):
+            begin = offsets[i]
+            offsets[i] += len(chunk)
+            chunk = _replay_record(chunk, records[i], begin)
+        out_of_core_stats["chunks"] += 1
+        count_metric("moderndb_rows_scanned_total", len(chunk), scan="out_of_core")
+        if columns is None:
+            columns = list(chunk.columns)
+        elif list(chunk.columns) != columns:
+            chunk = chunk.reindex(columns=columns)
+        offset = offsets[-1]
+        offsets[-1] += len(chunk)
+        return offset, chunk
+    for chunk in base:
+        if schema is None:
+            schema = chunk.iloc[:0].copy()
+        yield replay(chunk, 0)
+    for i, record in enumerate(records):
+        if record["op"] != "append":
+            continue
+        rows = record["rows"] if schema is None else _align_appended_rows(schema, record["rows"])
+        for begin in range(0, len(rows), chunk_rows):
+            yield replay(rows.iloc[begin:begin + chunk_rows].reset_index(drop=True), i + 1)
+
+# Applies one write-ahead log record to a chunk whose first row is at position start of the table
+# the record was logged against, as apply_wal_record does to a whole frame.
+def _replay_record(chunk, record, start):
+    op = record["op"]
+    if op == "append":
+        for col in record["rows"].columns:
+            if col not in chunk.columns:
+                chunk[col] = None
+        return chunk
+    positions = np.asarray(record["positions"])
+    selected = (positions >= start) & (positions < start + len(chunk))
+    local = positions[selected] - start
+    if op == "delete":
+        return chunk.drop(chunk.index[local]).reset_index(drop=True) if len(local) else chunk
+    for col, change in record["columns"].items():
+        if "column" in change:
+            chunk[col] = change["column"][start:start + len(chunk)]
+        elif len(local):
+            _assign_values(chunk, local, col, np.asarray(change["values"])[selected])
+    return chunk
+
+# Returns the positions in chunk of the rows matching every condition ({column: value}).
+@instrumented("filter")
+def _chunk_positions(conditions, chunk):
+    matched = np.ones(len(chunk), dtype=bool)
+    for p in compile_conditions(conditions, chunk).predicates:
+        matched &= p.evaluate(chunk[p.column])
+    return np.flatnonzero(matched)
+
+# Returns the dtype a streamed column must be written with once chunks of dtypes current and found
+# are combined, as concatenating them would: integers widen to the wider integer, mixed numbers
+# to float, anything else to object; categoricals that only differ in categories stay categorical.
+# found is None for a chunk holding nothing but missing values, which turns integers into floats
+# and bools into objects; current is None while only such chunks were seen.
+def _settle_chunk_dtype(current, found):
+    if current is None:
+        return found
+    if found is None:
+        if isinstance(current, np.dtype) and current.kind in "iub":
+            return np.dtype(np.float64) if current.kind != "b" else np.dtype(object)
+        return current
+    if same_column_dtype(current, found):
+        return current
+    numpy_dtypes = [getattr(dtype, "numpy_dtype", dtype) for dtype in (current, found)]
+    if all(isinstance(dtype, np.dtype) and dtype.kind in "iuf" for dtype in numpy_dtypes):
+        common = np.result_type(*numpy_dtypes)
+        if isinstance(current, np.dtype) and isinstance(found, np.dtype):
+            return common
+        # A nullable column stays nullable: Int8 and int64 chunks make Int64, Int64 and float64 Float64.
+        return pd.api.types.pandas_dtype({"i": "Int", "u": "UInt", "f": "Float"}[common.kind] + str(common.itemsize * 8))
+    return _widen_upload_dtype(current, found)
+
+# Streams the current table through transform(chunk) -> (new chunk, rows matched) into a new store
+# and returns (writer, rows matched, columns); the caller commits the writer or aborts it. Chunks are written
+# with the dtypes settled so far. When a later chunk widens a column, the remaining chunks are only
+# transformed to settle the final dtypes, and the table is streamed again from the start, as
+# ingest_csv does with uploads. The new store keeps the old one's compact flag.
+@instrumented("stream_rewrite")
+def _rewrite_streamed(transform):
+    storage = current_table().storage
+    compact = storage.is_compact()
+    dtypes, null_columns = {}, set()
+    while True:
+        writer, matched, settled = None, 0, True
+        try:
+            for _, chunk in stream_table()[1]:
+                chunk, count = transform(chunk)
+                matched += count
+                for col in chunk.columns:
+                    series = chunk[col]
+                    if series.dtype == object:
+                        series = chunk[col] = _normalize_object_column(series)
+                    found = None if series.dtype == object and series.isna().all() else series.dtype
+                    if found is None:
+                        null_columns.add(col)
+                    dtype = _settle_chunk_dtype(dtypes.get(col), found)
+                    if col in null_columns:
+                        dtype = _settle_chunk_dtype(dtype, None)
+                    if col in dtypes and not same_column_dtype(dtype, dtypes[col]) and writer is not None:
+                        settled = False
+                    dtypes[col] = dtype
+                if not settled:
+                    continue  # Keep streaming only to settle the dtypes of every column.
+                for col, dtype in dtypes.items():
+                    if dtype is not None and not same_column_dtype(chunk[col].dtype, dtype):
+                        chunk[col] = chunk[col].astype(dtype)
+                if writer is None:
+                    writer = storage.open_writer(list(chunk.columns), compact)
+                writer.append(chunk)
+            if settled:
+                return writer if writer is not None else storage.open_writer([], compact), matched, list(dtypes)
+        except Exception:
+            if writer is not None:
+                writer.abort()
+            raise
+        writer.abort()
+        app.logger.info("Out-of-core rewrite widened dtypes, streaming again: %s", dtypes)
+
+# Publishes a store written by _rewrite_streamed (see commit_writer) and remembers its shape.
+def _commit_streamed(writer, columns):
+    table = current_table()
+    commit_writer(writer)
+    out_of_core_stats["rewrites"] += 1
+    columns = [str(col) for col in columns]
+    table.stored_shape = ((table.storage.signature(), table.wal.signature() if table.wal else None), writer.rows, columns)
+
+# Folds the current table's write-ahead log into a new base by streaming it, on the dataset writer
+# so that no mutation lands in between (see compact_wal).
+def _compact_streamed():
+    _flush_pending_mutations()
+    table = current_table()
+    checkpoint_seq = table.storage.checkpoint_seq()
+    if table.wal.sync_seq(checkpoint_seq) <= checkpoint_seq:
+        return False
+    writer, _, columns = _rewrite_streamed(lambda chunk: (chunk, 0))
+    _commit_streamed(writer, columns)
+    table.wal_stats["compactions"] += 1
+    return True
+
+# Collects rows streamed in chunks into what a TableResult needs: their count and the first and
+# last rows of the preview. Rows are copied, so no chunk outlives its iteration.
+class StreamedResult:
+    def __init__(self, limit=None):
+        self.total = 0
+        self.head = None
+        self.tail = None
+        self.limit = limit  # See Command.limit
+
+    def add(self, rows):
+        if not len(rows):
+            return
+        limit = max(2 * TableResult.PREVIEW_ROWS, self.limit or 0)
+        if self.head is None:
+            self.head = rows.iloc[:limit].copy()
+        elif len(self.head) < limit:
+            self.head = pd.concat([self.head, rows.iloc[:limit - len(self.head)]], ignore_index=True)
+        tail = rows.iloc[-TableResult.PREVIEW_ROWS:]
+        self.tail = tail.copy() if self.tail is None else pd.concat([self.tail, tail], ignore_index=True).iloc[-TableResult.PREVIEW_ROWS:]
+        self.total += len(rows)
+
+    # Returns the TableResult of the collected rows, or None if there were none.
+    def result(self, query, version):
+        if self.total == 0:
+            return None
+        if self.limit is not None:
+            shown = self.head.iloc[:self.limit]
+        else:
+            shown = self.head if self.total <= 2 * TableResult.PREVIEW_ROWS else \
+                pd.concat([self.head.iloc[:TableResult.PREVIEW_ROWS], self.tail], ignore_index=True)
+        result = TableResult.from_frame(shown, query=list(query), version=version, limit=self.limit)
+        result.total = self.total
+        return result
+
+# Executes one of OUT_OF_CORE_COMMANDS on the current table by streaming its stored rows, with the
+# messages of _run_command. update and delete must run on the dataset writer.
+def run_streamed_command(command):
+    op, args = command.op, command.args
+    out_of_core_stats["commands"] += 1
+    with timed(f"command {op}", "moderndb_command_seconds", op=op):
+        try:
+            if op == "list":
+                return _stream_list(command.limit)
+            if op == "columns":
+                return _stream_columns()
+            if op == "search":
+                return _stream_search(args["keyword"], command.limit)
+            if op == "search_exact":
+                return _stream_search_exact(args["column"], args["value"], command.limit)
+            if op == "update":
+                return _stream_update(args["conditions"], args["data"])
+            return _stream_delete(args["conditions"], args["confirm"])
+        except Exception as e:
+            return _command_failed(command, e)
+
+# list: the first rows come from the head of the table and, without log records to replay, the
+# last ones straight from its end.
+def _stream_list(limit=None):
+    rows, _ = table_shape(current_table())
+    result = StreamedResult(limit)
+    head_rows = limit or 2 * TableResult.PREVIEW_ROWS
+    version, chunks = stream_table(min(head_rows, OUT_OF_CORE_CHUNK_ROWS))
+    for _, chunk in chunks:
+        result.add(chunk)
+        if result.total >= head_rows:
+            break
+    chunks.close()
+    if limit is not None:
+        result.total = rows
+    elif rows > 2 * TableResult.PREVIEW_ROWS:
+        tail_start = rows - TableResult.PREVIEW_ROWS
+        for offset, chunk in stream_table(start=tail_start)[1]:
+            if offset + len(chunk) > tail_start:
+                result.add(chunk.iloc[max(tail_start - offset, 0):])
+        result.total = rows
+    table_result = result.result(("list",), version)
+    if table_result is None:
+        return Message("No data available. Please upload a CSV file first.", "notice")
+    return table_result
+
+def _stream_columns():
+    dtypes, used, wide, rows, chunks = {}, {}, {}, 0, 0
+    for _, chunk in stream_table()[1]:
+        rows, chunks = rows + len(chunk), chunks + 1
+        for col in chunk.columns:
+            dtypes[col] = _settle_chunk_dtype(dtypes.get(col), chunk[col].dtype)
+            chunk_used, chunk_wide = column_memory(chunk[col])
+            used[col], wide[col] = used.get(col, 0) + chunk_used, wide.get(col, 0) + chunk_wide
+    if not dtypes:
+        return Message("No data loaded. Please upload a CSV file first.", "notice")
+    lines = []
+    for col, dtype in dtypes.items():
+        saved = f", {_format_bytes(wide[col])} uncompacted" if wide[col] > used[col] else ""
+        lines.append(f"{col} ({dtype}): {_format_bytes(used[col])}{saved}")
+    total_used, total_wide = sum(used.values()), sum(wide.values())
+    saving = f" ({1 - total_used / total_wide:.0%} saved)" if total_wide > total_used else ""
+    lines.append(f"Memory: {_format_bytes(total_used)}, {_format_bytes(total_wide)} with default dtypes{saving}")
+    lines.append(f"Out-of-core: {rows} rows streamed in {chunks} chunk(s) from "
+                 f"{_format_bytes(current_table().storage.stored_bytes())} stored; memory is what loading the table would take")
+    return Message(f"Available columns ({len(dtypes)}):\n" + "\n".join(lines), "pre")
+
+def _stream_search(keyword, limit=None):
+    result = StreamedResult(limit)
+    version, chunks = stream_table()
+    for _, chunk in chunks:
+        matched = np.zeros(len(chunk), dtype=bool)
+        for col in chunk.columns:
+            matched |= _search_column(chunk[col], keyword)
+        result.add(chunk.iloc[np.flatnonzero(matched)])
+    table_result = result.result(("search", keyword), version)
+    if table_result is None:
+        return Message(f"No rows found containing '{keyword}'.")
+    return table_result
+
+def _stream_search_exact(col_name, val_str, limit=None):
+    if col_name not in table_shape(current_table())[1]:
+        return Message(f"Error: Column '{col_name}' does not exist.", ok=False)
+    result = StreamedResult(limit)
+    version, chunks = stream_table()
+    for _, chunk in chunks:
+        result.add(chunk.iloc[_chunk_positions({col_name: val_str}, chunk)])
+    table_result = result.result(("search_exact", col_name, val_str), version)
+    if table_result is None:
+        return Message(f"No rows found where '{col_name}' matches '{val_str}'.")
+    return table_result
+
+def _stream_update(conditions, updates):
+    columns = table_shape(current_table())[1]
+    for col_name in conditions:
+        if col_name not in columns:
+            return Message(f"Error: Column '{col_name}' in conditions does not exist.", ok=False)
+    def transform(chunk):
+        positions = _chunk_positions(conditions, chunk)
+        for col_update, val_update_str in updates.items():
+            if col_update not in chunk.columns:
+                chunk[col_update] = None  # Add new column if it doesn't exist.
+            if len(positions):
+                assign_at_positions(chunk, positions, col_update, _attempt_cast_for_assignment(val_update_str, chunk[col_update]))
+        return chunk, len(positions)
+    _flush_pending_mutations()  # Mutations queued earlier in the same writer group are part of the table.
+    writer, matched, columns = _rewrite_streamed(transform)
+    if not matched:
+        writer.abort()
+        return Message("No rows found matching conditions for update.")
+    _commit_streamed(writer, columns)
+    count_metric("moderndb_rows_mutated_total", matched, op="update")
+    return Message(f"Updated {matched} row(s). Conditions: {conditions}, Updates: {updates}")
+
+# delete: without confirm=yes the matches are counted first, so a delete needing confirmation
+# doesn't rewrite anything.
+def _stream_delete(conditions, confirmed):
+    columns = table_shape(current_table())[1]
+    for col_name in conditions:
+        if col_name not in columns:
+            return Message(f"Error: Column '{col_name}' in conditions does not exist.", ok=False)
+    _flush_pending_mutations()
+    if not confirmed:
+        row_count = sum(len(_chunk_positions(conditions, chunk)) for _, chunk in stream_table()[1])
+        if row_count == 0:
+            return Message("No rows found matching conditions for delete.")
+        if row_count > 10:
+            return _confirm_delete_message(conditions, row_count)
+    def transform(chunk):
+        positions = _chunk_positions(conditions, chunk)
+        return (chunk.drop(chunk.index[positions]).reset_index(drop=True) if len(positions) else chunk), len(positions)
+    writer, row_count, columns = _rewrite_streamed(transform)
+    if not row_count:
+        writer.abort()
+        return Message("No rows found matching conditions for delete.")
+    _commit_streamed(writer, columns)
+    count_metric("moderndb_rows_mutated_total", row_count, op="delete")
+    return Message(f"Deleted {row_count} row(s). Conditions: {conditions}", "danger")
+
+# Returns the rows offset..offset+limit of the current table for /api/rows, as (version, frame).
+def read_streamed_rows(offset, limit):
+    version, chunks = stream_table(limit, start=offset)
+    parts = []
+    for chunk_offset, chunk in chunks:
+        if chunk_offset >= offset + limit:
+            break
+        if chunk_offset + len(chunk) > offset:
+            parts.append(chunk.iloc[max(offset - chunk_offset, 0):offset + limit - chunk_offset])
+    chunks.close()
+    return version, pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+# Returns the out-of-core line of the 'cache' command.
+def _describe_out_of_core():
+    if OUT_OF_CORE_MB <= 0:
+        return "\nOut-of-core: off (MODERNDB_OUT_OF_CORE_MB)"
+    stats = out_of_core_stats
+    state = "streamed" if is_out_of_core(current_table()) else "in memory"
+    return (f"\nOut-of-core: tables over {OUT_OF_CORE_MB} MB stored are streamed in chunks of {OUT_OF_CORE_CHUNK_ROWS} rows "
+            f"(this one: {state}); {stats['commands']} commands, {stats['chunks']} chunks, {stats['rewrites']} rewrites")
+
+
+# --- Secondary indexes -----------------------------------------------------------------------
+# A ColumnIndex keeps a column's non-null row positions sorted by value. Range (>, <, >=, <=)
+# and prefix* conditions become two searchsorted calls on it, and equality goes through a hash
+# table over its distinct values, so lookups don't scan the column. Indexes belong to one
+# dataset version: log_mutation() carries them forward record by record, anything else
+# (uploads, external edits) invalidates them and they are rebuilt in the background.
+
+INDEX_AUTO_AFTER = int(os.environ.get("MODERNDB_INDEX_AUTO_AFTER", 3))  # Condition uses before a column is auto-indexed
+INDEX_AUTO_MIN_ROWS = int(os.environ.get("MODERNDB_INDEX_AUTO_MIN_ROWS", 50000))  # Smaller tables are just scanned
+_index_lock = threading.RLock()  # Guards every table's declared_indexes, column_indexes and column_use
+_index_build_queue = queue.Queue()  # (table, column) pairs to (re)build
+_index_builder_thread = None
+_INDEXABLE_KINDS = ("eq", "range", "startswith", "isna", "bool")
+
+# Raised when a column's dtype or contents can't be indexed.
+class NotIndexable(Exception):
+    pass
+
+# Returns the values of the given positions in the form a ColumnIndex stores them.
+def _index_values(series, positions, kind):
+    subset = series.take(positions)
+    if kind == "string":
+        return subset.to_numpy(dtype=object)
+    if pd.api.types.is_extension_array_dtype(subset.dtype):
+        return subset.to_numpy(dtype=subset.dtype.numpy_dtype)  # Nulls are never included.
+    return subset.to_numpy()
+
+# Sorted-order index over one column. Instances are immutable: maintenance returns a new
+# index, so a reader that picked one up keeps a consistent view.
+class ColumnIndex:
+    def __init__(self, column, kind, dtype, version, order, sorted_values, null_positions):
+        self.column = column
+        self.kind = kind  # "numeric" (incl. bool) or "string"
+        self.dtype = dtype  # Column dtype the index was built for.
+        self.version = version  # Dataset version the index reflects.
+        self.order = order  # Row positions of non-null values, sorted by value.
+        self.sorted_values = sorted_values
+        self.null_positions = null_positions
+        self._hash = None  # (Index of distinct values, run starts in sorted order), built lazily.
+
+    @classmethod
+    def build(cls, column, series, version):
+        dtype = series.dtype
+        if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_numeric_dtype(dtype):
+            kind = "numeric"
+        elif dtype == object or isinstance(dtype, (pd.StringDtype, pd.CategoricalDtype)):
+            kind = "string"
+            if not _is_pure_string(series.astype(object) if dtype != object else series):
+                raise NotIndexable(f"column '{column}' mixes strings with other types")
+        else:
+            raise NotIndexable(f"columns of type {dtype} can't be indexed")
+        null = series.isna().to_numpy()
+        valid = np.flatnonzero(~null)
+        values = _index_values(series, valid, kind)
+        order = np.argsort(values, kind="stable")
+        return cls(column, kind, dtype, version, valid[order], values[order], np.flatnonzero(null))
+
+    def _replace(self, version, order, sorted_values, null_positions):
+        return ColumnIndex(self.column, self.kind, self.dtype, version, order, sorted_values, null_positions)
+
+    # Returns a copy without the given (sorted) positions and with later positions shifted down,
+    # matching a delete that renumbers rows.
+    def without_positions(self, positions, version, renumber):
+        keep = ~np.isin(self.order, positions)
+        order = self.order[keep]
+        nulls = self.null_positions[~np.isin(self.null_positions, positions)]
+        if renumber:
+            order = order - np.searchsorted(positions, order)
+            nulls = nulls - np.searchsorted(positions, nulls)
+        return self._replace(version, order, self.sorted_values[keep], nulls)
+
+    # Returns a copy with rows at the given positions inserted from series, merged into the
+    # sorted order with searchsorted rather than re-sorting everything.
+    def with_positions(self, series, positions, version):
+        if self.kind == "string" and not _is_pure_string(series.take(positions).astype(object)):
+            raise NotIndexable(f"column '{self.column}' now mixes strings with other types")
+        null = series.take(positions).isna().to_numpy()
+        new_nulls = np.union1d(self.null_positions, positions[null])
+        valid = positions[~null]
+        values = _index_values(series, valid, self.kind)
+        new_order = np.argsort(values, kind="stable")
+        values, valid = values[new_order], valid[new_order]
+        at = np.searchsorted(self.sorted_values, values, side="right")
+        return self._replace(version, np.insert(self.order, at, valid),
+                             np.insert(self.sorted_values, at, values), new_nulls)
+
+    def _hash_table(self):
+        if self._hash is None:
+            values = self.sorted_values
+            if len(values):
+                starts = np.flatnonzero(values[1:] != values[:-1]) + 1
+                starts = np.concatenate(([0], starts, [len(values)]))
+            else:
+                starts = np.array([0])
+            self._hash = (pd.Index(values[starts[:-1]]), starts)
+        return self._hash
+
+    # Returns sorted row positions where the column equals value (hash lookup).
+    def equal(self, value):
+        distinct, starts = self._hash_table()
+        try:
+            slot = distinct.get_loc(value)
+        except (KeyError, TypeError):
+            return np.empty(0, dtype=np.int64)
+        return np.sort(self.order[starts[slot]:starts[slot + 1]])
+
+    # Returns sorted row positions for a >, <, >= or <= comparison (binary search).
+    def compare(self, symbol, value):
+        values = self.sorted_values
+        if symbol == ">":
+            lo, hi = np.searchsorted(values, value, side="right"), len(values)
+        elif symbol == ">=":
+            lo, hi = np.searchsorted(values, value, side="left"), len(values)
+        elif symbol == "<":
+            lo, hi = 0, np.searchsorted(values, value, side="left")
+        else:
+            lo, hi = 0, np.searchsorted(values, value, side="right")
+        return np.sort(self.order[lo:hi])
+
+    # Returns sorted row positions of strings starting with prefix: every match sorts between
+    # the prefix itself and the prefix with its last character incremented.
+    def prefix(self, prefix):
+        values = self.sorted_values
+        if not prefix:
+            return np.sort(self.order)
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        lo = np.searchsorted(values, prefix, side="left")
+        hi = np.searchsorted(values, upper, side="left")
+        return np.sort(self.order[lo:hi])
+
+    # Answers a compiled predicate from the index, or returns None if it can't.
+    def lookup(self, predicate):
+        if predicate.kind == "isna":
+            return self.null_positions
+        if self.kind == "numeric" and predicate.op == "cmp":
+            symbol, value = predicate.operand
+            if symbol == "==":
+                return self.equal(value)
+            if predicate.kind == "range":
+                return self.compare(symbol, value)
+        if self.kind == "numeric" and predicate.op == "bool":
+            return self.equal(predicate.operand)
+        if self.kind == "string" and predicate.op == "str":
+            method, value = predicate.operand
+            if method == "eq":
+                return self.equal(value)
+            if method == "startswith" and (not value or ord(value[-1]) < 0x10FFFF):
+                return self.prefix(value)
+        return None
+
+# Builds (or rebuilds) an index for a column of the current table and registers it.
+def create_index(column):
+    table = current_table()
+    with _data_lock:
+        df = load_data(copy=False)
+        version = table.version
+    if column not in df.columns:
+        raise KeyError(column)
+    index = ColumnIndex.build(column, df[column], version)
+    with _index_lock:
+        table.declared_indexes.add(column)
+        current = table.column_indexes.get(column)
+        if current is None or current.version <= version:
+            table.column_indexes[column] = index
+    return index
+
+# Forgets a column's index and stops maintaining it.
+def drop_index(column):
+    table = current_table()
+    with _index_lock:
+        table.declared_indexes.discard(column)
+        table.column_indexes.pop(column, None)
+        table.column_use.pop(column, None)
+
+# Drops every built index of the current table (after a full save or a reload of changed data).
+# Declared indexes and the search index, if it is in use, are rebuilt in the background for the
+# new data; materialized aggregates on their next read.
+def invalidate_indexes():
+    table = current_table()
+    with _index_lock:
+        table.column_indexes.clear()
+        for column in table.declared_indexes:
+            _schedule_index_build(column)
+    invalidate_search_index()
+    invalidate_materialized_views()
+
+# Carries indexes from old_version to new_version through one write-ahead log record.
+# df is the frame after the mutation. Indexes that can't be maintained are rebuilt.
+def maintain_indexes(df, record, old_version, new_version):
+    column_indexes = current_table().column_indexes
+    with _index_lock:
+        for column, index in list(column_indexes.items()):
+            try:
+                if (index.version != old_version or column not in df.columns
+                        or not same_column_dtype(df[column].dtype, index.dtype)):
+                    raise NotIndexable(column)
+                op = record["op"]
+                if op == "append":
+                    start = len(df) - len(record["rows"])
+                    index = index.with_positions(df[column], np.arange(start, len(df)), new_version)
+                elif op == "delete":
+                    index = index.without_positions(np.sort(record["positions"]), new_version, renumber=True)
+                elif op == "update" and column in record["columns"]:
+                    if "column" in record["columns"][column]:
+                        raise NotIndexable(column)
+                    positions = np.sort(record["positions"])
+                    index = index.without_positions(positions, new_version, renumber=False)
+                    index = index.with_positions(df[column], positions, new_version)
+                else:
+                    index = index._replace(new_version, index.order, index.sorted_values, index.null_positions)
+                column_indexes[column] = index
+            except NotIndexable:
+                column_indexes.pop(column, None)
+                _schedule_index_build(column)
+
+# Returns the indexes usable for df: only if df is the unmodified frame of a known dataset
+# version. Declared indexes missing for the current version are queued for a rebuild.
+def indexes_for_frame(df):
+    version = frame_version(df)
+    if version is None:
+        return {}
+    table = current_table()
+    with _index_lock:
+        usable = {}
+        for column in table.declared_indexes:
+            index = table.column_indexes.get(column)
+            if index is not None and index.version == version:
+                usable[column] = index
+            elif version == table.version:
+                _schedule_index_build(column)
+        return usable
+
+# Counts a condition on a column and declares an automatic index once the column is hot.
+def note_column_use(column, df):
+    table = current_table()
+    with _index_lock:
+        if column in table.declared_indexes:
+            return
+        table.column_use[column] = table.column_use.get(column, 0) + 1
+        if table.column_use[column] >= INDEX_AUTO_AFTER and len(df) >= INDEX_AUTO_MIN_ROWS:
+            table.declared_indexes.add(column)
+            _schedule_index_build(column)
+
+def _schedule_index_build(column):
+    global _index_builder_thread
+    table = current_table()
+    with _index_lock:
+        if _index_builder_thread is None or not _index_builder_thread.is_alive():
+            _index_builder_thread = threading.Thread(target=_index_builder, name="index-builder", daemon=True)
+            _index_builder_thread.start()
+    _index_build_queue.put((table, column))
+
+def _index_builder():
+    while True:
+        table, column = _index_build_queue.get()
+        with _index_lock:
+            index = table.column_indexes.get(column)
+            if table.evicted or column not in table.declared_indexes or (index is not None and index.version == table.version):
+                continue  # Evicted (rebuilt on reload), dropped, or already current (duplicate request).
+        try:
+            with using_table(table):
+                create_index(column)
+        except (KeyError, NotIndexable):
+            with using_table(table):
+                drop_index(column)  # Column removed or no longer indexable.
+        except Exception:
+            app.logger.exception("Building index on %s.%s failed", table.name, column)
+
+# Returns a summary of the current table's declared indexes for the 'index' command.
+def describe_indexes():
+    table = current_table()
+    with _index_lock:
+        rows = []
+        for column in sorted(table.declared_indexes):
+            index = table.column_indexes.get(column)
+            if index is None:
+                rows.append(f"{column}: building")
+            else:
+                state = "current" if index.version == table.version else f"version {index.version}"
+                rows.append(f"{column}: {index.kind}, {len(index.order)} values, "
+                            f"{len(index.null_positions)} nulls ({state})")
+        return rows
+
+# --- Full-text search index --------------------------------------------------------------------
+# 'search' matches rows where any cell's string form contains the keyword, case-insensitively.
+# The index keeps an append-only vocabulary of distinct lower-cased cell strings with trigram
+# and token postings, plus, per column, the vocabulary id of every row's cell. A search finds
+# the matching vocabulary entries from the postings, verifies only those candidates, and maps
+# them back to rows with one gather per column. Like the secondary indexes it belongs to a
+# dataset version, is carried forward by log_mutation() and is rebuilt in the background.
+
+SEARCH_INDEX_SYNC_ROWS = int(os.environ.get("MODERNDB_SEARCH_INDEX_SYNC_ROWS", 20000))  # Build inline below this size
+_TOKEN_RE = re.compile(r"\w+")
+_REGEX_METACHARACTERS = set(".^$*+?{}[]\\|()")
+_search_index_lock = threading.RLock()  # Guards every table's search_index state
+
+# Append-only vocabulary of distinct cell strings with trigram and token postings.
+class SearchVocabulary:
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+        self.trigrams = {}  # trigram -> ids of strings containing it
+        self.tokens = {}  # token -> ids of strings containing it as a whole word
+
+    # Returns the id of a (lower-cased) string, adding it to the vocabulary if needed.
+    def intern(self, text):
+        vocab_id = self.ids.get(text)
+        if vocab_id is None:
+            vocab_id = len(self.strings)
+            self.strings.append(text)
+            self.ids[text] = vocab_id
+            for gram in {text[i:i + 3] for i in range(len(text) - 2)}:
+                self.trigrams.setdefault(gram, []).append(vocab_id)
+            for token in set(_TOKEN_RE.findall(text)):
+                self.tokens.setdefault(token, []).append(vocab_id)
+        return vocab_id
+
+    # Returns the ids of strings containing the (lower-cased) keyword.
+    def matching_ids(self, keyword):
+        if len(keyword) >= 3:
+            # Candidates must contain every trigram of the keyword; start from the rarest.
+            postings = [self.trigrams.get(keyword[i:i + 3]) for i in range(len(keyword) - 2)]
+            if any(p is None for p in postings):
+                return []
+            postings.sort(key=len)
+            candidates = postings[0]
+            if len(postings) > 1 and len(candidates) > 256:
+                candidates = set(candidates).intersection(postings[1])
+            return [i for i in candidates if keyword in self.strings[i]]
+        if keyword and _TOKEN_RE.fullmatch(keyword):
+            # A short word-character keyword can only occur inside a token: scan the tokens,
+            # which are far fewer than the strings.
+            matched = set()
+            for token, ids in list(self.tokens.items()):
+                if keyword in token:
+                    matched.update(ids)
+            return list(matched)
+        return [i for i, text in enumerate(list(self.strings)) if keyword in text]
+
+# Returns (codes, strings) such that strings[codes] is series.astype(str), stringifying each
+# distinct value once. Missing values keep their own spelling ("nan", "None", "NaT", "<NA>").
+def _distinct_strings(series):
+    codes, uniques = pd.factorize(series, use_na_sentinel=True)
+    strings = list(pd.Index(uniques).astype(str))
+    missing = codes == -1
+    if missing.any():
+        missing_codes, missing_strings = pd.factorize(series[missing].astype(str))
+        codes[missing] = missing_codes + len(strings)
+        strings.extend(missing_strings)
+    return codes, strings
+
+# Maps every row of a column to vocabulary ids.
+def _column_vocab_ids(vocab, series):
+    codes, strings = _distinct_strings(series)
+    ids = np.array([vocab.intern(text.lower()) for text in strings], dtype=np.int32)
+    return ids[codes] if len(ids) else np.zeros(len(codes), dtype=np.int32)
+
+# Search index for one dataset version. Instances are immutable apart from the shared,
+# append-only vocabulary, so maintenance swaps in a new instance.
+class SearchIndex:
+    def __init__(self, version, vocab, column_ids, column_dtypes):
+        self.version = version
+        self.vocab = vocab
+        self.column_ids = column_ids  # column -> vocabulary id per row
+        self.column_dtypes = column_dtypes  # column -> dtype the ids were computed for
+
+    @classmethod
+    def build(cls, df, version):
+        vocab = SearchVocabulary()
+        column_ids = {col: _column_vocab_ids(vocab, df[col]) for col in df.columns}
+        return cls(version, vocab, column_ids, {col: df[col].dtype for col in df.columns})
+
+    # Returns a new index carried through one write-ahead log record (df is the frame after it).
+    def apply(self, df, record, version):
+        column_ids, dtypes = dict(self.column_ids), dict(self.column_dtypes)
+        op = record["op"]
+        for col in df.columns:
+            replaced = op == "update" and "column" in record["columns"].get(col, {})
+            if col not in column_ids or not same_column_dtype(df[col].dtype, dtypes[col]) or replaced:
+                # New or replaced column, or a dtype change that alters how every cell stringifies.
+                column_ids[col] = _column_vocab_ids(self.vocab, df[col])
+                dtypes[col] = df[col].dtype
+            elif op == "append":
+                start = len(df) - len(record["rows"])
+                column_ids[col] = np.concatenate([column_ids[col], _column_vocab_ids(self.vocab, df[col].iloc[start:])])
+            elif op == "delete":
+                column_ids[col] = np.delete(column_ids[col], record["positions"])
+            elif op == "update" and col in record["columns"]:
+                positions = record["positions"]
+                ids = column_ids[col].copy()
+                ids[positions] = _column_vocab_ids(self.vocab, df[col].take(positions))
+                column_ids[col] = ids
+        return SearchIndex(version, self.vocab, column_ids, dtypes)
+
+    # Returns the sorted positions of rows with a cell containing keyword.
+    def search(self, keyword):
+        matched = self.vocab.matching_ids(keyword.lower())
+        n_rows = len(next(iter(self.column_ids.values()))) if self.column_ids else 0
+        if not matched:
+            return np.empty(0, dtype=np.int64)
+        hit = np.zeros(len(self.vocab.strings), dtype=bool)
+        hit[matched] = True
+        rows = np.zeros(n_rows, dtype=bool)
+        for ids in self.column_ids.values():
+            rows |= hit[ids]
+        return np.flatnonzero(rows)
+
+# Column-wise fallback used while the index isn't available: each column's distinct values
+# are stringified and tested once, then mapped back to rows. Keywords with regex
+# metacharacters keep the original regex semantics of str.contains. Large tables are scanned
+# in partitions on the worker pool.
+def _scan_search(df, keyword):
+    count_metric("moderndb_rows_scanned_total", len(df), scan="search")
+    positions = parallel_scan(df, list(df.columns), "search", keyword, "search")
+    if positions is not None:
+        return positions
+    rows = np.zeros(len(df), dtype=bool)
+    for col in df.columns:
+        rows |= _search_column(df[col], keyword)
+    return np.flatnonzero(rows)
+
+# Returns which values of a column contain keyword (case-insensitive) in their string form.
+def _search_column(series, keyword):
+    codes, strings = _distinct_strings(series)
+    if not strings:
+        return np.zeros(len(series), dtype=bool)
+    return pd.Series(strings, dtype=object).str.contains(keyword, case=False, na=False).to_numpy()[codes]
+
+# Returns the sorted positions of rows with any cell containing keyword (case-insensitive),
+# using the search index when it matches df's dataset version.
+@instrumented("search")
+def search_rows(df, keyword):
+    literal = not (set(keyword) & _REGEX_METACHARACTERS)
+    if literal:
+        version = frame_version(df)
+        table = current_table()
+        with _search_index_lock:
+            index = table.search_index["index"]
+            table.search_index["wanted"] = True
+        if version is not None and index is not None and index.version == version:
+            return index.search(keyword)
+        if version is not None and version == table.version:
+            if len(df) <= SEARCH_INDEX_SYNC_ROWS:
+                index = SearchIndex.build(df, version)
+                with _search_index_lock:
+                    table.search_index["index"] = index
+                return index.search(keyword)
+            _schedule_search_index_build()
+    return _scan_search(df, keyword)
+
+# Carries the search index through one write-ahead log record, or drops it if it is stale.
+def maintain_search_index(df, record, old_version, new_version):
+    state = current_table().search_index
+    with _search_index_lock:
+        index = state["index"]
+        if index is None:
+            return
+        if index.version != old_version:
+            state["index"] = None
+            return
+        state["index"] = index.apply(df, record, new_version)
+
+# Drops the current table's search index; if searches have used it, a new one is built in the
+# background.
+def invalidate_search_index():
+    state = current_table().search_index
+    with _search_index_lock:
+        state["index"] = None
+        wanted = state["wanted"]
+    if wanted:
+        _schedule_search_index_build()
+
+def _schedule_search_index_build():
+    table = current_table()
+    with _search_index_lock:
+        if table.search_index["building"]:
+            return
+        table.search_index["building"] = True
+    threading.Thread(target=_build_search_index, args=(table,), name=f"search-index-builder-{table.name}",
+                     daemon=True).start()
 
+def _build_search_index(table):
     try:
-        # Attempt casting based on the target column's existing dtype.
-        if pd.api.types.is_integer_dtype(target_dtype):
-            return int(float(value_str))  # Convert to float first to handle "10.0", then to int.
-        elif pd.api.types.is_float_dtype(target_dtype):
-            return float(value_str)
-        elif pd.api.types.is_bool_dtype(target_dtype):
-            val_lower = str(value_str).lower()
-            if val_lower in ['true', '1', 't', 'yes']:
-                return True
-            if val_lower in ['false', '0', 'f', 'no']:
-                return False
-            return str(value_str)  # If not a clear boolean string, keep as string.
-        elif pd.api.types.is_datetime64_any_dtype(target_dtype):
-            return pd.to_datetime(value_str, errors='raise')  # Try parsing as datetime.
-        return str(value_str)  # Default to string if no other type matches.
-    except ValueError:
-        # If any type conversion fails, return the original string value.
-        return str(value_str)
+        with using_table(table):
+            while not table.evicted:  # An evicted table gets a new build when it is reloaded.
+                with _data_lock:
+                    df = load_data(copy=False)
+                    version = table.version
+                index = SearchIndex.build(df, version)
+                with _data_lock, _search_index_lock:
+                    # Only publish an index for the current version; retry if writes raced the build.
+                    if version == table.version and not table.evicted:
+                        table.search_index["index"] = index
+                        return
+    except Exception:
+        app.logger.exception("Building the search index of table %s failed", table.name)
+    finally:
+        with _search_index_lock:
+            table.search_index["building"] = False
 
-# Loads data from the CSV file. Returns an empty DataFrame if the file doesn't exist or is empty.
-def load_data():
-    if os.path.exists(DATA_PATH):
-        try:
-            return pd.read_csv(DATA_PATH)
-        except pd.errors.EmptyDataError:
-            # Handle empty file case
-            return pd.DataFrame()
-    else:
-        return pd.DataFrame()
+# --- Aggregates --------------------------------------------------------------------------------
+# 'aggregate' computes count/sum/avg/min/max per group. An AggregateState keeps, per row, the group
+# the row falls in (-1 when the conditions exclude it) and the aggregated columns' values, and per
+# group the row count and each column's non-null count, sum, min and max, built with vectorized
+# bincounts. A materialized aggregate keeps its state: like the indexes it belongs to a dataset
+# version and is carried forward by log_mutation() record by record, subtracting the rows a record
+# removes or changes and adding the new ones, so reading it doesn't scan the table. Anything else
+# (uploads, full saves, external edits) drops the state and the next read rebuilds it.
 
-# Saves the DataFrame to a CSV file. Creates the 'data' directory if it doesn't exist.
-# If the DataFrame is empty, creates an empty CSV file to maintain consistency
-def save_data(df):
-    os.makedirs("data", exist_ok=True)
-    if df.empty:
-        # Create an empty file when df is empty
-        open(DATA_PATH, 'w').close()
-    else:
-        df.to_csv(DATA_PATH, index=False)
+_AGGREGATE_RE = re.compile(r"^(count|sum|avg|min|max)(?:\((.+)\))?$", re.IGNORECASE)
+_view_lock = threading.RLock()  # Guards every table's materialized_views
 
-# Retrieves the terminal output from the session.
-def get_terminal_output():
-    return session.get("terminal_output", "")
-
-# Appends a message to the terminal output in the session, keeping a maximum number of lines.
-def append_terminal_output(msg, max_lines=50):  # Increased max_lines for better history
-    output = get_terminal_output()
-    output += msg + "<br>"
-    lines = output.split("<br>")
-    # Keep only the last 'max_lines' lines.
-    if len(lines) > max_lines:
-        lines = lines[-max_lines:]
-    session["terminal_output"] = "<br>".join(lines)
+# A parsed aggregate: measures [(function, column or None)], group-by columns and conditions.
+class AggregateSpec:
+    def __init__(self, measures, group_by, conditions):
+        self.measures = measures
+        self.group_by = group_by
+        self.conditions = conditions
+        self.key = (tuple(measures), tuple(group_by), tuple(sorted(conditions.items())))
+        self.value_columns = list(dict.fromkeys(col for _, col in measures if col is not None))
+        self.columns = list(dict.fromkeys(group_by + self.value_columns + list(conditions)))
 
-# Retrieves AI configuration (URL, API key, and model).
-def get_ai_config():
-    # API URL: Env -> Session -> App Default
-    ai_url = os.environ.get("OPENROUTER_API_URL")
-    if not ai_url:
-        ai_url = session.get("api_url")
-    if not ai_url:
-        ai_url = DEFAULT_AI_URL  # Fallback to app default
-    
-    # API Key: Env only - no longer store in session for security
-    api_key = os.environ.get("OPENROUTER_API_KEY", "")
-    if not api_key:
-        api_key = DEFAULT_API_KEY  # Fallback to app default (empty string)
-        
-    # AI Model: Env -> Session -> App Default
-    ai_model = os.environ.get("AI_MODEL")
-    if not ai_model:
-        ai_model = session.get("ai_model")
-    if not ai_model:
-        ai_model = DEFAULT_AI_MODEL  # Fallback to app default
+    def __str__(self):
+        text = " ".join(func if col is None else f"{func}({col})" for func, col in self.measures)
+        if self.group_by:
+            text += " by " + ",".join(shlex.quote(col) for col in self.group_by)
+        if self.conditions:
+            text += " where " + " ".join(shlex.quote(f"{col}={val}") for col, val in self.conditions.items())
+        return text
 
-    return ai_url, api_key, ai_model
+# Parses the arguments of 'aggregate': measures, then optionally 'by col1,col2' and
+# 'where cond1=val1 ...', e.g. count sum(price) by city where age=>30. Raises ValueError.
+def parse_aggregate(tokens):
+    measures, group_by, conditions = [], [], {}
+    section = "measures"
+    for token in tokens:
+        if token.lower() in ("by", "where") and measures:
+            section = token.lower()
+            continue
+        if section == "measures":
+            match = _AGGREGATE_RE.match(token)
+            if match is None:
+                raise ValueError(f"'{token}' is not an aggregate; use count, count(col), sum(col), avg(col), min(col) or max(col)")
+            func, col = match.group(1).lower(), match.group(2)
+            if col is None and func != "count":
+                raise ValueError(f"{func} needs a column, e.g. {func}(price)")
+            measures.append((func, col))
+        elif section == "by":
+            group_by.extend(col for col in token.split(",") if col)
+        else:
+            if "=" not in token:
+                raise ValueError(f"condition '{token}' format is incorrect. Expected 'column=value'")
+            col, val = token.split("=", 1)
+            conditions[col] = val
+    if not measures:
+        raise ValueError("aggregate needs at least one of count, sum(col), avg(col), min(col), max(col)")
+    return AggregateSpec(measures, group_by, conditions)
 
-# Error handler for 413 Request Entity Too Large (file upload exceeds limit).
-@app.errorhandler(413)
-def request_entity_too_large(e):
-    append_terminal_output(f"<div class='text-error'>Upload failed: File is larger than 10MB.</div>")
-    return redirect(url_for("index"))
+# Checks that the aggregate's columns exist in df and that the aggregated ones are numeric.
+def validate_aggregate(spec, df):
+    for col in spec.columns:
+        if col not in df.columns:
+            raise ValueError(f"Column '{col}' does not exist")
+    for func, col in spec.measures:
+        if func != "count" and not pd.api.types.is_numeric_dtype(df[col].dtype):
+            raise ValueError(f"{func}({col}) needs a numeric column, '{col}' is {df[col].dtype}")
 
-# Route for the main page. Loads data and renders the index.html template.
-@app.route("/", methods=["GET"])
-def index():
-    df = load_data()
-    terminal_output = get_terminal_output()
-    _, current_api_key, _ = get_ai_config()  # Get current API key status
-    api_key_configured = bool(session.get("api_key") or os.environ.get("OPENROUTER_API_KEY") or DEFAULT_API_KEY)
+class AggregateState:
+    def __init__(self, spec, version):
+        self.spec = spec
+        self.version = version
+        self.dtypes = {}
+        self.row_groups = np.empty(0, dtype=np.int64)
+        self.row_values = {col: np.empty(0) for col in spec.value_columns}
+        self.keys = []  # Group id -> key tuple (missing values as None)
+        self.key_ids = {}
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.nonnull = {col: np.zeros(0, dtype=np.int64) for col in spec.value_columns}
+        self.sums = {col: np.zeros(0) for col in spec.value_columns}
+        # Extremes are only kept for columns with a min or max measure. Removing a group's
+        # current extreme marks it stale, and stale groups are recomputed on the next read.
+        self.extreme_columns = list(dict.fromkeys(col for func, col in spec.measures if func in ("min", "max")))
+        self.mins = {col: np.zeros(0) for col in self.extreme_columns}
+        self.maxs = {col: np.zeros(0) for col in self.extreme_columns}
+        self.stale_extremes = set()
+        self._result = None
+        if not spec.group_by:
+            self._group_id(())  # A single group, reported even when no row matches.
 
-    return render_template(
-        "index.html",
-        rows=df.to_dict(orient="records"),  # Data rows for the table
-        columns=list(df.columns),          # Column names for the table
-        terminal_output=terminal_output,   # Output for the terminal display
-        api_key_configured=api_key_configured  # Pass this to the template
-    )
+    @classmethod
+    def build(cls, df, spec, version):
+        state = cls(spec, version)
+        state.dtypes = {col: df[col].dtype for col in spec.columns}
+        count_metric("moderndb_rows_scanned_total", len(df), scan="aggregate")
+        state.row_groups, state.row_values = state._row_state(df)
+        state._add(np.arange(len(df)))
+        return state
 
-# Route for handling file uploads.
-@app.route("/upload", methods=["POST"])
-def upload():
-    file = request.files["file"]
-    if file:
-        # Check if the file has a .csv extension
-        if not file.filename.lower().endswith('.csv'):
-            append_terminal_output("<div class='text-error'>Upload failed: Only CSV files are allowed.</div>")
-            return redirect(url_for("index"))
-            
-        try:
-            df = pd.read_csv(file)
-            # Check if the uploaded CSV is empty or has no columns.
-            if df.empty or len(df.columns) == 0:
-                append_terminal_output("<span style='color:red;'>Upload failed: File has no valid data or no header.</span>")
+    def _group_id(self, key):
+        group = self.key_ids.get(key)
+        if group is None:
+            group = self.key_ids[key] = len(self.keys)
+            self.keys.append(key)
+        return group
+
+    # Grows the per-group arrays to cover every known group.
+    def _grow(self):
+        extra = len(self.keys) - len(self.rows)
+        if extra <= 0:
+            return
+        self.rows = np.concatenate([self.rows, np.zeros(extra, dtype=np.int64)])
+        for col in self.spec.value_columns:
+            self.nonnull[col] = np.concatenate([self.nonnull[col], np.zeros(extra, dtype=np.int64)])
+            self.sums[col] = np.concatenate([self.sums[col], np.zeros(extra)])
+        for col in self.extreme_columns:
+            self.mins[col] = np.concatenate([self.mins[col], np.full(extra, np.inf)])
+            self.maxs[col] = np.concatenate([self.maxs[col], np.full(extra, -np.inf)])
+
+    # Returns the group of every row of frame (-1 where the conditions exclude it) and the
+    # aggregated columns' values as floats (NaN for missing).
+    def _row_state(self, frame):
+        included = np.ones(len(frame), dtype=bool)
+        if self.spec.conditions:
+            # Predicates are evaluated directly: frame is often just the rows of one record.
+            for p in compile_conditions(self.spec.conditions, frame).predicates:
+                positions = parallel_scan(frame, [p.column], "predicate", p, "aggregate")
+                if positions is None:
+                    included &= _as_bool_array(p.evaluate(frame[p.column]))
+                else:
+                    matched = np.zeros(len(frame), dtype=bool)
+                    matched[positions] = True
+                    included &= matched
+        groups = np.full(len(frame), -1, dtype=np.int64)
+        if included.any():
+            if self.spec.group_by:
+                keyed = frame.loc[included, self.spec.group_by]
+                local = keyed.groupby(self.spec.group_by, dropna=False, sort=False, observed=True).ngroup().to_numpy()
+                first = np.unique(local, return_index=True)[1]
+                ids = np.array([self._group_id(tuple(None if pd.isna(v) else v for v in key))
+                                for key in keyed.iloc[first].itertuples(index=False, name=None)], dtype=np.int64)
+                groups[included] = ids[local]
             else:
-                save_data(df)
-                append_terminal_output(f"<span style='color:green;'>Data uploaded. Rows: {len(df)}, Columns: {len(df.columns)}</span>")
-        except Exception as e:
-            append_terminal_output(f"<span style='color:red;'>Upload failed: {e}</span>")
-    else:
-        append_terminal_output("<span style='color:red;'>No file selected.</span>")
-    return redirect(url_for("index"))
+                groups[included] = 0
+        self._grow()
+        values = {col: frame[col].to_numpy(dtype=np.float64, na_value=np.nan) for col in self.spec.value_columns}
+        return groups, values
 
-# Route for exporting data as a CSV file.
-@app.route("/export")
-def export():
-    if os.path.exists(DATA_PATH):
-        return send_file(DATA_PATH, as_attachment=True)  # Send the CSV file for download.
-    else:
-        return "No data to export", 404
+    # Adds (sign 1) or subtracts (sign -1) the contributions of the rows at positions.
+    def _accumulate(self, positions, sign):
+        groups = self.row_groups[positions]
+        included = groups >= 0
+        groups = groups[included]
+        size = len(self.keys)
+        self.rows += sign * np.bincount(groups, minlength=size)
+        for col in self.spec.value_columns:
+            values = self.row_values[col][positions][included]
+            present = ~np.isnan(values)
+            g, v = groups[present], values[present]
+            self.nonnull[col] += sign * np.bincount(g, minlength=size)
+            self.sums[col] += sign * np.bincount(g, weights=v, minlength=size)
+            if col not in self.mins:
+                continue
+            if sign > 0:
+                np.fmin.at(self.mins[col], g, v)
+                np.fmax.at(self.maxs[col], g, v)
+            else:
+                lost = (v <= self.mins[col][g]) | (v >= self.maxs[col][g])
+                self.stale_extremes.update(g[lost].tolist())
+        self._result = None
 
-# Route for checking the AI service status.
-@app.route("/check_ai_status", methods=["POST"])
-def check_ai_status():
-    ai_url, api_key, ai_model = get_ai_config()
-    if api_key:  # Check if api_key is not empty
-        append_terminal_output(f"<span style='color:green;'>AI Status: API Key is configured. Using model: {ai_model}. URL: {ai_url}</span>")
-    else:
-        append_terminal_output("<span style='color:red;'>AI Status: API Key is NOT configured. Please set it via the form or environment variable OPENROUTER_API_KEY.</span>")
-    return redirect(url_for("index"))
+    def _add(self, positions):
+        self._accumulate(positions, 1)
 
-# Route for processing commands generated by the AI.
-@app.route("/ai_command", methods=["POST"])
-def ai_command():
-    user_input = request.form["user_input"]  # User's natural language query
-    ai_url, api_key, model = get_ai_config()  # Get config including model
+    def _subtract(self, positions):
+        self._accumulate(positions, -1)
 
-    if not api_key:  # Explicitly check for API key
-        append_terminal_output("<span style='color:red;'>AI Error: API Key is not configured. Please set it first (via UI or OPENROUTER_API_KEY environment variable).</span>")
-        return redirect(url_for("index"))
+    # Recomputes min and max of the groups that lost their extreme value.
+    def _refresh_extremes(self):
+        if not self.stale_extremes:
+            return
+        stale = np.fromiter(self.stale_extremes, dtype=np.int64)
+        rows = np.flatnonzero(np.isin(self.row_groups, stale))
+        groups = self.row_groups[rows]
+        for col in self.extreme_columns:
+            self.mins[col][stale] = np.inf
+            self.maxs[col][stale] = -np.inf
+            values = self.row_values[col][rows]
+            np.fmin.at(self.mins[col], groups, values)
+            np.fmax.at(self.maxs[col], groups, values)
+        self.stale_extremes.clear()
 
-    df = load_data()
-    columns = list(df.columns)
-    # Provide a preview of the data to the AI for context.
-    preview = df.head(5).to_dict(orient="records") if not df.empty else []
-    columns_str = ", ".join(columns)
-    preview_str = "\n".join([str(row) for row in preview])
+    # Carries the state through one write-ahead log record to new_version. df is the frame
+    # after the mutation. Returns False if the record can't be applied incrementally (a column
+    # the aggregate uses was replaced or changed type), in which case the state must be rebuilt.
+    def apply(self, df, record, new_version):
+        for col, dtype in self.dtypes.items():
+            if col not in df.columns or not same_column_dtype(df[col].dtype, dtype):
+                return False
+        op = record["op"]
+        if op == "append":
+            start = len(df) - len(record["rows"])
+            groups, values = self._row_state(df.iloc[start:])
+            self.row_groups = np.concatenate([self.row_groups, groups])
+            for col in self.spec.value_columns:
+                self.row_values[col] = np.concatenate([self.row_values[col], values[col]])
+            self._add(np.arange(start, len(df)))
+        elif op == "delete":
+            positions = np.asarray(record["positions"], dtype=np.int64)
+            self._subtract(positions)
+            self.row_groups = np.delete(self.row_groups, positions)
+            for col in self.spec.value_columns:
+                self.row_values[col] = np.delete(self.row_values[col], positions)
+        elif op == "update":
+            changed = [col for col in record["columns"] if col in self.dtypes]
+            if any("column" in record["columns"][col] for col in changed):
+                return False
+            if changed:
+                positions = np.asarray(record["positions"], dtype=np.int64)
+                self._subtract(positions)
+                groups, values = self._row_state(df.iloc[positions])
+                self.row_groups[positions] = groups
+                for col in self.spec.value_columns:
+                    self.row_values[col][positions] = values[col]
+                self._add(positions)
+        if len(self.row_groups) != len(df):
+            return False
+        self.version = new_version
+        return True
 
-    # System prompt to guide the AI in generating commands.
-    system_prompt = f"""
-You are a database assistant. The user has uploaded the following data table:
-Available columns: {columns_str}
-First 5 rows of data example:
-{preview_str}
-You can understand the following operations and must strictly return commands in JSON format:
+    # Returns the aggregate as a DataFrame: one row per non-empty group, sorted by the group
+    # columns (missing values last), then one column per measure.
+    def result(self):
+        if self._result is not None:
+            return self._result
+        self._refresh_extremes()
+        live = np.flatnonzero(self.rows > 0) if self.spec.group_by else np.arange(1)
+        data = {}
+        for i, col in enumerate(self.spec.group_by):
+            data[col] = [self.keys[g][i] for g in live]
+        for func, col in self.spec.measures:
+            name = func if col is None else f"{func}({col})"
+            if func == "count":
+                data[name] = self.rows[live] if col is None else self.nonnull[col][live]
+                continue
+            whole = pd.api.types.is_integer_dtype(self.dtypes[col]) or pd.api.types.is_bool_dtype(self.dtypes[col])
+            nonnull = self.nonnull[col][live]
+            if func == "sum":
+                values = self.sums[col][live]
+                data[name] = values.round().astype(np.int64) if whole else values
+            elif func == "avg":
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    data[name] = np.where(nonnull > 0, self.sums[col][live] / nonnull, np.nan)
+            else:
+                values = np.where(nonnull > 0, (self.mins if func == "min" else self.maxs)[col][live], np.nan)
+                data[name] = values.astype(np.int64) if whole and (nonnull > 0).all() else values
+        result = pd.DataFrame(data)
+        if self.spec.group_by and len(result) > 1:
+            try:
+                result = result.sort_values(self.spec.group_by, na_position="last", kind="stable", ignore_index=True)
+            except TypeError:  # Mixed types in a key column
+                result = result.sort_values(self.spec.group_by, na_position="last", kind="stable", ignore_index=True,
+                                            key=lambda s: s.astype(str))
+        self._result = result
+        return result
 
-- list: List all data. JSON: {{"operation": "list"}}
+# Computes an aggregate of df. If it is materialized and df is a dataset version's frame, the
+# maintained result is served (after rebuilding the state if it was dropped).
+def aggregate(df, spec):
+    version = frame_version(df)
+    views = current_table().materialized_views
+    with _view_lock:
+        view = next((v for v in views.values() if v["spec"].key == spec.key), None)
+    if view is None or version is None:
+        return AggregateState.build(df, spec, version).result()
+    return materialized_result(view, df, version)
 
-- add: Add a new row. JSON: {{"operation": "add", "data": {{"column_name1": value1, "column_name2": value2}}}}
-  Note: Missing columns will receive appropriate default values based on their data types.
+# Returns a materialized aggregate's result for df, the frame of the given dataset version.
+def materialized_result(view, df, version):
+    with _view_lock:
+        state = view["state"]
+        if state is not None and state.version == version:
+            view["reads"] += 1
+            return state.result()
+    # Build outside the lock so commits aren't held up; only install it if it is newer.
+    state = AggregateState.build(df, view["spec"], version)
+    with _view_lock:
+        current = view["state"]
+        if current is None or current.version < version:
+            view["state"] = state
+            view["rebuilds"] += 1
+        view["reads"] += 1
+    return state.result()
 
-- add_batch: Add multiple rows at once. Return JSON as:
-  {{"operation": "add_batch", "columns": ["col1", "col2"], "values": [[val1_row1, val2_row1], [val1_row2, val2_row2]]}}
+# Registers a materialized aggregate of the current table under name (replacing any of the same
+# name) and builds it.
+def create_materialized_view(name, spec, df):
+    views = current_table().materialized_views
+    with _view_lock:
+        view = views[name] = {"spec": spec, "state": None, "reads": 0, "rebuilds": 0}
+    version = frame_version(df)
+    if version is None:
+        return AggregateState.build(df, spec, None).result()
+    return materialized_result(view, df, version)
 
-- update: Update rows matching conditions. JSON: 
-  {{"operation": "update", "conditions": {{"condition_column1": "condition_value1"}}, "data": {{"update_column1": "new_value1"}}}}
-  (conditions cannot be empty)
-  
-  Supports advanced comparison operators for numeric columns:
-  - greater than: "column": ">value" 
-  - less than: "column": "<value"
-  - greater/equal: "column": ">=value"
-  - less/equal: "column": "<=value"
-  - not equal: "column": "!=value"
-  
-  Supports pattern matching for string columns:
-  - starts with: "column": "prefix*"
-  - ends with: "column": "*suffix"
-  - contains: "column": "*contains*"
+# Forgets a materialized aggregate. Returns False if there was none of that name.
+def drop_materialized_view(name):
+    with _view_lock:
+        return current_table().materialized_views.pop(name, None) is not None
 
-- delete: Delete rows matching conditions. JSON: 
-  {{"operation": "delete", "conditions": {{"condition_column1": "condition_value1", "condition_column2": "condition_value2"}}}}
-  (conditions cannot be empty)
-  
-  Supports the same advanced comparison operators as update.
-  For bulk deletions (>10 rows), add "confirm": true to the JSON.
+# Carries materialized aggregates from old_version to new_version through one write-ahead log
+# record. df is the frame after the mutation. States that can't be maintained are dropped.
+def maintain_materialized_views(df, record, old_version, new_version):
+    views = current_table().materialized_views
+    with _view_lock:
+        for view in views.values():
+            state = view["state"]
+            if state is None:
+                continue
+            if state.version != old_version or not state.apply(df, record, new_version):
+                view["state"] = None
 
-- search: Fuzzy search all fields. JSON: {{"operation": "search", "keyword": "search_term"}}
+# Drops the state of the current table's materialized aggregates; each is rebuilt on its next read.
+def invalidate_materialized_views():
+    views = current_table().materialized_views
+    with _view_lock:
+        for view in views.values():
+            view["state"] = None
 
-- search_exact: Exact search a specific column. JSON: 
-  {{"operation": "search_exact", "column": "column_name", "value": "exact_value"}}
-  
-  Also supports pattern matching like update/delete.
+# Returns a summary of the current table's materialized aggregates for the 'materialize' command.
+def describe_materialized_views():
+    table = current_table()
+    with _view_lock:
+        rows = []
+        for name in sorted(table.materialized_views):
+            view = table.materialized_views[name]
+            state = view["state"]
+            if state is None:
+                status = "stale, rebuilt on next read"
+            else:
+                current = "current" if state.version == table.version else f"version {state.version}"
+                status = f"{int((state.rows > 0).sum())} groups ({current})"
+            rows.append(f"{name}: aggregate {view['spec']} -- {status}, {view['reads']} reads, {view['rebuilds']} rebuilds")
+        return rows
 
-- columns: Show column information. JSON: {{"operation": "columns"}}
+# Rendered table fragments keyed by (dataset version, query), so showing a result again
+# (the terminal re-renders its history on every page load) doesn't render it again.
+FRAGMENT_CACHE_SIZE = 64
+_fragment_cache = OrderedDict()
+_fragment_cache_lock = threading.Lock()
 
-Important notes:
-- The 'conditions' object is required in 'update' and 'delete' operations and cannot be an empty object.
-- The 'data' object is required in 'add' and 'update' operations.
-- Value types should match column data types as much as possible. For string values, please use strings.
-- Strictly return only JSON commands. Do not include any other text, explanations, or Markdown tags.
-- For missing/null values, use null or the strings "nan" or "na" (returned as NaN in the database).
-- If the user request is outside the above scope or incorrectly formatted, please return {{"operation": "error", "message": "Only specified command formats are supported."}}.
-"""
+# Renders a TableResult as an HTML table. Tables over 10 rows show the first and last 5 with an
+# ellipsis row between them. Cells are HTML-escaped.
+@instrumented("render_table")
+def render_table_result(result):
+    if result.total == 0:
+        return "<div class='text-gray-400'>No data</div>"
+    cache_key = (result.version, tuple(result.query)) if result.version is not None and result.query else None
+    if cache_key is not None:
+        with _fragment_cache_lock:
+            html_fragment = _fragment_cache.get(cache_key)
+            if html_fragment is not None:
+                _fragment_cache.move_to_end(cache_key)
+                return html_fragment
+    header = "<tr>" + "".join(f"<th>{html.escape(col)}</th>" for col in result.columns) + "</tr>"
+    rows = ["<tr>" + "".join(f"<td>{html.escape(cell)}</td>" for cell in row) + "</tr>" for row in result.rows]
+    if result.total > len(result.rows):
+        # Ellipsis to indicate omitted rows
+        rows.insert(TableResult.PREVIEW_ROWS, f"<tr><td colspan='{len(result.columns)}' class='text-center text-secondary'>... (Total {result.total} rows, middle part omitted) ...</td></tr>")
+    html_fragment = f"""<div style='overflow-x:auto;'><table class='table table-sm table-striped table-bordered' style='background:white;color:#222;'><thead>{header}</thead><tbody>{"".join(rows)}</tbody></table></div>"""
+    if cache_key is not None:
+        with _fragment_cache_lock:
+            _fragment_cache[cache_key] = html_fragment
+            if len(_fragment_cache) > FRAGMENT_CACHE_SIZE:
+                _fragment_cache.popitem(last=False)
+    return html_fragment
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_input}
-    ]
-    payload = {
-        "model": model,
-        "messages": messages,
-        "stream": False  # Not using streaming response for simplicity
-    }
-    headers = {"Authorization": f"Bearer {api_key}"}
+# Returns the result of a query command over df as a TableResult. query (e.g. ("search", keyword))
+# identifies the result for caching; base is the frame the rows were selected from, whose
+# dataset version the result belongs to. limit is the command's (see Command.limit).
+def df_to_table_result(df, query=None, base=None, limit=None):
+    if df.empty:
+        return Message("No data", "muted")
+    version = frame_version(base if base is not None else df) if query else None
+    return TableResult.from_frame(df, query=list(query) if query else None, version=version, limit=limit)
+
+# Returns the parallel scan line of the 'cache' command.
+def _describe_parallel_scans():
+    if PARALLEL_SCAN_WORKERS < 2:
+        return "\nParallel scans: off (MODERNDB_PARALLEL_SCAN_WORKERS)"
+    stats = parallel_scan_stats
+    return (f"\nParallel scans: tables of {PARALLEL_SCAN_MIN_ROWS}+ rows on {PARALLEL_SCAN_WORKERS} workers; "
+            f"{stats['scans']} scans in {stats['partitions']} partitions, {stats['exports']} column exports, "
+            f"{stats['fallbacks']} fallbacks")
+
+# Returns the AI cache line of the 'cache' command.
+def _describe_ai_cache():
+    if ai_cache is None:
+        return "\nAI cache: disabled"
+    stats = get_ai_cache_stats()
+    hit_ratio = f"{stats['hit_ratio']:.1%}" if stats["hit_ratio"] is not None else "n/a"
+    return (f"\nAI cache: {stats['entries']} entries, hits {stats['hits']}, coalesced {stats['coalesced']}, "
+            f"misses {stats['misses']} (hit ratio {hit_ratio}), saved {stats['saved_ms'] / 1000:.1f}s of model latency")
+
+# Runs a command on df, timing it by operation.
+def run_command(command, df):
+    with timed(f"command {command.op}", "moderndb_command_seconds", op=command.op):
+        return _run_command(command, df)
 
+# Parses the arguments of 'update cond=val ... set col=val ...' into (conditions, updates).
+# Raises ValueError with the message to show for a malformed command.
+def parse_update_args(tokens):
     try:
-        # Make the API call to the AI service.
-        resp = requests.post(f"{ai_url}/chat/completions", json=payload, headers=headers, timeout=30)
-        resp.raise_for_status()  # Raise an exception for HTTP errors.
-        data = resp.json()
-        
-        # Extract the AI's response content.
-        if "choices" in data and data["choices"]:
-            content = data["choices"][0]["message"]["content"]
-        elif "message" in data and "content" in data["message"]:  # Some models might use this structure
-            content = data["message"]["content"]
+        set_idx = tokens.index("set")  # Find 'set' keyword to separate conditions and updates.
+    except ValueError:
+        raise ValueError("update command format error: missing 'set' keyword. Usage: update condition1=value1 ... set update_col1=new_val1 ...")
+
+    condition_args_str = tokens[1:set_idx]
+    update_args_str = tokens[set_idx+1:]
+
+    if not condition_args_str:
+        raise ValueError("update command format error: missing update conditions.")
+    if not update_args_str:
+        raise ValueError("update command format error: missing fields and values to update.")
+
+    # Parse condition arguments.
+    conditions = {}
+    for token_cond in condition_args_str:
+        if '=' not in token_cond: raise ValueError(f"update command format error: condition '{token_cond}' format is incorrect.")
+        k, v = token_cond.split('=', 1)
+        conditions[k] = v
+
+    # Parse update arguments.
+    updates = {}
+    for token_update in update_args_str:
+        if '=' not in token_update: raise ValueError(f"update command format error: update '{token_update}' format is incorrect.")
+        k, v = token_update.split('=', 1)
+        updates[k] = v
+    return conditions, updates
+
+# Parses the arguments of 'delete cond=val ... [confirm=yes]' into (conditions, confirmed).
+# Raises ValueError with the message to show for a malformed command.
+def parse_delete_args(tokens):
+    condition_args_str = tokens[1:]
+    if not condition_args_str:
+        raise ValueError("delete command requires conditions, e.g., delete name=Tom age=30. For bulk delete confirmation, add confirm=yes")
+
+    conditions = {}
+    confirm_delete = False  # Flag for confirming bulk deletes.
+
+    # Separate 'confirm=yes' from actual conditions.
+    actual_condition_args_str = []
+    for token_cond in condition_args_str:
+        if token_cond.lower() == "confirm=yes":
+            confirm_delete = True
         else:
-            content = str(data)  # Fallback if structure is unexpected
-        
-        try:
-            # Clean up potential markdown formatting from the AI response.
-            if content.strip().startswith("```json"):
-                content = content.strip().removeprefix("```json").removesuffix("```").strip()
-            # Replace 'undefined' with 'null' for better JSON parsing compatibility.
-            content = re.sub(r':\s*undefined', ': null', content)
-            ai_cmd = json.loads(content)  # Parse the JSON command.
-            append_terminal_output(f"<div class='text-info'>AI suggested command: {ai_cmd}</div>")
-            
-            cmd_str = ai_cmd_to_str(ai_cmd)  # Convert the AI's JSON command to a string command.
-            if cmd_str:
-                append_terminal_output(f"<div class='text-command'>&gt; {cmd_str}</div>")
-                df = load_data()
-                result = parse_terminal_command(cmd_str, df)  # Execute the command.
-                append_terminal_output(result)
-            else:
-                append_terminal_output("AI failed to generate a valid command.")
-        except Exception as e:
-            append_terminal_output(f"AI response could not be parsed as a command: {content} ({e}), please retry or optimize the prompt.")
-    except Exception as e:
-        append_terminal_output(f"AI request failed: {e}")
-    return redirect(url_for("index"))
+            actual_condition_args_str.append(token_cond)
 
-# Route for processing commands entered directly into the terminal.
-@app.route("/terminal_command", methods=["POST"])
-def terminal_command():
-    cmd = request.form["terminal_input"]  # Command string from the terminal input field.
-    append_terminal_output(f"<div class='text-command'>&gt; {cmd}</div>")
-    df = load_data()
-    msg = parse_terminal_command(cmd, df)  # Parse and execute the command.
-    append_terminal_output(msg)
-    return redirect(url_for("index"))
+    if not actual_condition_args_str:  # Ensure there are actual conditions beyond just confirmation.
+        raise ValueError("delete command requires conditions to specify which rows to delete (beyond just 'confirm=yes').")
 
-# Route for destroying all data
-@app.route("/destroy_data", methods=["POST"])
-def destroy_data():
-    try:
-        # Ensure data directory exists
-        os.makedirs("data", exist_ok=True)
-        
-        # Create an empty file rather than removing it
-        # This avoids EmptyDataError when the app tries to read it
-        open(DATA_PATH, 'w').close()
-        
-        # Clear terminal output
-        session["terminal_output"] = "<div class='text-success'>All data has been destroyed. Application reset to initial state.</div>"
-        return redirect(url_for("index"))
-    except Exception as e:
-        append_terminal_output(f"<div class='text-error'>Data destruction failed: {e}</div>")
-    return redirect(url_for("index"))
+    # Parse condition arguments.
+    for token_cond in actual_condition_args_str:
+        if '=' not in token_cond:
+            raise ValueError(f"delete command format error: condition '{token_cond}' format is incorrect. Expected 'column=value'.")
+        k, v = token_cond.split('=', 1)
+        conditions[k] = v
 
-# Converts a DataFrame to an HTML table string for display.
-# Shows first 5 and last 5 rows if the DataFrame has more than 10 rows.
-def df_to_html_table(df):
-    if df.empty:
-        return "<div class='text-gray-400'>No data</div>"
-    n = len(df)
-    header = "<tr>" + "".join(f"<th>{col}</th>" for col in df.columns) + "</tr>"
-    body = ""
-    if n > 10:
-        # Display first 5 rows
-        for _, row in df.head(5).iterrows():
-            body += "<tr>" + "".join(f"<td>{row[col]}</td>" for col in df.columns) + "</tr>"
-        # Ellipsis to indicate omitted rows
-        body += f"<tr><td colspan='{len(df.columns)}' class='text-center text-secondary'>... (Total {n} rows, middle part omitted) ...</td></tr>"
-        # Display last 5 rows
-        for _, row in df.tail(5).iterrows():
-            body += "<tr>" + "".join(f"<td>{row[col]}</td>" for col in df.columns) + "</tr>"
-    else:
-        # Display all rows if 10 or fewer.
-        for _, row in df.iterrows():
-            body += "<tr>" + "".join(f"<td>{row[col]}</td>" for col in df.columns) + "</tr>"
-    return f"""<div style='overflow-x:auto;'><table class='table table-sm table-striped table-bordered' style='background:white;color:#222;'><thead>{header}</thead><tbody>{body}</tbody></table></div>"""
+    if not conditions:  # Should be caught by earlier checks, but as a safeguard.
+        raise ValueError("delete command requires conditions to specify which rows to delete.")
+    return conditions, confirm_delete
 
-# Parses and executes terminal commands.
-def parse_terminal_command(cmd, df):
+# Executes a command on df: the command engine behind the terminal, scripts, the AI and
+# /api/command.
+def _run_command(command, df):
+    op, args = command.op, command.args
     try:
-        tokens = shlex.split(cmd)  # Split command string into tokens, respecting quotes.
-        if not tokens:
-            return "No command input"
-        op = tokens[0].lower()  # The operation is the first token.
-        
         if op == "clear":
-            session["terminal_output"] = ""  # Clear terminal history from session.
-            return "<div class='text-success'>Terminal cleared.</div>"
-            
+            clear_terminal_output()  # Clear this session's terminal history.
+            return Message("Terminal cleared.", "success")
+
         if op == "help":
             # Display help text for available commands.
-            return (
-                "<pre>Supported commands:\n"
+            return Message(
+                "Supported commands:\n"
                 "help                                 Show this help\n"
                 "clear                                Clear terminal content\n"
                 "list                                 List all data\n"
                 "columns                              Show column information\n"
+                "cache                                Show dataset cache statistics\n"
+                "tables                               List tables and the memory they hold\n"
+                "use table                            Switch to (or create) a table\n"
                 "add col1=val1 col2=val2 ...          Add a new row\n"
                 "add_batch col1=val1,val2,... col2=val3,val4,...    Add multiple rows at once\n"
                 "update cond1=val1 ... set col_to_update1=new_val1 ...  Update rows based on conditions\n"
@@ -382,46 +5507,154 @@ def parse_terminal_command(cmd, df):
                 "delete_all                           Delete all data (with confirmation)\n"
                 "search keyword                       Fuzzy search all fields containing the keyword\n"
                 "search_exact col=val                 Exactly search for rows where col equals val\n"
+                "index [col | drop col]               List, build or drop secondary indexes\n"
+                "aggregate count sum(col) ... [by col,...] [where cond=val ...]  Grouped count/sum/avg/min/max\n"
+                "materialize [name aggregate-args | drop name]  List, create or drop maintained aggregates\n"
+                "profile command                      Run a command and show where its time went\n"
                 "\nAdvanced features:\n"
                 "- For numeric columns, you can use comparison operators: >, <, >=, <=, != \n"
                 "- For string columns, you can use patterns: 'prefix*', '*suffix', '*contains*'\n"
                 "- Supported special values: nan, na, none, '' (empty string) for missing values\n"
-                "</pre>"
-            )
+                "- Prefix a command with a table name to run it on that table: sales.list, sales.add id=4\n"
+                "- Tables stored larger than MODERNDB_OUT_OF_CORE_MB are streamed in chunks by list, columns,\n"
+                "  search, search_exact, update and delete instead of being loaded\n"
+                "- Programs can POST the same commands as JSON to /api/command and get JSON results\n",
+                "pre")
+
+        if op == "use":
+            # Switch this session to another table; a table that doesn't exist yet starts empty.
+            name = args["name"]
+            if name is None:
+                return Message(f"Current table: {current_table().name}. Usage: use table_name", "pre")
+            if not valid_table_name(name):
+                return Message(f"Error: Invalid table name '{name}' (use letters, digits and underscores).", ok=False)
+            exists = name in list_tables()
+            _table_context.table = get_table(name)
+            if has_request_context():
+                session["table"] = name
+            if not exists:
+                return Message(f"Using new table {name}. Upload a CSV file or add rows to fill it.", "success")
+            rows = table_shape(current_table())[0] if is_out_of_core(current_table()) else len(load_data(copy=False))
+            return Message(f"Using table {name} ({rows} rows).", "success")
+
+        if op == "tables":
+            # List the tables with their residency in the table pool.
+            rows, used = describe_tables()
+            current = current_table().name
+            lines = [f"{'*' if name == current else ' '} {name}: {state}" for name, state in rows]
+            return Message("Tables (* = current):\n" + ("\n".join(lines) or "  none")
+                           + f"\nTable pool: {_format_bytes(used)} resident of {_format_bytes(TABLE_MEMORY_MB * 1024 * 1024)}, "
+                             f"{table_pool_stats['evictions']} evictions, {table_pool_stats['reloads']} reloads", "pre")
+
+        if op == "cache":
+            # Display dataset cache counters.
+            stats = get_cache_stats()
+            lookups = stats["hits"] + stats["misses"]
+            hit_ratio = f"{stats['hits'] / lookups:.1%}" if lookups else "n/a"
+            return Message(f"Dataset cache of table {stats['table']} ({stats['backend']} storage): version {stats['version']}, "
+                           f"{'warm' if stats['cached'] else 'cold'}, "
+                           f"hits {stats['hits']}, misses {stats['misses']} (hit ratio {hit_ratio})"
+                           + (f"\nWrite-ahead log: {stats['wal_bytes']} bytes, {stats['appends']} appends, "
+                              f"{stats['replayed']} replayed, {stats['compactions']} compactions"
+                              if stats["wal_bytes"] is not None else "")
+                           + f"\nWriter: {writer_stats['jobs']} jobs in {writer_stats['groups']} group commits "
+                             f"(largest group {writer_stats['largest_group']})"
+                           + _describe_parallel_scans() + _describe_out_of_core()
+                           + _describe_ai_cache(), "pre")
+
+        if op == "index":
+            # Manage secondary indexes: list, create or drop.
+            col_name = args["column"]
+            if col_name is None:
+                described = describe_indexes()
+                if not described:
+                    return Message("No indexes. Create one with: index column_name", "pre")
+                return Message("Indexes:\n" + "\n".join(described), "pre")
+            if args["drop"]:
+                drop_index(col_name)
+                return Message(f"Index on '{col_name}' dropped.", "success")
+            if col_name not in df.columns:
+                return Message(f"Error: Column '{col_name}' does not exist.", ok=False)
+            started = time.perf_counter()
+            try:
+                index = create_index(col_name)
+            except NotIndexable as e:
+                return Message(f"Cannot index '{col_name}': {e}.", "warning", ok=False)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            return Message(f"Index on '{col_name}' built ({index.kind}, {len(index.order)} values) in {elapsed_ms:.1f} ms.", "success")
+
+        if op == "aggregate":
+            # Grouped count/sum/avg/min/max, or a materialized aggregate by name.
+            if df.empty:
+                return Message("No data to aggregate. Please upload a CSV file first.", "notice")
+            with _view_lock:
+                view = current_table().materialized_views.get(args["view"]) if args["view"] is not None else None
+            try:
+                spec = view["spec"] if view is not None else args["spec"] or parse_aggregate([args["view"]])
+                validate_aggregate(spec, df)
+            except ValueError as e:
+                return Message(f"Error: {e}.", ok=False)
+            result = aggregate(df, spec)
+            return df_to_table_result(result, query=("aggregate", str(spec)), base=df, limit=command.limit)
+
+        if op == "materialize":
+            # Manage materialized aggregates: list, create or drop.
+            name = args["name"]
+            if name is None:
+                described = describe_materialized_views()
+                if not described:
+                    return Message("No materialized aggregates. Create one with: materialize name count sum(col) by col", "pre")
+                return Message("Materialized aggregates:\n" + "\n".join(described), "pre")
+            if args["drop"]:
+                if not drop_materialized_view(name):
+                    return Message(f"Error: No materialized aggregate named '{name}'.", ok=False)
+                return Message(f"Materialized aggregate '{name}' dropped.", "success")
+            spec = args["spec"]
+            try:
+                validate_aggregate(spec, df)
+            except ValueError as e:
+                return Message(f"Error: {e}.", ok=False)
+            started = time.perf_counter()
+            result = create_materialized_view(name, spec, df)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            return Message(f"Materialized aggregate '{name}' built ({len(result)} groups) "
+                           f"in {elapsed_ms:.1f} ms; 'aggregate {name}' reads it.", "success")
 
         if op == "columns":
             if df.empty:
-                return "<div class='text-command'>No data loaded. Please upload a CSV file first.</div>"
-            # Display column names and their data types.
-            cols_info = [f"{col} ({df[col].dtype})" for col in df.columns]
-            return f"<pre>Available columns ({len(df.columns)}):\n{', '.join(cols_info)}</pre>"
-        
+                return Message("No data loaded. Please upload a CSV file first.", "notice")
+            # Display column names, their data types and memory use, with what the default
+            # wide dtypes (int64, object strings) would take instead.
+            lines, total_used, total_wide = [], 0, 0
+            for col in df.columns:
+                used, wide = column_memory(df[col])
+                total_used, total_wide = total_used + used, total_wide + wide
+                saved = f", {_format_bytes(wide)} uncompacted" if wide > used else ""
+                lines.append(f"{col} ({df[col].dtype}): {_format_bytes(used)}{saved}")
+            saving = f" ({1 - total_used / total_wide:.0%} saved)" if total_wide > total_used else ""
+            lines.append(f"Memory: {_format_bytes(total_used)}, {_format_bytes(total_wide)} with default dtypes{saving}")
+            return Message(f"Available columns ({len(df.columns)}):\n" + "\n".join(lines), "pre")
+
         if op == "list":
             if df.empty:
-                return "<div class='text-command'>No data available. Please upload a CSV file first.</div>"
-            return df_to_html_table(df)  # Display the current data as an HTML table.
-            
+                return Message("No data available. Please upload a CSV file first.", "notice")
+            return df_to_table_result(df, query=("list",), limit=command.limit)  # Display the current data as a table.
+
         elif op == "delete_all":
             if df.empty:
-                return "<div class='text-command'>No data to delete</div>"
+                return Message("No data to delete", "notice")
             # Requires confirmation to delete all data.
-            if len(tokens) > 1 and tokens[1].lower() == "confirm":
-                # Create an empty file directly, which is more consistent
-                # with our handling of empty data elsewhere
-                os.makedirs("data", exist_ok=True)
-                open(DATA_PATH, 'w').close()
-                return f"<div class='text-error'>All data deleted. Original row count: {len(df)}</div>"
+            if args["confirm"]:
+                # Save an empty dataset, which is consistent with our handling of
+                # empty data elsewhere and bumps the dataset version
+                save_data(pd.DataFrame())
+                return Message(f"All data deleted. Original row count: {len(df)}", "danger")
             else:
-                return f"<div class='text-command'>Warning: You are about to delete all {len(df)} rows. To confirm, type: delete_all confirm</div>"
+                return Message(f"Warning: You are about to delete all {len(df)} rows. To confirm, type: delete_all confirm", "notice", ok=False)
 
         elif op == "add":
-            # Parse arguments for the 'add' command (e.g., col1=val1 col2=val2).
-            args = dict(token.split('=', 1) for token in tokens[1:] if '=' in token)
-            if not args:
-                return "add requires fields and values, e.g., add name=Tom age=18"
-            
             new_row_data = {}
-            
+
             # Initialize new row with default values for existing columns to avoid NaNs.
             if not df.empty:
                 for col in df.columns:
@@ -431,9 +5664,9 @@ def parse_terminal_command(cmd, df):
                         new_row_data[col] = False  # Boolean defaults to False.
                     else:
                         new_row_data[col] = ""  # String/object defaults to empty string.
-            
+
             # Override defaults with provided values or add new columns.
-            for k, v_str in args.items():
+            for k, v_str in args["data"].items():
                 if k in df.columns:  # If column exists, cast value to column's type.
                     new_row_data[k] = _attempt_cast_for_assignment(v_str, df[k])
                 else:  # If column is new, infer type.
@@ -444,392 +5677,132 @@ def parse_terminal_command(cmd, df):
                             new_row_data[k] = v_str.lower() == 'true'
                         else:
                             new_row_data[k] = v_str
-            
+
             new_row_df = pd.DataFrame([new_row_data])
-            
-            # If new columns were added, update the main DataFrame's schema.
-            if not df.empty:
-                for col in new_row_data:
-                    if col not in df.columns:
-                        df[col] = None  # Initialize new column with None/NA.
-            
-            # Concatenate the new row to the DataFrame.
-            if df.empty:
-                df = new_row_df
-            else:
-                df = pd.concat([df, new_row_df], ignore_index=True)
-                
-            save_data(df)
-            return f"Row added successfully: {new_row_data}"
-        
+
+            # Append the row (new columns are initialized with None/NA in existing rows) and log it.
+            record = {"op": "append", "rows": new_row_df}
+            df = apply_wal_record(df, record)
+            log_mutation(df, record)
+            return Message(f"Row added successfully: {new_row_data}")
+
         elif op == "add_batch":
-            # Parse arguments for batch adding rows (e.g., col1=v1,v2 col2=v3,v4).
-            args = dict(token.split('=', 1) for token in tokens[1:] if '=' in token)
-            if not args:
-                return "add_batch requires column lists, e.g., add_batch name=Tom,Alice,Bob age=25,30,28"
-            
-            column_values = {}
-            row_count = -1  # Used to ensure all columns have the same number of values.
-            
-            # Parse comma-separated values for each column.
-            for col, val_list_str in args.items():
-                values = [v.strip() for v in val_list_str.split(',')]
-                if row_count == -1:
-                    row_count = len(values)
-                elif len(values) != row_count:  # Validate consistent number of values.
-                    return f"Error: All columns must have the same number of values. Column '{col}' has {len(values)} values, but expected {row_count}."
-                column_values[col] = values
-            
-            if row_count <= 0:  # Check if any values were actually provided.
-                return "Error: No values provided for batch add, or empty value lists."
-            
-            new_rows = []
-            # Construct each new row.
-            for i in range(row_count):
-                row_data = {}
-                # Initialize with defaults if DataFrame is not empty.
-                if not df.empty:
-                    for col_existing in df.columns:
-                        if pd.api.types.is_numeric_dtype(df[col_existing].dtype):
-                            row_data[col_existing] = 0
-                        elif pd.api.types.is_bool_dtype(df[col_existing].dtype):
-                            row_data[col_existing] = False
-                        else:
-                            row_data[col_existing] = ""
-                
-                # Populate row with values from the batch, casting or inferring types.
-                for col_batch, values_batch in column_values.items():
-                    if i < len(values_batch):
-                        val_str_current = values_batch[i]
-                        if col_batch in df.columns:
-                            row_data[col_batch] = _attempt_cast_for_assignment(val_str_current, df[col_batch])
-                        else:  # New column, infer type.
-                            try:
-                                row_data[col_batch] = pd.to_numeric(val_str_current)
-                            except ValueError:
-                                if val_str_current.lower() in ['true', 'false']:
-                                    row_data[col_batch] = val_str_current.lower() == 'true'
-                                else:
-                                    row_data[col_batch] = val_str_current
-                new_rows.append(row_data)
-            
-            new_rows_df = pd.DataFrame(new_rows)
-            
-            # Add any new columns from batch to the main DataFrame schema.
+            column_values = args["columns"]
+            row_count = len(next(iter(column_values.values())))
+
+            # Build the new rows column by column: defaults for existing columns the batch doesn't
+            # mention, then each batch column cast (or inferred, for new columns) in one pass.
+            new_columns = {}
             if not df.empty:
-                for col_new in new_rows_df.columns:
-                    if col_new not in df.columns:
-                        df[col_new] = None 
-            
-            # Concatenate new rows.
-            if df.empty:
-                df = new_rows_df
-            else:
-                df = pd.concat([df, new_rows_df], ignore_index=True)
-                
-            save_data(df)
-            return f"Added {row_count} rows successfully"
-        
+                for col_existing in df.columns:
+                    new_columns[col_existing] = default_column_values(df[col_existing], row_count)
+            for col_batch, values_batch in column_values.items():
+                if col_batch in df.columns:
+                    new_columns[col_batch] = cast_values_for_column(values_batch, df[col_batch])
+                else:  # New column, infer type.
+                    new_columns[col_batch] = infer_new_column_values(values_batch)
+
+            new_rows_df = pd.DataFrame(new_columns)
+
+            # Append the rows (adding any new columns from the batch to the schema) and log them.
+            record = {"op": "append", "rows": new_rows_df}
+            df = apply_wal_record(df, record)
+            log_mutation(df, record)
+            return Message(f"Added {row_count} rows successfully")
+
         elif op == "update":
-            if df.empty: return "Data is empty, cannot update."
-            try:
-                set_idx = tokens.index("set")  # Find 'set' keyword to separate conditions and updates.
-            except ValueError:
-                return "update command format error: missing 'set' keyword. Usage: update condition1=value1 ... set update_col1=new_val1 ..."
-
-            condition_args_str = tokens[1:set_idx]
-            update_args_str = tokens[set_idx+1:]
-
-            if not condition_args_str:
-                return "update command format error: missing update conditions."
-            if not update_args_str:
-                return "update command format error: missing fields and values to update."
-
-            # Parse condition arguments.
-            conditions = {}
-            for token_cond in condition_args_str:
-                if '=' not in token_cond: return f"update command format error: condition '{token_cond}' format is incorrect."
-                k, v = token_cond.split('=', 1)
-                conditions[k] = v
-            
-            # Parse update arguments.
-            updates = {}
-            for token_update in update_args_str:
-                if '=' not in token_update: return f"update command format error: update '{token_update}' format is incorrect."
-                k, v = token_update.split('=', 1)
-                updates[k] = v
-
-            # Build a boolean mask based on conditions.
-            mask = pd.Series(True, index=df.index)
-            for col_name, val_str in conditions.items():
-                if col_name not in df.columns: 
-                    return f"Error: Column '{col_name}' in conditions does not exist."
-                
-                column_series = df[col_name]
-                current_condition_mask = pd.Series(False, index=df.index)
-                val_str_lower = str(val_str).lower()
-
-                # Handle null/empty string conditions.
-                if val_str_lower in ['nan', 'na', '<na>', 'none', '']:
-                    current_condition_mask = column_series.isna()
-                else:
-                    # Apply type-specific comparisons and operators.
-                    try:
-                        if pd.api.types.is_numeric_dtype(column_series.dtype):
-                            # Numeric comparisons (>, <, >=, <=, !=, ==).
-                            if val_str.startswith('>='): comp_val = pd.to_numeric(val_str[2:]); current_condition_mask = (column_series >= comp_val)
-                            elif val_str.startswith('<='): comp_val = pd.to_numeric(val_str[2:]); current_condition_mask = (column_series <= comp_val)
-                            elif val_str.startswith('>'): comp_val = pd.to_numeric(val_str[1:]); current_condition_mask = (column_series > comp_val)
-                            elif val_str.startswith('<'): comp_val = pd.to_numeric(val_str[1:]); current_condition_mask = (column_series < comp_val)
-                            elif val_str.startswith('!='): comp_val = pd.to_numeric(val_str[2:]); current_condition_mask = (column_series != comp_val)
-                            else: comp_val = pd.to_numeric(val_str); current_condition_mask = (column_series == comp_val)
-                        elif pd.api.types.is_bool_dtype(column_series.dtype):
-                            # Boolean comparisons.
-                            if val_str_lower in ['true', '1', 't', 'yes']: comp_val = True
-                            elif val_str_lower in ['false', '0', 'f', 'no']: comp_val = False
-                            else: comp_val = None 
-                            if comp_val is not None: current_condition_mask = (column_series == comp_val)
-                            else: current_condition_mask = (column_series.astype(str).str.lower() == val_str_lower)  # Fallback to string match if not clear bool
-                        else:  # String/object type column comparisons (contains, startswith, endswith, exact).
-                            str_series = column_series.astype(str)
-                            if val_str.startswith('*') and val_str.endswith('*'): pattern = val_str.strip('*'); current_condition_mask = str_series.str.contains(pattern, case=True, na=False)
-                            elif val_str.startswith('*'): suffix = val_str[1:]; current_condition_mask = str_series.str.endswith(suffix, na=False)
-                            elif val_str.endswith('*'): prefix = val_str[:-1]; current_condition_mask = str_series.str.startswith(prefix, na=False)
-                            else: current_condition_mask = (str_series == str(val_str))
-                    except ValueError:  # Fallback if type conversion (e.g., pd.to_numeric) fails.
-                        current_condition_mask = (column_series.astype(str) == str(val_str))
-                mask &= current_condition_mask  # Combine masks for multiple conditions.
-            
-            indices_to_update = df.loc[mask].index
+            if df.empty: return Message("Data is empty, cannot update.", ok=False)
+            conditions, updates = args["conditions"], args["data"]
+
+            # Select the matching rows with the compiled condition plan.
+            for col_name in conditions:
+                if col_name not in df.columns:
+                    return Message(f"Error: Column '{col_name}' in conditions does not exist.", ok=False)
+            positions = compile_conditions(conditions, df).positions(df)
+            indices_to_update = df.index[positions]
             if indices_to_update.empty:
-                return "No rows found matching conditions for update."
+                return Message("No rows found matching conditions for update.")
 
             # Perform updates on the matched rows.
+            changes = {}
             for col_update, val_update_str in updates.items():
+                prior_dtype = df[col_update].dtype if col_update in df.columns else None
                 if col_update not in df.columns:
                     df[col_update] = None  # Add new column if it doesn't exist.
-                
-                for idx in indices_to_update:
-                    casted_value = _attempt_cast_for_assignment(val_update_str, df[col_update])
-                    df.at[idx, col_update] = casted_value  # Use .at for fast scalar setting.
-            
-            save_data(df)
-            return f"Updated {len(indices_to_update)} row(s). Conditions: {conditions}, Updates: {updates}"
 
-        elif op == "delete":
-            if df.empty: return "Data is empty, cannot delete."
-            condition_args_str = tokens[1:]
-            if not condition_args_str:
-                return "delete command requires conditions, e.g., delete name=Tom age=30. For bulk delete confirmation, add confirm=yes"
-
-            conditions = {}
-            confirm_delete = False  # Flag for confirming bulk deletes.
-            
-            # Separate 'confirm=yes' from actual conditions.
-            actual_condition_args_str = []
-            for token_cond in condition_args_str:
-                if token_cond.lower() == "confirm=yes":
-                    confirm_delete = True
-                else:
-                    actual_condition_args_str.append(token_cond)
-
-            if not actual_condition_args_str:  # Ensure there are actual conditions beyond just confirmation.
-                 return "delete command requires conditions to specify which rows to delete (beyond just 'confirm=yes')."
-
-            # Parse condition arguments.
-            for token_cond in actual_condition_args_str:
-                if '=' not in token_cond: 
-                    return f"delete command format error: condition '{token_cond}' format is incorrect. Expected 'column=value'."
-                k, v = token_cond.split('=', 1)
-                conditions[k] = v
-            
-            if not conditions:  # Should be caught by earlier checks, but as a safeguard.
-                return "delete command requires conditions to specify which rows to delete."
-
-            # Build a boolean mask based on conditions (similar to update).
-            mask = pd.Series(True, index=df.index)
-            for col_name, val_str in conditions.items():
-                if col_name not in df.columns: 
-                    return f"Error: Column '{col_name}' in conditions does not exist."
-
-                column_series = df[col_name]
-                current_condition_mask = pd.Series(False, index=df.index)
-                val_str_lower = str(val_str).lower()
-
-                if val_str_lower in ['nan', 'na', '<na>', 'none', '']:
-                    current_condition_mask = column_series.isna()
+                # Cast once for the column, then write every matched row in one vectorized assignment.
+                casted_value = _attempt_cast_for_assignment(val_update_str, df[col_update])
+                assign_at_positions(df, positions, col_update, casted_value)
+
+                # Log only the changed cells, unless the column is new or its dtype changed.
+                if prior_dtype is None or not same_column_dtype(df[col_update].dtype, prior_dtype):
+                    changes[col_update] = {"column": df[col_update].to_numpy()}
                 else:
-                    try:
-                        if pd.api.types.is_numeric_dtype(column_series.dtype):
-                            if val_str.startswith('>='): comp_val = pd.to_numeric(val_str[2:]); current_condition_mask = (column_series >= comp_val)
-                            elif val_str.startswith('<='): comp_val = pd.to_numeric(val_str[2:]); current_condition_mask = (column_series <= comp_val)
-                            elif val_str.startswith('>'): comp_val = pd.to_numeric(val_str[1:]); current_condition_mask = (column_series > comp_val)
-                            elif val_str.startswith('<'): comp_val = pd.to_numeric(val_str[1:]); current_condition_mask = (column_series < comp_val)
-                            elif val_str.startswith('!='): comp_val = pd.to_numeric(val_str[2:]); current_condition_mask = (column_series != comp_val)
-                            else: comp_val = pd.to_numeric(val_str); current_condition_mask = (column_series == comp_val)
-                        elif pd.api.types.is_bool_dtype(column_series.dtype):
-                            if val_str_lower in ['true', '1', 't', 'yes']: comp_val = True
-                            elif val_str_lower in ['false', '0', 'f', 'no']: comp_val = False
-                            else: comp_val = None 
-                            if comp_val is not None: current_condition_mask = (column_series == comp_val)
-                            else: current_condition_mask = (column_series.astype(str).str.lower() == val_str_lower)
-                        else:  # String/object type column
-                            str_series = column_series.astype(str)
-                            if val_str.startswith('*') and val_str.endswith('*'): pattern = val_str.strip('*'); current_condition_mask = str_series.str.contains(pattern, case=True, na=False)
-                            elif val_str.startswith('*'): suffix = val_str[1:]; current_condition_mask = str_series.str.endswith(suffix, na=False)
-                            elif val_str.endswith('*'): prefix = val_str[:-1]; current_condition_mask = str_series.str.startswith(prefix, na=False)
-                            else: current_condition_mask = (str_series == str(val_str))
-                    except ValueError:
-                        current_condition_mask = (column_series.astype(str) == str(val_str))
-                
-                mask &= current_condition_mask
-            
-            indices_to_delete = df.loc[mask].index
+                    changes[col_update] = {"values": df[col_update].to_numpy()[positions]}
+
+            log_mutation(df, {"op": "update", "positions": positions, "columns": changes})
+            return Message(f"Updated {len(indices_to_update)} row(s). Conditions: {conditions}, Updates: {updates}")
+
+        elif op == "delete":
+            if df.empty: return Message("Data is empty, cannot delete.", ok=False)
+            conditions, confirm_delete = args["conditions"], args["confirm"]
+
+            # Select the matching rows with the compiled condition plan (shared with update).
+            for col_name in conditions:
+                if col_name not in df.columns:
+                    return Message(f"Error: Column '{col_name}' in conditions does not exist.", ok=False)
+            positions = compile_conditions(conditions, df).positions(df)
+            indices_to_delete = df.index[positions]
             if indices_to_delete.empty:
-                return "No rows found matching conditions for delete."
-            
+                return Message("No rows found matching conditions for delete.")
+
             row_count = len(indices_to_delete)
             # Require confirmation if more than 10 rows are to be deleted.
             if row_count > 10 and not confirm_delete:
-                original_cmd_conditions = " ".join([f"{k}={v}" for k,v in conditions.items()])
-                return f"<span style='color:orange;'>Warning: This command will delete {row_count} rows. To proceed, add 'confirm=yes' to your command. E.g., delete {original_cmd_conditions} confirm=yes</span>"
+                return _confirm_delete_message(conditions, row_count)
             else:
-                df.drop(indices_to_delete, inplace=True)
-                save_data(df)
-                return f"<span style='color:red;'>Deleted {row_count} row(s). Conditions: {conditions}</span>"
-        
+                record = {"op": "delete", "positions": positions}
+                df = apply_wal_record(df, record)
+                log_mutation(df, record)
+                return Message(f"Deleted {row_count} row(s). Conditions: {conditions}", "danger")
+
         elif op == "search":  # Fuzzy search across all columns.
             if df.empty:
-                return "<span style='color:orange;'>No data to search. Please upload a CSV file first.</span>"
-            if len(tokens) < 2:
-                return "search command requires a keyword. Usage: search <keyword>"
-            keyword = tokens[1]
-            # Apply a function to each row to check if any cell contains the keyword (case-insensitive).
-            result_df = df[df.apply(lambda row: row.astype(str).str.contains(keyword, case=False, na=False).any(), axis=1)]
+                return Message("No data to search. Please upload a CSV file first.", "warning")
+            keyword = args["keyword"]
+            # Rows where any cell contains the keyword (case-insensitive), via the search index.
+            result_df = df.iloc[search_rows(df, keyword)]
 
             if result_df.empty:
-                return f"No rows found containing '{keyword}'."
-            return df_to_html_table(result_df)
-            
+                return Message(f"No rows found containing '{keyword}'.")
+            return df_to_table_result(result_df, query=("search", keyword), base=df, limit=command.limit)
+
         elif op == "search_exact":  # Exact search on a specific column, with operator support.
             if df.empty:
-                return "No data to search."
-            if len(tokens) != 2 or '=' not in tokens[1]:
-                return "search_exact command format error. Usage: search_exact column_name=value_to_search"
-            
-            col_name, val_str = tokens[1].split('=', 1)
+                return Message("No data to search.")
+            col_name, val_str = args["column"], args["value"]
 
             if col_name not in df.columns:
-                return f"Error: Column '{col_name}' does not exist."
-
-            column_series = df[col_name]
-            mask_se = pd.Series(False, index=df.index)  # Mask for search_exact.
-            val_str_lower = str(val_str).lower()
+                return Message(f"Error: Column '{col_name}' does not exist.", ok=False)
 
-            if val_str_lower in ['nan', 'na', '<na>', 'none', '']:
-                mask_se = column_series.isna()
-            else:
-                # Apply type-specific comparisons and operators (similar to update/delete).
-                try:
-                    if pd.api.types.is_numeric_dtype(column_series.dtype):
-                        if val_str.startswith('>='): comp_val = pd.to_numeric(val_str[2:]); mask_se = (column_series >= comp_val)
-                        elif val_str.startswith('<='): comp_val = pd.to_numeric(val_str[2:]); mask_se = (column_series <= comp_val)
-                        elif val_str.startswith('>'): comp_val = pd.to_numeric(val_str[1:]); mask_se = (column_series > comp_val)
-                        elif val_str.startswith('<'): comp_val = pd.to_numeric(val_str[1:]); mask_se = (column_series < comp_val)
-                        elif val_str.startswith('!='): comp_val = pd.to_numeric(val_str[2:]); mask_se = (column_series != comp_val)
-                        else: comp_val = pd.to_numeric(val_str); mask_se = (column_series == comp_val)
-                    elif pd.api.types.is_bool_dtype(column_series.dtype):
-                        if val_str_lower in ['true', '1', 't', 'yes']: comp_val = True
-                        elif val_str_lower in ['false', '0', 'f', 'no']: comp_val = False
-                        else: comp_val = None
-                        if comp_val is not None: mask_se = (column_series == comp_val)
-                        else: mask_se = (column_series.astype(str).str.lower() == val_str_lower)  # Fallback for non-standard bool strings
-                    else:  # String/object type column
-                        str_series = column_series.astype(str)
-                        if val_str.startswith('*') and val_str.endswith('*'): pattern = val_str.strip('*'); mask_se = str_series.str.contains(pattern, case=True, na=False)
-                        elif val_str.startswith('*'): suffix = val_str[1:]; mask_se = str_series.str.endswith(suffix, na=False)
-                        elif val_str.endswith('*'): prefix = val_str[:-1]; mask_se = str_series.str.startswith(prefix, na=False)
-                        else: mask_se = (str_series == str(val_str))
-                except ValueError: 
-                    mask_se = (column_series.astype(str) == str(val_str))  # Fallback on error.
-            
-            result_df = df[mask_se]
+            # Same compiled condition plan as update/delete.
+            result_df = df.iloc[compile_conditions({col_name: val_str}, df).positions(df)]
             if result_df.empty:
-                return f"No rows found where '{col_name}' matches '{val_str}'."
-            return df_to_html_table(result_df)
-            
+                return Message(f"No rows found where '{col_name}' matches '{val_str}'.")
+            return df_to_table_result(result_df, query=("search_exact", col_name, val_str), base=df, limit=command.limit)
+
         else:
-            # Handle unknown commands.
-            return f"<span style='color:orange;'>Unknown command: '{op}'. Type 'help' for available commands.</span>"
+            # Commands compile only to known operations; this is a safeguard.
+            return Message(f"Unknown command: '{op}'. Type 'help' for available commands.", "warning", ok=False)
     except Exception as e:
-        # General error handler for command parsing/execution.
-        return f"<span style='color:red;'>Error processing command '{cmd}': {e}. Please check syntax or use 'help'.</span>"
-
-# Converts an AI-generated JSON command object into an executable string command.
-def ai_cmd_to_str(ai_cmd):
-    if not isinstance(ai_cmd, dict) or "operation" not in ai_cmd:
-        return None  # Invalid AI command structure.
+        # General error handler for command execution.
+        return _command_failed(command, e)
 
-    op = ai_cmd.get("operation")
-
-    if op == "error":
-        return None 
-    elif op == "list":
-        return "list"
-    elif op == "columns":
-        return "columns"
-    elif op == "add":
-        data = ai_cmd.get("data", {})
-        if not data: return None  # 'add' requires data.
-        return "add " + " ".join([f"{shlex.quote(str(k))}={shlex.quote(str(v))}" for k, v in data.items()])
-    elif op == "add_batch":
-        columns = ai_cmd.get("columns")
-        values_matrix = ai_cmd.get("values")  # Expected as list of lists.
-        if not columns or not values_matrix or not isinstance(columns, list) or not isinstance(values_matrix, list):
-            return None 
-        if not values_matrix: 
-            return "add_batch" 
-        if not all(isinstance(row, list) and len(row) == len(columns) for row in values_matrix):
-            return None 
-
-        parts = []
-        for i, col_name in enumerate(columns):
-            col_values = []
-            for row in values_matrix:
-                val = row[i] if i < len(row) else '' 
-                col_values.append(str(val))
-            parts.append(f"{shlex.quote(col_name)}={','.join(map(shlex.quote, col_values))}")
-        return "add_batch " + " ".join(parts)
-    elif op == "update":
-        conditions = ai_cmd.get("conditions", {})
-        data_to_update = ai_cmd.get("data", {})
-        if not conditions or not data_to_update: return None 
-        
-        cond_str = " ".join([f"{shlex.quote(str(k))}={shlex.quote(str(v))}" for k, v in conditions.items()])
-        update_str = " ".join([f"{shlex.quote(str(k))}={shlex.quote(str(v))}" for k, v in data_to_update.items()])
-        return f"update {cond_str} set {update_str}"
-    elif op == "delete":
-        conditions = ai_cmd.get("conditions", {})
-        if not conditions: return None 
-        
-        cond_parts = []
-        for k,v in conditions.items():
-            cond_parts.append(f"{shlex.quote(str(k))}={shlex.quote(str(v))}")
-        cond_str = " ".join(cond_parts)
-        
-        confirm_str = " confirm=yes" if ai_cmd.get("confirm") is True else ""
-        return f"delete {cond_str}{confirm_str}".strip()
-    elif op == "search":
-        keyword = ai_cmd.get("keyword")
-        if keyword is None: return None 
-        return f"search {shlex.quote(str(keyword))}"
-    elif op == "search_exact":
-        column = ai_cmd.get("column")
-        value = ai_cmd.get("value")
-        if column is None or value is None: return None 
-        return f"search_exact {shlex.quote(str(column))}={shlex.quote(str(value))}"
-        
-    return None 
+# Warning of a delete that would remove more than 10 rows without confirm=yes.
+def _confirm_delete_message(conditions, row_count):
+    original_cmd_conditions = " ".join([f"{k}={v}" for k,v in conditions.items()])
+    return Message(f"Warning: This command will delete {row_count} rows. To proceed, add 'confirm=yes' to your command. "
+                   f"E.g., delete {original_cmd_conditions} confirm=yes", "warning", ok=False)
 
 # New route to set the API key
 @app.route("/set_api_key", methods=["POST"])
@@ -0,0 +1,324 @@
+# Benchmark harness for Flask Modern DB. Generates synthetic datasets, then at each scale times
+# the upload, every terminal command, export, page render, dataset load/save and an AI command
+# through the Flask test client, records peak memory, writes the results as JSON and compares
+# them with a stored baseline. Runs offline: the app works in a temporary directory and the AI
+# endpoint is a local stub that always answers the same command.
+#
+#   python bench.py                                   # 10k, 100k and 1M rows
+#   python bench.py --rows 10000,10000000 --repeat 5  # up to 10M rows
+#   python bench.py --save-baseline                   # also store the results as the baseline
+#   python bench.py --baseline bench_baseline.json    # compare; exit code 1 on regressions
+import argparse
+import importlib
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+GENERATE_CHUNK_ROWS = 1_000_000  # Rows generated and written to the CSV at a time
+NOISE_FLOOR_MS = 1.0  # Slowdowns smaller than this are never reported as regressions
+STUB_AI_COMMAND = {"operation": "columns"}  # What the stubbed AI endpoint answers
+
+# Writes a synthetic CSV of n rows to path: a unique id, an integer and a category with the given
+# cardinality, a float and a short text with missing values, a unique name and a boolean.
+def generate_csv(path, n, cardinality, null_fraction, seed=0):
+    rng = np.random.default_rng(seed)
+    with open(path, "w", newline="") as f:
+        for start in range(0, n, GENERATE_CHUNK_ROWS):
+            size = min(GENERATE_CHUNK_ROWS, n - start)
+            ids = np.arange(start, start + size)
+            amount = np.round(rng.random(size) * 1000, 2)
+            amount[rng.random(size) < null_fraction] = np.nan
+            note = rng.choice(np.array(["new", "returning", "vip", "churned"], dtype=object), size)
+            note[rng.random(size) < null_fraction] = None
+            chunk = pd.DataFrame({
+                "id": ids,
+                "quantity": rng.integers(0, cardinality, size),
+                "category": np.char.add("cat", rng.integers(0, cardinality, size).astype(str)),
+                "amount": amount,
+                "name": np.char.add("name", ids.astype(str)),
+                "active": rng.random(size) < 0.5,
+                "note": note,
+            })
+            chunk.to_csv(f, header=start == 0, index=False)
+
+# Starts a local HTTP server standing in for the AI endpoint and returns (server, base URL).
+def start_ai_stub():
+    body = json.dumps({"choices": [{"message": {"content": json.dumps(STUB_AI_COMMAND)}}]}).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+# Benchmarks one dataset size. Returns a list of result dicts, one per operation.
+class ScaleBenchmark:
+    def __init__(self, app_module, csv_path, rows, cardinality, repeat, measure_memory):
+        self.app = app_module
+        self.csv_path = csv_path
+        self.rows = rows
+        self.cardinality = cardinality
+        self.repeat = repeat
+        self.measure_memory = measure_memory
+        self.client = app_module.app.test_client()
+        self.client.get("/")  # Creates the session and its history.
+        with self.client.session_transaction() as sess:
+            self.history_id = sess["history_id"]
+        self.next_id = rows  # Ids for added rows
+        self.deleted = 0  # Ids deleted so far (0, 1, 2, ...)
+
+    # Runs a terminal command through the route and raises if its output reports an error.
+    def command(self, cmd):
+        self.client.post("/terminal_command", data={"terminal_input": cmd})
+        entries = self.app.terminal_history.entries(self.history_id)
+        output = entries[-1].get("html", "") if entries else ""
+        if "Error" in output or "Unknown command" in output:
+            raise RuntimeError(f"{cmd!r} failed: {output}")
+
+    def upload(self):
+        with open(self.csv_path, "rb") as f:
+            response = self.client.post("/upload", data={"file": (f, "bench.csv")}, content_type="multipart/form-data")
+        if response.status_code != 302:
+            raise RuntimeError(f"upload failed with status {response.status_code}")
+
+    def load_cold(self):
+        self.app.bump_data_version()  # Drops the cached frame, as an external edit would.
+        self.app.load_data(copy=False)
+
+    def save(self):
+        df = self.app.load_data()
+        self.app.dataset_writer.submit(lambda: self.app.save_data(df), with_frame=False)
+
+    def page_render(self):
+        response = self.client.get("/")
+        if response.status_code != 200:
+            raise RuntimeError(f"page render failed with status {response.status_code}")
+
+    def add(self):
+        self.command(f"add id={self.next_id} quantity=1 category=cat1 amount=9.5 name=added{self.next_id} active=true note=new")
+        self.next_id += 1
+
+    def add_batch(self):
+        ids = range(self.next_id, self.next_id + 100)
+        self.command("add_batch id=" + ",".join(map(str, ids)) + " category=" + ",".join("cat2" for _ in ids)
+                     + " amount=" + ",".join("1.25" for _ in ids))
+        self.next_id += 100
+
+    def update(self):
+        self.command(f"update category=cat{self.cardinality // 2} set amount=2.5")
+
+    def delete(self):
+        self.command(f"delete id={self.deleted}")
+        self.deleted += 1
+
+    def export(self, fmt="csv"):
+        response = self.client.get(f"/export?format={fmt}")
+        body = b"".join(response.iter_encoded())
+        response.close()
+        if response.status_code != 200 or not body:
+            raise RuntimeError(f"export failed with status {response.status_code}")
+        return body
+
+    # Checks that the JSON Lines export reads back the exact stored float values, for the
+    # dataset and for values that need all 17 significant digits.
+    def check_jsonl_floats(self):
+        exported = [json.loads(line)["amount"] for line in self.export("jsonl").splitlines()]
+        stored = [None if pd.isna(value) else value for value in self.app.load_data(copy=False)["amount"].tolist()]
+        hard = [0.1 + 0.2, 1 / 3, 1234567.891, 5e-324, 1.7976931348623157e308]
+        encoded = b"".join(self.app.encode_export([pd.DataFrame({"amount": hard})], "jsonl"))
+        if exported != stored or [json.loads(line)["amount"] for line in encoded.splitlines()] != hard:
+            raise RuntimeError("the JSON Lines export doesn't round-trip the float values")
+
+    def ai_command(self):
+        response = self.client.post("/ai_command", data={"user_input": "which columns are there?"},
+                                    headers={"Accept": "application/json"})
+        if response.status_code != 202:
+            raise RuntimeError(f"AI command failed with status {response.status_code}: {response.get_json()}")
+        status_url = response.get_json()["status_url"]
+        while True:
+            job = self.client.get(status_url).get_json()
+            if job["status"] in ("done", "error"):
+                break
+            time.sleep(0.001)
+        if job["status"] == "error":
+            raise RuntimeError(f"AI command failed: {job['error']}")
+
+    # Operation name -> callable, in the order they run. Mutations come after the reads so
+    # the reads see the freshly uploaded dataset.
+    def operations(self):
+        middle = self.rows // 2
+        return [
+            ("upload", self.upload),
+            ("load_cold", self.load_cold),
+            ("page_render", self.page_render),
+            ("list", lambda: self.command("list")),
+            ("columns", lambda: self.command("columns")),
+            ("search", lambda: self.command(f"search name{middle}")),
+            ("search_exact", lambda: self.command(f"search_exact category=cat{self.cardinality // 3}")),
+            ("search_exact_range", lambda: self.command("search_exact amount=>990")),
+            ("add", self.add),
+            ("add_batch", self.add_batch),
+            ("update", self.update),
+            ("delete", self.delete),
+            ("export", self.export),
+            ("export_jsonl", lambda: self.export("jsonl")),
+            ("save", self.save),
+            ("ai_command", self.ai_command),
+        ]
+
+    def run(self):
+        results = []
+        for name, operation in self.operations():
+            timings = []
+            for _ in range(self.repeat):
+                started = time.perf_counter()
+                operation()
+                timings.append((time.perf_counter() - started) * 1000)
+            peak_mb = None
+            if self.measure_memory:
+                # A separate traced run: tracing allocations slows the operation down.
+                tracemalloc.start()
+                try:
+                    operation()
+                    peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+                finally:
+                    tracemalloc.stop()
+            results.append({
+                "rows": self.rows,
+                "op": name,
+                "median_ms": round(statistics.median(timings), 3),
+                "min_ms": round(min(timings), 3),
+                "runs_ms": [round(t, 3) for t in timings],
+                "peak_mb": round(peak_mb, 2) if peak_mb is not None else None,
+            })
+            print(f"{self.rows:>10}  {name:<20} {results[-1]['median_ms']:>11.2f} ms"
+                  + (f" {peak_mb:>10.1f} MB" if peak_mb is not None else ""), flush=True)
+        self.check_jsonl_floats()
+        return results
+
+# Compares results with a baseline. Returns (report lines, number of regressions): an operation
+# regressed if its median is more than tolerance slower and by more than NOISE_FLOOR_MS.
+def compare(results, baseline, tolerance):
+    previous = {(r["rows"], r["op"]): r for r in baseline["results"]}
+    lines = [f"{'rows':>10}  {'operation':<20} {'baseline ms':>12} {'now ms':>12} {'change':>8}"]
+    regressions = 0
+    for result in results:
+        before = previous.get((result["rows"], result["op"]))
+        if before is None:
+            continue
+        now, then = result["median_ms"], before["median_ms"]
+        change = now / then - 1 if then else 0.0
+        regressed = change > tolerance and now - then > NOISE_FLOOR_MS
+        regressions += regressed
+        lines.append(f"{result['rows']:>10}  {result['op']:<20} {then:>12.2f} {now:>12.2f} {change:>+8.1%}"
+                     + ("  REGRESSION" if regressed else ""))
+    return lines, regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark Flask Modern DB on synthetic datasets.")
+    parser.add_argument("--rows", default="10000,100000,1000000", help="comma-separated dataset sizes")
+    parser.add_argument("--cardinality", type=int, default=1000, help="distinct values of quantity and category")
+    parser.add_argument("--null-fraction", type=float, default=0.05, help="share of missing amount and note values")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per operation")
+    parser.add_argument("--backend", choices=("columnar", "csv"), default="columnar", help="storage backend")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced run measuring peak memory")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="also write the results to bench_baseline.json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown reported as a regression (0.2 = 20%%)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    sizes = [int(n) for n in args.rows.split(",")]
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = tempfile.mkdtemp(prefix="moderndb-bench-")
+    stub, stub_url = start_ai_stub()
+
+    # The app keeps its data, sessions and caches relative to the working directory, and reads
+    # its configuration at import time.
+    os.environ.update({
+        "MODERNDB_STORAGE": args.backend,
+        "OPENROUTER_API_URL": stub_url,
+        "OPENROUTER_API_KEY": "bench",
+        "AI_MODEL": "bench/stub",
+        "MODERNDB_AI_CACHE": "off",  # Every AI command goes to the (stub) endpoint.
+    })
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    try:
+        app_module = importlib.import_module("app")
+        results = []
+        print(f"{'rows':>10}  {'operation':<20} {'median':>14}" + ("" if args.no_memory else f" {'peak':>13}"))
+        for n in sizes:
+            csv_path = os.path.join(workdir, f"bench-{n}.csv")
+            generate_csv(csv_path, n, args.cardinality, args.null_fraction)
+            bench = ScaleBenchmark(app_module, csv_path, n, args.cardinality, args.repeat, not args.no_memory)
+            results.extend(bench.run())
+            os.remove(csv_path)
+    finally:
+        stub.shutdown()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "backend": args.backend,
+            "cardinality": args.cardinality,
+            "null_fraction": args.null_fraction,
+            "repeat": args.repeat,
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        },
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output} (process peak RSS {report['meta']['max_rss_mb']} MB)")
+    if args.save_baseline:
+        with open(os.path.join(REPO_DIR, "bench_baseline.json"), "w") as f:
+            json.dump(report, f, indent=2)
+        print("Baseline saved to bench_baseline.json")
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        for key in ("backend", "cardinality", "null_fraction"):
+            if baseline["meta"].get(key) != report["meta"][key]:
+                print(f"Warning: baseline was run with {key}={baseline['meta'].get(key)}, now {report['meta'][key]}")
+        lines, regressions = compare(results, baseline, args.tolerance)
+        print("\n".join(lines))
+        if regressions:
+            print(f"{regressions} regression(s) over {args.tolerance:.0%}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()